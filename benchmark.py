@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark suite of the 2D turbulence solver.
+
+A case is a solver, 'python' for Vorticity2D or 'serial' for
+Vorticity2DSerial, a grid of n x n points, an FFT backend and a number
+of threads. The box is chosen so that the grid has exactly n points
+at Re = 10000, and the initial condition is the vortex soup.
+
+Every case runs in a new process, so the peak memory of the process
+is the one of the case and the FFTW state of the Fortran module is
+not shared. After a few steps to warm up, the steps are timed one by
+one until *nsteps* steps or *seconds* seconds. The results are a
+dictionary with the description of the machine and one row per case,
+that can be saved as JSON and compared with a stored baseline.
+
+Example.
+results = suite(sizes=[64,128,256],solvers=['python','serial'])
+save(results,'bench.json')
+compare(results,load('baseline.json'))
+
+Or from the command line, failing if a case is 10% slower
+python benchmark.py --sizes 64 128 256 --output bench.json \\
+    --baseline baseline.json --tolerance 0.1
+"""
+
+from __future__ import division
+import sys
+import json
+import timeit
+import platform
+import argparse
+import itertools
+import subprocess
+import multiprocessing
+import numpy
+from datetime import datetime
+
+import turbulence
+from memory import maxrss
+
+solvers = {'python': turbulence.Vorticity2D,
+           'serial': turbulence.Vorticity2DSerial}
+
+quick_sizes = (64,128,256,512)
+full_sizes = (64,128,256,512,1024,2048,4096)
+
+Re = 10000
+
+
+def box(n):
+    """Length of the box with n points at Re = 10000"""
+    return n/(0.64*numpy.sqrt(Re))
+
+
+def case_id(case):
+    """
+    String that identifies a case in the results and the baseline
+    """
+    return '{solver},n={n},{backend},threads={threads}'.format(**case)
+
+
+def run(case):
+    """
+    Runs a single case, a dictionary with the keys solver, n, backend,
+    threads, nsteps, seconds and warmup, and optionally solver_args, a
+    dictionary of keyword arguments for the solver. Returns a row of
+    the results.
+    """
+    row = dict(case)
+    row['id'] = case_id(case)
+    row['status'] = 'ok'
+    try:
+        before = maxrss()
+        L = box(case['n'])
+        kwargs = dict(backend=case['backend'],threads=case['threads'])
+        if case['solver'] == 'serial':
+            kwargs['rigor'] = 'FFTW_ESTIMATE'
+        kwargs.update(case.get('solver_args',{}))
+        V = solvers[case['solver']](L,L,Re,0.2,**kwargs)
+        V.set_initial(turbulence.vortex_soup(V,L,L))
+        for i in range(case['warmup']):
+            V.step()
+
+        times = []
+        while len(times) < case['nsteps']:
+            tstamp = timeit.default_timer()
+            V.step()
+            times.append(timeit.default_timer()-tstamp)
+            if len(times) >= 3 and sum(times) > case['seconds']:
+                break
+        if hasattr(V,'cleanup'):
+            V.cleanup()
+
+        row.update(nx=V.nx,ny=V.ny,steps=len(times),
+                   # The backend may fall back to numpy
+                   backend_used=V.backend.name,
+                   fortran=getattr(V,'fortran',False),
+                   median=float(numpy.median(times)),
+                   min=float(numpy.min(times)),
+                   steps_per_second=float(1/numpy.median(times)),
+                   peak_mb=maxrss(),
+                   solver_mb=maxrss()-before)
+    except Exception as err:
+        row['status'] = 'error: {}'.format(err)
+    return row
+
+
+def machine():
+    """Description of the machine and the software"""
+    try:
+        commit = subprocess.check_output(['git','rev-parse','HEAD'],
+                                         stderr=subprocess.STDOUT).strip()
+    except (OSError,subprocess.CalledProcessError):
+        commit = None
+    return {'host': platform.node(),
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpus': multiprocessing.cpu_count(),
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'fftw': turbulence.fftw_version(),
+            'fortran': turbulence.rhs_tur2d is not None,
+            'commit': commit,
+            'date': datetime.now().isoformat()}
+
+
+def suite(sizes=quick_sizes,solvers=('python','serial'),backends=('numpy',),
+          threads=(1,),nsteps=50,seconds=5.0,warmup=2,solver_args=None):
+    """
+    Runs all the combinations of *solvers*, *sizes*, *backends* and
+    *threads*. Each case takes at most *nsteps* steps or *seconds*
+    seconds, at least three steps, after *warmup* steps. *solver_args*
+    is a dictionary of keyword arguments for all the solvers.
+
+    Returns a dictionary with the keys machine and cases.
+    """
+    cases = []
+    for solver,n,backend,nthreads in itertools.product(solvers,sizes,
+                                                       backends,threads):
+        cases.append({'solver': solver, 'n': n, 'backend': backend,
+                      'threads': nthreads, 'nsteps': nsteps,
+                      'seconds': seconds, 'warmup': warmup,
+                      'solver_args': solver_args or {}})
+
+    rows = []
+    # A new process for each case
+    pool = multiprocessing.Pool(1,maxtasksperchild=1)
+    try:
+        for row in pool.imap(run,cases):
+            rows.append(row)
+            if row['status'] == 'ok':
+                print '{:<40} {:>10.2f} steps/s {:>10.1f} MB'.format(
+                    row['id'],row['steps_per_second'],row['peak_mb'])
+            else:
+                print '{:<40} {}'.format(row['id'],row['status'])
+    finally:
+        pool.terminate()
+
+    return {'machine': machine(), 'cases': rows}
+
+
+def save(results,filename):
+    """Writes the *results* of :func:`suite` to the JSON *filename*"""
+    output = open(filename,'w')
+    json.dump(results,output,indent=2)
+    output.close()
+
+
+def load(filename):
+    """Reads the results saved with :func:`save`"""
+    jsonfile = open(filename)
+    results = json.load(jsonfile)
+    jsonfile.close()
+    return results
+
+
+def compare(results,baseline,tolerance=0.1):
+    """
+    Compares the speed and the peak memory of the cases in *results*
+    with the same cases in *baseline*. A case is a regression if it
+    is slower, or uses more memory, by more than the fraction
+    *tolerance*. Prints the table and returns the ids of the
+    regressions.
+    """
+    if results['machine']['host'] != baseline['machine']['host']:
+        print 'Warning: baseline from',baseline['machine']['host']
+
+    reference = dict((row['id'],row) for row in baseline['cases']
+                     if row['status'] == 'ok')
+    regressions = []
+    print '{:<40} {:>10} {:>10} {:>8} {:>8}'.format(
+        'case','steps/s','baseline','speed','memory')
+    for row in results['cases']:
+        old = reference.get(row['id'])
+        if row['status'] != 'ok' or old is None:
+            continue
+        speed = row['steps_per_second']/old['steps_per_second']
+        memory = row['peak_mb']/old['peak_mb']
+        status = ''
+        if speed < 1-tolerance or memory > 1+tolerance:
+            status = 'REGRESSION'
+            regressions.append(row['id'])
+        print '{:<40} {:>10.2f} {:>10.2f} {:>8.3f} {:>8.3f} {}'.format(
+            row['id'],row['steps_per_second'],old['steps_per_second'],
+            speed,memory,status)
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark suite of the 2D turbulence solver')
+    parser.add_argument('--sizes',type=int,nargs='+',default=quick_sizes)
+    parser.add_argument('--full',action='store_true',
+                        help='Grids from 64 to 4096 points')
+    parser.add_argument('--solvers',nargs='+',default=['python','serial'],
+                        choices=sorted(solvers))
+    parser.add_argument('--backends',nargs='+',default=['numpy'])
+    parser.add_argument('--threads',type=int,nargs='+',default=[1])
+    parser.add_argument('--nsteps',type=int,default=50)
+    parser.add_argument('--seconds',type=float,default=5.0)
+    parser.add_argument('--output',help='JSON file for the results')
+    parser.add_argument('--baseline',help='JSON file to compare with')
+    parser.add_argument('--tolerance',type=float,default=0.1)
+    args = parser.parse_args(argv)
+
+    results = suite(full_sizes if args.full else args.sizes,args.solvers,
+                    args.backends,args.threads,args.nsteps,args.seconds)
+    if args.output:
+        save(results,args.output)
+    if args.baseline:
+        regressions = compare(results,load(args.baseline),args.tolerance)
+        if regressions:
+            print len(regressions),'regressions'
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Diagnostics of the 2D turbulence solver computed from the spectrum
+of the vorticity, without additional transforms.
+
+By Parseval's theorem the mean of the square of a field is the sum of
+the squared modulus of its Fourier coefficients divided by (nx*ny)**2.
+The kinetic energy, the enstrophy, the palinstrophy and the energy
+spectrum are weighted sums of abs(omega_hat)**2, with weights that
+only depend on the wavenumbers and are computed once. The maximum
+velocity is the one the solver already computes for the timestep.
+
+The records are kept in a buffer that is appended to a binary file
+when it is full. :func:`load` reads the file back.
+
+Example.
+V = Vorticity2D(2.0,2.0,10000,0.2)
+V.diagnostics = Diagnostics(V,'run.diag',every=10)
+for i in range(nsteps):
+    V.step()
+V.diagnostics.close()
+"""
+
+from __future__ import division
+import json
+import numpy
+
+
+def record_dtype(batch,nshells):
+    """
+    Type of the records for an ensemble of shape *batch* and a
+    spectrum of *nshells* wavenumbers.
+    """
+    return numpy.dtype([('t','f8',batch),
+                        ('energy','f8',batch),
+                        ('enstrophy','f8',batch),
+                        ('palinstrophy','f8',batch),
+                        ('vmax','f8',batch),
+                        ('spectrum','f4',batch+(nshells,))])
+
+
+def modes(V):
+    """
+    Weights of the modes of the solver *V*, two for the modes that
+    stand for their complex conjugate in a half spectrum, the squared
+    wavenumbers, one at k = 0, the width of the shells and the shell
+    of each mode, both raveled.
+    """
+    herm = numpy.ones(V.kx.shape)
+    if V.rfft:
+        # Index of the mode, the last one of an even nx is alone
+        kx = numpy.rint(V.kx*V.Lx/(2*numpy.pi))
+        herm[numpy.logical_and(kx > 0,2*kx < V.nx)] = 2
+    k2 = V.kx**2+V.ky**2
+    # k = 0 is not at the first position in a distributed solver
+    zero = k2 == 0
+    k2[zero] = 1
+
+    dk = 2*numpy.pi/max(V.Lx,V.Ly)
+    shell = numpy.rint(numpy.sqrt(k2)/dk).astype('int')
+    shell[zero] = 0
+    return herm.ravel(),k2.ravel(),dk,shell.ravel()
+
+
+class Diagnostics(object):
+    """
+    Time series of the integral quantities and the energy spectrum
+    of the solver *V*, sampled every *every* steps and written to
+    *filename* every *size* samples. If *filename* is None all the
+    records are kept in memory, see :attr:`records`.
+
+    Each record has the fields t, energy, enstrophy, palinstrophy,
+    vmax and spectrum, the energy in each shell of wavenumbers
+    between (k-1/2)*dk and (k+1/2)*dk, being dk = 2*pi/max(Lx,Ly).
+    For an ensemble every field has an additional dimension. With a
+    distributed solver the sums are reduced over all the processes
+    and only the first one writes the file.
+    """
+    def __init__(self,V,filename=None,every=1,size=1024):
+        if V.rank != 0:
+            filename = None
+        self.filename = filename
+        self.every = every
+        self.batch = V.batch
+        self.count = 0
+        self.n = 0
+
+        herm,k2,dk,self.shell = modes(V)
+        norm = 0.5/(V.nx*V.ny)**2
+        self.w_enstrophy = norm*herm
+        self.w_energy = norm*herm/k2
+        self.w_palinstrophy = norm*herm*k2
+        zero = (V.kx**2+V.ky**2).ravel() == 0
+        self.w_energy[zero] = 0
+        self.w_palinstrophy[zero] = 0
+
+        self.nshells = int(V.allreduce(self.shell.max(),'max'))+1
+        self.k = dk*numpy.arange(self.nshells)
+
+        self.abs2 = numpy.zeros(V.omega_hat.shape)
+        self.buffer = numpy.zeros(size,dtype=record_dtype(self.batch,
+                                                          self.nshells))
+
+        if filename is not None:
+            header = open(filename+'.json','w')
+            json.dump({'batch': list(self.batch),
+                       'nshells': int(self.nshells),
+                       'dk': dk},header,indent=2)
+            header.close()
+            # Start with an empty file
+            open(filename,'wb').close()
+
+    def record(self,V):
+        """
+        Called by the solver at the beginning of each step, after the
+        timestep has been computed.
+        """
+        self.count += 1
+        if (self.count-1)%self.every:
+            return
+
+        numpy.absolute(V.omega_hat,out=self.abs2)
+        numpy.square(self.abs2,out=self.abs2)
+        abs2 = self.abs2.reshape(self.batch+(-1,))
+
+        spectrum = numpy.zeros(self.batch+(self.nshells,))
+        if self.batch:
+            for i in numpy.ndindex(*self.batch):
+                spectrum[i] = numpy.bincount(self.shell,abs2[i]*self.w_energy,
+                                             self.nshells)
+        else:
+            spectrum[...] = numpy.bincount(self.shell,abs2*self.w_energy,
+                                           self.nshells)
+
+        n = self.n
+        self.buffer['t'][n] = numpy.reshape(V.t,self.batch)
+        self.buffer['vmax'][n] = V.vmax
+        self.buffer['energy'][n] = V.allreduce(abs2.dot(self.w_energy))
+        self.buffer['enstrophy'][n] = V.allreduce(abs2.dot(self.w_enstrophy))
+        self.buffer['palinstrophy'][n] = \
+            V.allreduce(abs2.dot(self.w_palinstrophy))
+        self.buffer['spectrum'][n] = V.allreduce(spectrum)
+
+        self.n += 1
+        if self.n == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        """
+        Appends the records in the buffer to the file
+        """
+        if self.filename is None:
+            # Keep the last records in memory
+            if self.n == len(self.buffer):
+                self.buffer = numpy.concatenate(
+                    (self.buffer,numpy.zeros_like(self.buffer)))
+            return
+
+        output = open(self.filename,'ab')
+        self.buffer[:self.n].tofile(output)
+        output.close()
+        self.n = 0
+
+    @property
+    def records(self):
+        """Records that are still in the buffer"""
+        return self.buffer[:self.n]
+
+    def close(self):
+        self.flush()
+
+
+def load(filename):
+    """
+    Reads the records of the diagnostics file *filename*. Returns the
+    records and the wavenumbers of the spectrum.
+    """
+    header = open(filename+'.json')
+    meta = json.load(header)
+    header.close()
+
+    dtype = record_dtype(tuple(meta['batch']),meta['nshells'])
+    return (numpy.fromfile(filename,dtype=dtype),
+            meta['dk']*numpy.arange(meta['nshells']))
@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+"""
+FFT backends for the 2D turbulence solver.
+
+All the backends share the same interface. They are created for a
+given shape of the physical field and they know whether the full
+complex spectrum or only the half given by the Hermitian symmetry is
+stored. The transforms are done on the last two dimensions, the
+leading ones are a batch of independent fields.
+
+  *forward(a,out=None)*
+    Spectrum of the real field *a*
+
+  *backward(a_hat,out=None)*
+    Real part of the inverse transform of *a_hat*. The input is
+    never modified.
+
+  *zeros(shape,dtype)*
+    Array suitable to be used as *out*
+
+  *inplace*
+    True if the transforms write on *out*. The ones that cannot,
+    like numpy.fft, copy the result on it, pass out=None to them and
+    keep the returned array instead.
+
+With *single* the fields are single precision, complex64 and
+float32. numpy.fft always computes in double precision and only the
+results are converted, the other libraries compute in single
+precision.
+
+A backend may store only part of the fields, then *physical_shape*
+and *spectral_shape* are the shapes of the local parts, *rows* the
+slice of rows of the physical field and *columns* the slice of
+columns of the spectrum. Non distributed backends store everything.
+
+Available backends are 'numpy', 'scipy' (scipy.fft, multithreaded
+with *threads*), 'pyfftw' (multithreaded, with optional wisdom
+file) and 'mpi' (distributed with mpi4py). Use :func:`get_backend` to
+create them.
+"""
+
+from __future__ import division
+import os
+import pickle
+import numpy
+
+
+class NumpyFFT(object):
+    """
+    Transforms from numpy.fft. Always available.
+    """
+    name = 'numpy'
+    rows = slice(None)
+    columns = slice(None)
+    inplace = False
+
+    def __init__(self,shape,rfft=False,threads=1,single=False,**kwargs):
+        self.shape = tuple(shape)
+        self.rfft = rfft
+        self.threads = 1
+        self.single = single
+        self.dtype = numpy.dtype('complex64' if single else 'complex128')
+        self.real_dtype = numpy.dtype('float32' if single else 'float64')
+        self.physical_shape = self.shape
+        if rfft:
+            self.spectral_shape = self.shape[:-1]+(self.shape[-1]//2+1,)
+        else:
+            self.spectral_shape = self.shape
+
+    def zeros(self,shape,dtype='float',order='C'):
+        return numpy.zeros(shape,dtype=dtype,order=order)
+
+    def _fft2(self,a):
+        if self.rfft:
+            return numpy.fft.rfft2(a)
+        else:
+            return numpy.fft.fft2(a)
+
+    def _ifft2(self,a_hat):
+        if self.rfft:
+            return numpy.fft.irfft2(a_hat,s=self.shape[-2:])
+        else:
+            return numpy.fft.ifft2(a_hat).real
+
+    def forward(self,a,out=None):
+        a_hat = self._fft2(a)
+        if out is None:
+            return a_hat.astype(self.dtype,copy=False)
+        out[...] = a_hat
+        return out
+
+    def backward(self,a_hat,out=None):
+        a = self._ifft2(a_hat)
+        if out is None:
+            return a.astype(self.real_dtype,copy=False)
+        out[...] = a
+        return out
+
+
+class ScipyFFT(NumpyFFT):
+    """
+    Transforms from scipy.fft, using *threads* workers. Requires
+    scipy 1.4 or newer.
+    """
+    name = 'scipy'
+
+    def __init__(self,shape,rfft=False,threads=1,single=False,**kwargs):
+        import scipy.fft
+        NumpyFFT.__init__(self,shape,rfft,single=single)
+        self.fft = scipy.fft
+        self.threads = threads
+
+    def _fft2(self,a):
+        if self.rfft:
+            return self.fft.rfft2(a,workers=self.threads)
+        else:
+            return self.fft.fft2(a,workers=self.threads)
+
+    def _ifft2(self,a_hat):
+        if self.rfft:
+            return self.fft.irfft2(a_hat,s=self.shape[-2:],
+                                   workers=self.threads)
+        else:
+            return self.fft.ifft2(a_hat,workers=self.threads).real
+
+
+class PyFFTW(NumpyFFT):
+    """
+    FFTW plans through pyfftw. The plans are created once, in the
+    constructor, with the planner *rigor*. If *wisdom* is the path of
+    a file, the wisdom is imported from it before planning and saved
+    afterwards.
+    """
+    name = 'pyfftw'
+    inplace = True
+
+    def __init__(self,shape,rfft=False,threads=1,single=False,
+                 wisdom=None,rigor='FFTW_MEASURE',**kwargs):
+        import pyfftw
+        NumpyFFT.__init__(self,shape,rfft,single=single)
+        self.pyfftw = pyfftw
+        self.threads = threads
+        self.wisdom = wisdom
+
+        if wisdom and os.path.exists(wisdom):
+            wisdomfile = open(wisdom,'rb')
+            pyfftw.import_wisdom(pickle.load(wisdomfile))
+            wisdomfile.close()
+
+        if rfft:
+            a = pyfftw.empty_aligned(shape,dtype=self.real_dtype)
+        else:
+            a = pyfftw.empty_aligned(shape,dtype=self.dtype)
+
+        a_hat = pyfftw.empty_aligned(self.spectral_shape,dtype=self.dtype)
+        self.a = a
+        self.a_hat = a_hat
+        self.fw = pyfftw.FFTW(a,a_hat,axes=(-2,-1),
+                              direction='FFTW_FORWARD',
+                              flags=(rigor,),threads=threads)
+        # The complex to real transform destroys its input, the
+        # plan has its own copy.
+        self.bw = pyfftw.FFTW(a_hat,a,axes=(-2,-1),
+                              direction='FFTW_BACKWARD',
+                              flags=(rigor,'FFTW_DESTROY_INPUT'),
+                              threads=threads)
+
+        if wisdom:
+            wisdomfile = open(wisdom,'wb')
+            pickle.dump(pyfftw.export_wisdom(),wisdomfile)
+            wisdomfile.close()
+
+    def zeros(self,shape,dtype='float',order='C'):
+        return self.pyfftw.zeros_aligned(shape,dtype=dtype,order=order)
+
+    # A plan called with output_array keeps writing there in the next
+    # calls, so the arrays of the plan are passed again without *out*.
+    def forward(self,a,out=None):
+        self.fw.input_array[...] = a
+        if out is None:
+            return self.fw(output_array=self.a_hat).copy()
+        return self.fw(output_array=out)
+
+    def backward(self,a_hat,out=None):
+        self.bw.input_array[...] = a_hat
+        if self.rfft and out is not None:
+            return self.bw(output_array=out)
+
+        a = self.bw(output_array=self.a)
+        if not self.rfft:
+            a = a.real
+        if out is None:
+            return a.copy()
+        out[...] = a
+        return out
+
+
+def _split(n,parts):
+    """First index of each of the *parts* blocks of *n*, and n"""
+    return numpy.array([i*n//parts for i in range(parts+1)])
+
+
+class SlabFFT(NumpyFFT):
+    """
+    Transforms distributed over the processes of the MPI communicator
+    *comm*, COMM_WORLD by default. Each process stores a slab of rows
+    of the physical field and a slab of columns of the spectrum. The
+    transforms in x are done on the rows, the data is transposed with
+    a single all to all exchange and the transforms in y are done on
+    the columns. The order of the one dimensional transforms is the
+    one of numpy.fft.fft2, so the results are the same as NumpyFFT.
+    Batches are not supported.
+    """
+    name = 'mpi'
+
+    def __init__(self,shape,rfft=False,threads=1,single=False,comm=None,
+                 **kwargs):
+        from mpi4py import MPI
+        NumpyFFT.__init__(self,shape,rfft,single=single)
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        if single:
+            self.datatype = MPI.C_FLOAT_COMPLEX
+        else:
+            self.datatype = MPI.C_DOUBLE_COMPLEX
+
+        ny,nx = self.shape
+        nk = self.spectral_shape[1]
+        size = comm.Get_size()
+        rank = comm.Get_rank()
+        if size > min(ny,nk):
+            raise ValueError('More processes than rows or columns')
+
+        ystart = _split(ny,size)
+        kstart = _split(nk,size)
+        self.rows = slice(ystart[rank],ystart[rank+1])
+        self.columns = slice(kstart[rank],kstart[rank+1])
+        nyl = ystart[rank+1]-ystart[rank]
+        nkl = kstart[rank+1]-kstart[rank]
+        self.physical_shape = (nyl,nx)
+        self.spectral_shape = (ny,nkl)
+
+        # Rows transformed in x, split by columns, and columns split
+        # by rows, the two sides of the transpose.
+        self.kstart = kstart
+        self.xside = (nyl*numpy.diff(kstart),nyl*kstart[:-1])
+        self.yside = (nkl*numpy.diff(ystart),nkl*ystart[:-1])
+        self.xbuf = numpy.empty(nyl*nk,dtype=self.dtype)
+        self.ybuf = numpy.empty(ny*nkl,dtype=self.dtype)
+
+    def _xblock(self,r):
+        """Block of the rows that goes to or comes from process *r*"""
+        k0,k1 = self.kstart[r],self.kstart[r+1]
+        return self.xbuf[self.physical_shape[0]*k0:
+                         self.physical_shape[0]*k1].reshape(-1,k1-k0)
+
+    def forward(self,a,out=None):
+        if self.rfft:
+            ax = numpy.fft.rfft(a,axis=-1)
+        else:
+            ax = numpy.fft.fft(a,axis=-1)
+
+        for r in range(len(self.kstart)-1):
+            self._xblock(r)[...] = ax[:,self.kstart[r]:self.kstart[r+1]]
+        self.comm.Alltoallv([self.xbuf,self.xside,self.datatype],
+                            [self.ybuf,self.yside,self.datatype])
+
+        a_hat = numpy.fft.fft(self.ybuf.reshape(self.spectral_shape),axis=0)
+        if out is None:
+            return a_hat.astype(self.dtype,copy=False)
+        out[...] = a_hat
+        return out
+
+    def backward(self,a_hat,out=None):
+        self.ybuf.reshape(self.spectral_shape)[...] = \
+            numpy.fft.ifft(a_hat,axis=0)
+        self.comm.Alltoallv([self.ybuf,self.yside,self.datatype],
+                            [self.xbuf,self.xside,self.datatype])
+
+        ax = numpy.empty((self.physical_shape[0],self.kstart[-1]),
+                         dtype='complex')
+        for r in range(len(self.kstart)-1):
+            ax[:,self.kstart[r]:self.kstart[r+1]] = self._xblock(r)
+        if self.rfft:
+            a = numpy.fft.irfft(ax,n=self.shape[1],axis=-1)
+        else:
+            a = numpy.fft.ifft(ax,axis=-1).real
+        if out is None:
+            return a.astype(self.real_dtype,copy=False)
+        out[...] = a
+        return out
+
+
+backends = {'numpy': NumpyFFT,
+            'scipy': ScipyFFT,
+            'pyfftw': PyFFTW,
+            'mpi': SlabFFT}
+
+
+def get_backend(name,shape,rfft=False,threads=1,**kwargs):
+    """
+    Returns the backend *name* for fields of *shape*. If the library
+    is not available it falls back to numpy. Additional keyword
+    arguments are passed to the backend.
+    """
+    try:
+        return backends[name](shape,rfft,threads,**kwargs)
+    except ImportError as err:
+        print 'FFT backend',name,'not available, using numpy:',err
+        return NumpyFFT(shape,rfft,**kwargs)
+
+
+def test_backends(shape=(48,64),threads=2):
+    """
+    Compares the transforms of the backends that can be imported with
+    numpy.fft, complex and real to complex, with and without *out*.
+    A call without *out* must not write in the *out* of a previous
+    call.
+    """
+    a = numpy.random.randn(*shape)
+    b = numpy.random.randn(*shape)
+    for rfft in (False,True):
+        reference = NumpyFFT(shape,rfft)
+        a_hat = reference.forward(a)
+        b_hat = reference.forward(b)
+        for name in ('scipy','pyfftw'):
+            F = get_backend(name,shape,rfft,threads=threads)
+            if F.name != name:
+                continue
+            out_hat = F.zeros(F.spectral_shape,dtype=F.dtype)
+            out = F.zeros(F.physical_shape,dtype=F.real_dtype)
+            F.forward(a,out=out_hat)
+            F.backward(a_hat,out=out)
+            saved_hat = out_hat.copy()
+            saved = out.copy()
+            errors = (abs(F.forward(b)-b_hat).max(),
+                      abs(F.backward(b_hat)-b).max())
+            print name,'rfft:',rfft,'errors:',errors
+            assert max(errors) < 1e-12
+            assert numpy.all(out_hat == saved_hat)
+            assert numpy.all(out == saved)
+            assert abs(saved_hat-a_hat).max() < 1e-12
+            assert abs(saved-a).max() < 1e-12
@@ -1,7 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Daily, weekly or monthly quotes of Yahoo Finance.
+
+With a *cache* directory the data of every symbol is kept on disk,
+and a read only requests the dates that are not there yet. Use
+:func:`read_many` to read many symbols concurrently, with a pool of
+threads that share a :class:`Client` and keep their connections open.
+A :class:`Store` packs the series of many symbols in memory mapped
+columns, and yahoostock can read any window of a symbol from it
+without loading the rest.
+
+Example.
+stocks = read_many(['IBM','AAPL','MSFT'],cache='/data/quotes',
+                   sdate=datetime.date(2005,1,1))
+"""
+
+import os
+import json
+import time
+import zlib
+import socket
 import urllib
+import urlparse
+import httplib
+import threading
+import tempfile
+import shutil
+import StringIO
+import BaseHTTPServer
+import SocketServer
+from multiprocessing.pool import ThreadPool
 import numpy
 import datetime
 import pylab
+from memory import maxrss
+
+# Columns of table.csv
+columns = ['date','open','high','low','close','volume','adj_close']
+
+# Day number of 1970-01-01, the origin of datetime64
+epoch = datetime.date(1970,1,1).toordinal()
+
+
+def parse(text):
+    """
+    Columns of the table.csv in the string *text* as a (7,N) array,
+    one row per column. The dates are day numbers, the same as
+    pylab.datestr2num gives for them.
+    """
+    ncols = len(columns)
+    # Skip the header, all the fields in a single list
+    text = text.replace('\r','')
+    fields = text[text.find('\n')+1:].replace('\n',',').split(',')
+    if fields[-1] == '':
+        fields.pop()
+
+    table = numpy.empty((ncols,len(fields)//ncols))
+    table[0] = numpy.array(fields[0::ncols],dtype='datetime64[D]'
+                           ).astype('int64')+epoch
+    for i in range(1,ncols):
+        table[i] = numpy.array(fields[i::ncols],dtype='float64')
+    return table
+
+
+class Client(object):
+    """
+    HTTP client that keeps a connection open to each host in each
+    thread, so many requests do not open a connection each. It can be
+    shared by the threads of a pool.
+    """
+    def __init__(self,timeout=30):
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def _connection(self,host,new=False):
+        connections = self.local.__dict__.setdefault('connections',{})
+        if new and host in connections:
+            connections.pop(host).close()
+        if host not in connections:
+            connections[host] = httplib.HTTPConnection(host,
+                                                       timeout=self.timeout)
+        return connections[host]
+
+    def get(self,url):
+        """
+        Body of the response to a GET of *url*, an empty string if the
+        resource is not found. Raises IOError if the request fails.
+        """
+        parts = urlparse.urlsplit(url)
+        path = parts.path+('?'+parts.query if parts.query else '')
+        for retry in (False,True):
+            # The server may have closed an idle connection
+            try:
+                connection = self._connection(parts.netloc,new=retry)
+                connection.request('GET',path)
+                response = connection.getresponse()
+                body = response.read()
+                break
+            except (httplib.HTTPException,socket.error) as err:
+                if retry:
+                    raise IOError(err)
+
+        if response.status == 404:
+            return ''
+        if response.status != 200:
+            raise IOError('HTTP {} {} for {}'.format(
+                    response.status,response.reason,url))
+        return body
+
+
+class Cache(object):
+    """
+    Local copy of the data of yahoostock in the directory *path*.
+    Each symbol and density has a .npy file with the rows sorted by
+    date, and a .json file with the first and the last date that have
+    been requested as day numbers, None for the whole history.
+    """
+    def __init__(self,path):
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _name(self,symbol,density):
+        return os.path.join(self.path,'{}_{}'.format(symbol,density))
+
+    def get(self,symbol,density):
+        """
+        Data, first and last date requested of *symbol*, all None if
+        the symbol is not in the cache.
+        """
+        name = self._name(symbol,density)
+        if not os.path.exists(name+'.json'):
+            return None,None,None
+        rangefile = open(name+'.json')
+        requested = json.load(rangefile)
+        rangefile.close()
+        return numpy.load(name+'.npy'),requested['start'],requested['end']
+
+    def put(self,symbol,density,data,start,end):
+        """
+        Stores the *data* of *symbol* requested from *start* to
+        *end*. The files are replaced when they are complete.
+        """
+        name = self._name(symbol,density)
+        tmp = '{}.{}.tmp'.format(name,threading.current_thread().ident)
+        numpy.save(tmp+'.npy',data)
+        rangefile = open(tmp+'.json','w')
+        json.dump({'start': start, 'end': end},rangefile)
+        rangefile.close()
+        # The range is replaced last, it never covers missing data
+        os.rename(tmp+'.npy',name+'.npy')
+        os.rename(tmp+'.json',name+'.json')
+
+
+class Store(object):
+    """
+    Quotes of many symbols in the directory *path*, one file per
+    column with the rows of all the symbols, grouped by symbol and
+    sorted by date. The columns are mapped in memory when the store is
+    opened, so only the pages of the dates that are read are loaded.
+    The dates are day numbers, the prices single precision and the
+    volume an integer, 32 bytes per session instead of 56.
+
+    The index has the density and the first row and the number of rows
+    of each symbol. Create a store with :meth:`write` or
+    :meth:`from_cache`.
+
+    Example.
+    Store.write('/data/store',((S.symbol,S.data) for S in stocks.values()))
+    store = Store('/data/store')
+    IBM_stock = yahoostock('IBM',sdate=datetime.date(2011,1,30),store=store)
+    IBM_stock.read()
+    """
+    dtypes = ['int32','float32','float32','float32','float32','int64',
+              'float32']
+
+    def __init__(self,path):
+        self.path = path
+        indexfile = open(os.path.join(path,'index.json'))
+        index = json.load(indexfile)
+        indexfile.close()
+        self.density = index['density']
+        self.symbols = index['symbols']
+        self.index = dict((symbol,(offset,count)) for symbol,offset,count
+                          in zip(index['symbols'],index['offsets'],
+                                 index['counts']))
+        self.nrows = sum(index['counts'])
+        self.columns = []
+        for name,dtype in zip(columns,self.dtypes):
+            if self.nrows == 0:
+                # An empty file can not be mapped
+                self.columns.append(numpy.zeros(0,dtype=dtype))
+            else:
+                self.columns.append(numpy.memmap(
+                        os.path.join(path,name+'.bin'),dtype=dtype,
+                        mode='r',shape=(self.nrows,)))
+
+    def __contains__(self,symbol):
+        return symbol in self.index
+
+    def __len__(self):
+        return len(self.symbols)
+
+    @staticmethod
+    def write(path,items,density='d'):
+        """
+        Writes a store in the directory *path* with the *items*, pairs
+        of a symbol and its data with the layout of yahoostock.data,
+        for the *density* of the data. Only the data of one symbol is
+        in memory at the same time, *items* may be a generator.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        files = [open(os.path.join(path,name+'.bin'),'wb')
+                 for name in columns]
+        symbols,offsets,counts = [],[],[]
+        offset = 0
+        try:
+            for symbol,data in items:
+                if data is None or len(data) == 0:
+                    continue
+                data = data[numpy.argsort(data[:,0],kind='mergesort')]
+                for output,dtype,column in zip(files,Store.dtypes,data.T):
+                    column.astype(dtype).tofile(output)
+                symbols.append(symbol)
+                offsets.append(offset)
+                counts.append(len(data))
+                offset += len(data)
+        finally:
+            for output in files:
+                output.close()
+
+        # The index is written last, the store is complete with it
+        indexfile = open(os.path.join(path,'index.json'),'w')
+        json.dump({'columns': columns, 'dtypes': Store.dtypes,
+                   'density': density, 'symbols': symbols,
+                   'offsets': offsets, 'counts': counts},indexfile)
+        indexfile.close()
+        return Store(path)
+
+    @staticmethod
+    def from_cache(path,cache,density='d'):
+        """
+        Writes a store in *path* with all the symbols of *density* in
+        *cache*, a Cache or its directory.
+        """
+        if not isinstance(cache,Cache):
+            cache = Cache(cache)
+        suffix = '_{}.json'.format(density)
+        symbols = sorted(name[:-len(suffix)] for name in os.listdir(cache.path)
+                         if name.endswith(suffix))
+        return Store.write(path,((symbol,cache.get(symbol,density)[0])
+                                 for symbol in symbols),density)
+
+    def rows(self,symbol,start=None,end=None):
+        """
+        Slice of the rows of *symbol* from the day number *start* to
+        *end*, both included, the whole series if they are None.
+        """
+        offset,count = self.index[symbol]
+        dates = self.columns[0][offset:offset+count]
+        first,last = 0,count
+        if start is not None:
+            first = numpy.searchsorted(dates,start,'left')
+        if end is not None:
+            last = numpy.searchsorted(dates,end,'right')
+        return slice(offset+first,offset+max(first,last))
+
+    def window(self,symbol,start=None,end=None):
+        """
+        Columns of *symbol* from the date *start* to *end*, the most
+        recent first. They are views of the files, nothing is copied.
+        """
+        rows = self.rows(symbol,
+                         None if start is None else start.toordinal(),
+                         None if end is None else end.toordinal())
+        return tuple(column[rows][::-1] for column in self.columns)
+
+    def at(self,date,column='close'):
+        """
+        Value of *column* of all the symbols at the session of *date*,
+        NaN for the symbols without that session.
+        """
+        day = date.toordinal()
+        values = numpy.empty(len(self.symbols))
+        values[:] = numpy.nan
+        data = self.columns[columns.index(column)]
+        for i,symbol in enumerate(self.symbols):
+            rows = self.rows(symbol,day,day)
+            if rows.stop > rows.start:
+                values[i] = data[rows.start]
+        return values
 
 class yahoostock(object):
     """
@@ -13,15 +302,30 @@ class yahoostock(object):
     edate -- Final time for the data as datetime.date or datetime.datetime
     weekly -- If it is True gives weekly data
     monthly -- If it is True gives monthly data
+    cache -- Directory of the local copy of the data, or a Cache
+    store -- Store or its directory, the data are views of its columns
+    baseurl -- Address of table.csv, to use another server
     
     Example.
     IBM_stock = yahoostock('IBM',sdate=datetime.date(2011,1,30),weekly=True)
     """
+    baseurl = 'http://ichart.yahoo.com/table.csv'
+
     def __init__(self,symbol,**kwargs):
         self.symbol = symbol
         self.weekly = False
         self.monthly = False
         self.density = 'd'
+        self.start = kwargs.get('sdate')
+        self.end = kwargs.get('edate')
+        cache = kwargs.get('cache')
+        if cache is not None and not isinstance(cache,Cache):
+            cache = Cache(cache)
+        self.cache = cache
+        if kwargs.has_key('baseurl'):
+            self.baseurl = kwargs['baseurl']
+        self.table = None
+
         if kwargs.has_key('sdate'):
             self.sdate = True
             self.sd = kwargs['sdate'].day
@@ -42,72 +346,488 @@ class yahoostock(object):
             self.density = 'w'
             
         if kwargs.has_key('monthly') and kwargs['monthly'] == True:
-            self.monthly = 'm'
-        
-    def read(self):
-        """Reads the data from Yahoo finance"""
-        baseurl = 'http://ichart.yahoo.com/table.csv'
-        url = baseurl+'?s='+self.symbol
-        if self.sdate:
-            url += '&a=%.2i'%(self.sm-1)
-            url += '&b=%i'%(self.sd)
-            url += '&c=%i'%(self.sy)
-            
-        if self.edate:
-            url += '&d=%.2i'%(self.em-1)
-            url += '&e=%i'%(self.ed)
-            url += '&f=%i'%(self.ey)
-            
+            self.monthly = True
+            self.density = 'm'
+
+        store = kwargs.get('store')
+        if store is not None and not isinstance(store,Store):
+            store = Store(store)
+        if store is not None and store.density != self.density:
+            raise ValueError('The store has density {}'.format(store.density))
+        self.store = store
+
+    def url(self,start=None,end=None):
+        """Address of the data from the date *start* to *end*"""
+        url = self.baseurl+'?s='+self.symbol
+        if start is not None:
+            url += '&a=%.2i'%(start.month-1)
+            url += '&b=%i'%(start.day)
+            url += '&c=%i'%(start.year)
+
+        if end is not None:
+            url += '&d=%.2i'%(end.month-1)
+            url += '&e=%i'%(end.day)
+            url += '&f=%i'%(end.year)
+
         url += '&g=%s'%(self.density)
+        return url
+
+    def fetch(self,start=None,end=None,client=None):
+        """
+        Data from the date *start* to *end* from the server, the most
+        recent first. Opens a new connection if *client* is None.
+        """
+        if client is None:
+            text = urllib.urlopen(self.url(start,end)).read()
+        else:
+            text = client.get(self.url(start,end))
+        return parse(text).T
 
-        #Check the converters argument out!
-        #Thanks duck typing!
+    def read(self,client=None,verbose=True):
+        """
+        Reads the data from Yahoo finance. If there is a cache only
+        the dates that are not in it are requested. *client* is the
+        Client for the requests. If there is a store the data are
+        taken from it.
+        """
         try:
-            self.data = numpy.loadtxt(urllib.urlopen(url),
-                                      delimiter=',',
-                                      skiprows=1,
-                                      converters = {0: pylab.datestr2num})
-            print "Read %i days."%self.data.shape[0]
+            if self.store is not None:
+                if self.symbol not in self.store:
+                    raise IOError('{} is not in the store'.format(self.symbol))
+                self.table = self.store.window(self.symbol,self.start,
+                                               self.end)
+            elif self.cache is None:
+                self.data = self.fetch(self.start,self.end,client)
+            else:
+                self.data = self._read_cached(client)
+            if verbose:
+                print "Read %i days."%len(self.table[0])
         except IOError:
             print "No data retrieved. Probably no internet connection"
             self.data = None
-                                  
-        
-    
+
+    def _read_cached(self,client):
+        cached,first,last = self.cache.get(self.symbol,self.density)
+        start = self.start
+        end = self.end or datetime.date.today()
+        snum = None if start is None else pylab.date2num(start)
+        enum = pylab.date2num(end)
+
+        if cached is None:
+            cached = self.fetch(start,end,client)[::-1]
+            first,last = snum,enum
+        else:
+            parts = []
+            if first is not None and (snum is None or snum < first):
+                before = datetime.date.fromordinal(int(first)-1)
+                parts.append(self.fetch(start,before,client))
+                first = snum
+            if enum > last:
+                # The last session may have been incomplete
+                after = datetime.date.fromordinal(int(last))
+                parts.append(self.fetch(after,end,client))
+                last = enum
+            if not parts:
+                return self._select(cached,snum,enum)
+
+            # The new rows replace the ones of the same date
+            merged = numpy.concatenate(parts+[cached])
+            dates,index = numpy.unique(merged[:,0],return_index=True)
+            cached = merged[index]
+
+        self.cache.put(self.symbol,self.density,cached,first,last)
+        return self._select(cached,snum,enum)
+
+    def _select(self,cached,snum,enum):
+        """Rows of the dates requested, the most recent first"""
+        keep = cached[:,0] <= enum
+        if snum is not None:
+            keep &= cached[:,0] >= snum
+        return cached[keep][::-1]
+
+    @property
+    def data(self):
+        """
+        Table with a row per session and a column per quote, a view
+        of *table*, that has a row per column. None if there is no
+        data. The data of a store are copied in double precision.
+        """
+        if self.table is None:
+            return None
+        if isinstance(self.table,tuple):
+            return numpy.array(self.table,dtype='float64').T
+        return self.table.T
+
+    @data.setter
+    def data(self,data):
+        if data is None:
+            self.table = None
+        else:
+            # No copy if data is already a view of a table
+            self.table = numpy.ascontiguousarray(numpy.transpose(data))
+
     @property
     def date(self):
         """Date returned as a float"""
-        return self.data[:,0]          
+        return self.table[0]          
         
     @property
     def open(self):
         """Value at the beginning of the session"""
-        return self.data[:,1]
+        return self.table[1]
         
     @property
     def high(self):
         """Highest value during the session"""
-        return self.data[:,2]
+        return self.table[2]
         
     @property
     def low(self):
         """Lowest value during the session"""
-        return self.data[:,3]
+        return self.table[3]
         
     @property
     def clse(self):
         """Value at the end of the session"""
-        return self.data[:,4]
+        return self.table[4]
        
     @property
     def volume(self):
         """Volume traded during the sessino"""
-        return self.data[:,5]
+        return self.table[5]
         
     @property
     def adj_close(self):
         """I Don't really know what this is"""
-        return self.data[:,6]
+        return self.table[6]
+
+
+def read_many(symbols,workers=8,**kwargs):
+    """
+    Reads the data of all the *symbols* with a pool of *workers*
+    threads. Keyword arguments are passed to yahoostock. Returns a
+    dictionary of yahoostock by symbol, the data is None for the
+    symbols that could not be read.
+    """
+    if kwargs.get('cache') is not None and \
+            not isinstance(kwargs['cache'],Cache):
+        kwargs['cache'] = Cache(kwargs['cache'])
+    stocks = dict((symbol,yahoostock(symbol,**kwargs)) for symbol in symbols)
+    client = Client()
+    pool = ThreadPool(workers)
+    try:
+        pool.map(lambda stock: stock.read(client,verbose=False),
+                 stocks.values())
+    finally:
+        pool.close()
+        pool.join()
+    return stocks
+
+
+def synthetic(symbol,density,start,end):
+    """
+    Synthetic quotes of *symbol* from *start* to *end*, with the
+    layout of yahoostock.data. They are always the same for a symbol
+    and a date. There is a quote for every weekday, the mondays for
+    weekly data and the first day of the month for monthly data.
+    """
+    day = numpy.arange(start.toordinal(),end.toordinal()+1)
+    if density == 'w':
+        day = day[day%7 == 1]
+    elif density == 'm':
+        day = numpy.array([d for d in day
+                           if datetime.date.fromordinal(d).day == 1],
+                          dtype='int')
+    else:
+        day = day[(day-1)%7 < 5]
+    # Most recent first
+    day = day[::-1]
+
+    seed = zlib.crc32(symbol)%1000
+    close = 50+seed/20.+10*numpy.sin(day/20.+seed)
+    opn = close+numpy.sin(day/3.+seed)
+    data = numpy.empty((len(day),len(columns)))
+    data[:,0] = day
+    data[:,1] = opn
+    data[:,2] = numpy.maximum(opn,close)+1
+    data[:,3] = numpy.minimum(opn,close)-1
+    data[:,4] = close
+    data[:,5] = numpy.floor(1e6*(2+numpy.sin(day/7.+seed)))
+    data[:,6] = 0.9*close
+    # Prices with two decimals, like table.csv
+    data[:,1:5] = numpy.round(data[:,1:5],2)
+    data[:,6] = numpy.round(data[:,6],2)
+    return data
+
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serves the quotes of :func:`synthetic` in the format of table.csv
+    """
+    protocol_version = 'HTTP/1.1'
+    first = datetime.date(1990,1,1)
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        self.server.requests.append(query)
+        time.sleep(self.server.delay)
+
+        def date(year,month,day,default):
+            if year not in query:
+                return default
+            return datetime.date(int(query[year][0]),int(query[month][0])+1,
+                                 int(query[day][0]))
+        body = self.table(query['s'][0],query.get('g',['d'])[0],
+                          date('c','a','b',self.first),
+                          date('f','d','e',datetime.date.today()))
+
+        self.send_response(200)
+        self.send_header('Content-Type','text/csv')
+        self.send_header('Content-Length',str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    @staticmethod
+    def table(symbol,density,start,end):
+        """Table of *symbol* from *start* to *end*"""
+        lines = ['Date,Open,High,Low,Close,Volume,Adj Close']
+        for row in synthetic(symbol,density,start,end):
+            lines.append('%s,%.2f,%.2f,%.2f,%.2f,%i,%.2f'%(
+                    (datetime.date.fromordinal(int(row[0])).isoformat(),)+
+                    tuple(row[1:])))
+        return '\n'.join(lines)+'\n'
+
+    def log_message(self,format,*args):
+        pass
+
+
+class StandInServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+    """
+    Local server that stands in for Yahoo Finance in the tests, at
+    the address *baseurl*. Each response takes at least *delay*
+    seconds, and the queries are kept in *requests*.
+
+    Example.
+    server = StandInServer()
+    stock = yahoostock('IBM',baseurl=server.baseurl)
+    """
+    daemon_threads = True
+
+    def __init__(self,port=0,delay=0.0):
+        BaseHTTPServer.HTTPServer.__init__(self,('127.0.0.1',port),
+                                           StandInHandler)
+        self.delay = delay
+        self.requests = []
+        self.baseurl = 'http://127.0.0.1:{}/table.csv'.format(
+            self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def test_cache(nsymbols=100,workers=16,delay=0.1):
+    """
+    Checks the cache and the concurrent reads against the stand-in
+    server, with responses that take *delay* seconds. Prints the
+    time to read *nsymbols* symbols with one thread and with
+    *workers* threads.
+    """
+    server = StandInServer(delay=delay)
+    path = tempfile.mkdtemp()
+    try:
+        def stock(sdate,edate):
+            return yahoostock('IBM',sdate=sdate,edate=edate,cache=path,
+                              baseurl=server.baseurl)
+
+        # First read, a single request
+        S = stock(datetime.date(2010,1,1),datetime.date(2010,12,31))
+        S.read()
+        assert len(server.requests) == 1
+        assert S.data.shape == (261,7)
+        # The same dates, from the cache
+        S.read()
+        assert len(server.requests) == 1
+        # Later dates, from the last one requested
+        S = stock(datetime.date(2010,1,1),datetime.date(2011,6,30))
+        S.read()
+        assert len(server.requests) == 2
+        assert server.requests[1]['c'] == ['2010']
+        # Earlier dates, up to the first one requested
+        S = stock(datetime.date(2009,1,1),datetime.date(2011,6,30))
+        S.read()
+        assert len(server.requests) == 3
+        assert server.requests[2]['f'] == ['2009']
+        # Dates inside the ones requested
+        S = stock(datetime.date(2009,6,1),datetime.date(2010,6,1))
+        S.read()
+        assert len(server.requests) == 3
+
+        # The same data as a read without cache
+        for sdate,edate in ((datetime.date(2009,1,1),datetime.date(2011,6,30)),
+                            (datetime.date(2009,6,1),datetime.date(2010,6,1))):
+            S = stock(sdate,edate)
+            S.read()
+            F = yahoostock('IBM',sdate=sdate,edate=edate,
+                           baseurl=server.baseurl)
+            F.read()
+            assert numpy.all(S.data == F.data)
+
+        # Many symbols
+        symbols = ['S{:04d}'.format(i) for i in range(nsymbols)]
+        kwargs = dict(sdate=datetime.date(2009,1,1),
+                      edate=datetime.date(2009,12,31),baseurl=server.baseurl)
+        times = {}
+        for nworkers in (1,workers):
+            tstamp = time.time()
+            stocks = read_many(symbols,nworkers,**kwargs)
+            times[nworkers] = time.time()-tstamp
+            print nworkers,'workers:',times[nworkers],'seconds'
+        print 'Speedup:',times[1]/times[workers]
+        for symbol in symbols:
+            F = yahoostock(symbol,**kwargs)
+            F.read(verbose=False)
+            assert numpy.all(stocks[symbol].data == F.data)
+
+        # Only the first read of each symbol gets to the server
+        del server.requests[:]
+        read_many(symbols,workers,cache=path,**kwargs)
+        stocks = read_many(symbols,workers,cache=path,**kwargs)
+        assert len(server.requests) == nsymbols
+        assert numpy.all(stocks[symbols[0]].data ==
+                         yahoostock(symbols[0],**kwargs).fetch(
+                kwargs['sdate'],kwargs['edate']))
+    finally:
+        server.close()
+        shutil.rmtree(path)
+
+
+def _query_store(path,symbol,start,end):
+    """Memory of a new process that reads a window of the store"""
+    before = maxrss()
+    S = yahoostock(symbol,sdate=start,edate=end,store=path)
+    S.read(verbose=False)
+    total = float(S.clse.sum())
+    return maxrss()-before,total
+
+
+def _load_all(path):
+    """Memory of a new process with all the symbols as yahoostock"""
+    before = maxrss()
+    store = Store(path)
+    stocks = []
+    for symbol in store.symbols:
+        S = yahoostock(symbol,store=store)
+        S.read(verbose=False)
+        # A copy in double precision, like the data read from Yahoo
+        S.data = S.data
+        stocks.append(S)
+    return maxrss()-before,len(stocks)
+
+
+def test_store(nsymbols=1000,years=20):
+    """
+    Checks the Store with *nsymbols* symbols of synthetic daily
+    quotes of *years* years. Prints the size of the store and the
+    memory of a new process that reads a window of a symbol, and of
+    one that has every symbol in memory as yahoostock.
+    """
+    from multiprocessing import Pool
+    end = datetime.date(2015,12,31)
+    start = datetime.date(end.year-years,1,1)
+    symbols = ['S{:05d}'.format(i) for i in range(nsymbols)]
+    path = tempfile.mkdtemp()
+    try:
+        tstamp = time.time()
+        store = Store.write(path,((symbol,synthetic(symbol,'d',start,end))
+                                  for symbol in symbols))
+        print 'Written',store.nrows,'rows in',time.time()-tstamp,'seconds'
+        assert len(store) == nsymbols and symbols[-1] in store
+
+        # Windows, the same data in single precision
+        for symbol,sdate,edate in ((symbols[0],None,None),
+                                   (symbols[-1],datetime.date(2010,3,6),
+                                    datetime.date(2011,2,1)),
+                                   (symbols[1],datetime.date(1900,1,1),
+                                    datetime.date(1900,2,1))):
+            expected = synthetic(symbol,'d',max(sdate or start,start),
+                                 min(edate or end,end))
+            S = yahoostock(symbol,store=path)
+            S.start,S.end = sdate,edate
+            S.read(verbose=False)
+            assert S.date.dtype == numpy.int32
+            assert S.volume.dtype == numpy.int64
+            assert S.clse.dtype == numpy.float32
+            assert not S.clse.flags.owndata
+            for column,dtype,values in zip(S.table,Store.dtypes,expected.T):
+                assert numpy.all(column == values.astype(dtype))
+
+        # Cross section
+        day = datetime.date(2012,5,4)
+        close = store.at(day)
+        assert numpy.all(close == [synthetic(symbol,'d',day,day)[0,4]
+                                   .astype('float32') for symbol in symbols])
+        assert numpy.isnan(store.at(datetime.date(2012,5,5))).all()
+
+        # From a cache
+        cache = Cache(os.path.join(path,'cache'))
+        for symbol in symbols[:3]:
+            cache.put(symbol,'d',synthetic(symbol,'d',start,end)[::-1],
+                      None,None)
+        small = Store.from_cache(os.path.join(path,'small'),cache)
+        assert small.symbols == symbols[:3]
+        assert numpy.all(small.window(symbols[2])[4] ==
+                         store.window(symbols[2])[4])
+
+        size = sum(os.path.getsize(os.path.join(path,name+'.bin'))
+                   for name in columns)
+        print 'Store:',size/2.**20,'MB,',size/store.nrows,'bytes per row'
+        print 'yahoostock:',store.nrows*56/2.**20,'MB'
+
+        # Each measure in a new process, with the store not loaded yet
+        pool = Pool(1,maxtasksperchild=1)
+        try:
+            rss,total = pool.apply(_query_store,(path,symbols[nsymbols//2],
+                                                 datetime.date(2014,1,1),
+                                                 datetime.date(2014,12,31)))
+            print 'New process, one year of a symbol:',rss,'MB'
+            rss,count = pool.apply(_load_all,(path,))
+            print 'New process, all symbols as yahoostock:',rss,'MB'
+        finally:
+            pool.terminate()
+    finally:
+        shutil.rmtree(path)
+
+
+def bench_parse(nrows=100000):
+    """
+    Times :func:`parse` and numpy.loadtxt with pylab.datestr2num, the
+    parser that read used before, on a synthetic table.csv of
+    *nrows* sessions. Returns both times.
+    """
+    end = datetime.date(2015,12,31)
+    start = end-datetime.timedelta(nrows*7//5-1)
+    text = StandInHandler.table('IBM','d',start,end)
+
+    tstamp = time.time()
+    old = numpy.loadtxt(StringIO.StringIO(text),
+                        delimiter=',',
+                        skiprows=1,
+                        converters = {0: pylab.datestr2num})
+    loadtxt = time.time()-tstamp
+
+    tstamp = time.time()
+    new = parse(text)
+    vectorized = time.time()-tstamp
+
+    assert numpy.all(old == new.T)
+    print len(text)/2.**20,'MB,',new.shape[1],'rows'
+    print 'loadtxt:',loadtxt,'seconds, parse:',vectorized,'seconds'
+    print 'Speedup:',loadtxt/vectorized
+    return loadtxt,vectorized
 
 
 if __name__ == '__main__':
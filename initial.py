@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Initial conditions for the 2D turbulence solver.
+
+All the generators take the solver *V* and the size of the box, and
+return the vorticity in physical space, ready for
+:meth:`Vorticity2D.set_initial`. The ones made of gaussian vortices
+can also return the spectrum directly with *spectral*, then use
+V.set_initial(omega_hat,spectral=True).
+
+A gaussian vortex is the product of a gaussian in x and a gaussian in
+y, and it is negligible beyond a few radii. Each vortex is added only
+on the window of points where it is larger than *tol* times its
+intensity, as the outer product of two short vectors. In spectral
+space the transform of a gaussian is known, and the sum of the phases
+of all the vortices is a single matrix product.
+
+The physical grid is numpy.linspace(-Lx/2,Lx/2,V.nx), the one the
+solver has always been initialized with, unless *periodic* is given.
+The periodic grid drops the last point, x = -Lx/2+i*Lx/nx, and it is
+the one that corresponds to the spectral generators.
+
+Example.
+V = Vorticity2D(32.0,32.0,10000,0.2)
+V.set_initial(lattice(V,32.0,32.0,32,32,spectral=True),spectral=True)
+"""
+
+from __future__ import division
+import numpy
+from fftbackend import NumpyFFT
+from diagnostics import modes
+
+
+def grid(V,Lx,Ly,periodic=False):
+    """
+    Coordinates of the grid of the solver *V* in x and y
+    """
+    if periodic:
+        return (-Lx/2+Lx/V.nx*numpy.arange(V.nx),
+                -Ly/2+Ly/V.ny*numpy.arange(V.ny))
+    return (numpy.linspace(-Lx/2,Lx/2,V.nx),
+            numpy.linspace(-Ly/2,Ly/2,V.ny))
+
+
+def _window(x,xc,r,L,periodic):
+    """
+    Indices of the points of *x* closer than *r* to *xc* and their
+    distance to it.
+    """
+    n = len(x)
+    dx = x[1]-x[0]
+    i0 = int(numpy.floor((xc-r-x[0])/dx))
+    i1 = int(numpy.ceil((xc+r-x[0])/dx))+1
+    if not periodic:
+        i = numpy.arange(max(i0,0),min(i1,n))
+        return i,x[i]-xc
+    if i1-i0 >= n:
+        return numpy.arange(n),numpy.mod(x-xc+L/2,L)-L/2
+    i = numpy.arange(i0,i1)
+    return numpy.mod(i,n),x[0]+i*dx-xc
+
+
+def gaussian_vortices(V,Lx,Ly,xc,yc,gamma,a,periodic=False,tol=1e-15):
+    """
+    Sum of the gaussian vortices gamma*exp(-a*r**2) centered at
+    (*xc*, *yc*). *gamma* may be a scalar or one value per vortex.
+    With *periodic* the vortices wrap around the box.
+    """
+    x,y = grid(V,Lx,Ly,periodic)
+    xc,yc,gamma = numpy.broadcast_arrays(numpy.ravel(xc),numpy.ravel(yc),
+                                         numpy.ravel(gamma))
+    r = numpy.sqrt(-numpy.log(tol)/a)
+
+    omega = numpy.zeros((V.ny,V.nx))
+    for xv,yv,g in zip(xc,yc,gamma):
+        ix,dx = _window(x,xv,r,Lx,periodic)
+        iy,dy = _window(y,yv,r,Ly,periodic)
+        if len(ix) and len(iy):
+            omega[numpy.ix_(iy,ix)] += numpy.outer(g*numpy.exp(-a*dy**2),
+                                                   numpy.exp(-a*dx**2))
+
+    return omega
+
+
+def gaussian_vortices_hat(V,Lx,Ly,xc,yc,gamma,a,tol=1e-15):
+    """
+    Spectrum of the periodic sum of gaussian vortices, same arguments
+    as :func:`gaussian_vortices`. It has the layout of V.omega_hat.
+    """
+    xc,yc,gamma = numpy.broadcast_arrays(numpy.ravel(xc),numpy.ravel(yc),
+                                         numpy.ravel(gamma))
+    # Only the modes where the gaussian is larger than tol
+    gx = numpy.exp(-V.kx[0,:]**2/(4*a))
+    gy = numpy.exp(-V.ky[:,0]**2/(4*a))
+    cols = numpy.flatnonzero(gx > tol)
+    rows = numpy.flatnonzero(gy > tol)
+
+    # Phases relative to the first point of the periodic grid
+    ex = numpy.exp(-1j*numpy.outer(xc+Lx/2,V.kx[0,cols]))
+    ey = numpy.exp(-1j*numpy.outer(yc+Ly/2,V.ky[rows,0]))
+    block = numpy.dot((gamma[:,numpy.newaxis]*ey).T,ex)
+    block *= numpy.pi/a*V.nx*V.ny/(Lx*Ly)*numpy.outer(gy[rows],gx[cols])
+
+    omega_hat = numpy.zeros(V.kx.shape,dtype='complex')
+    omega_hat[numpy.ix_(rows,cols)] = block
+    return omega_hat
+
+
+def _vortices(V,Lx,Ly,xc,yc,gamma,a,periodic,spectral):
+    if spectral:
+        return gaussian_vortices_hat(V,Lx,Ly,xc,yc,gamma,a)
+    return gaussian_vortices(V,Lx,Ly,xc,yc,gamma,a,periodic)
+
+
+def lattice(V,Lx,Ly,nvx,nvy,gamma=2,a=30,missing=(),
+            periodic=False,spectral=False):
+    """
+    Lattice of *nvx* times *nvy* gaussian vortices of alternating
+    sign. The lattice positions (i,j) in *missing* are left empty.
+    """
+    i,j = numpy.meshgrid(numpy.arange(nvx),numpy.arange(nvy),indexing='ij')
+    keep = numpy.ones(i.shape,dtype='bool')
+    for im,jm in missing:
+        keep[im,jm] = False
+    i = i[keep]
+    j = j[keep]
+
+    xc = Lx/2-(i+1/2)*Lx/nvx
+    yc = Ly/2-(j+1/2)*Ly/nvy
+    return _vortices(V,Lx,Ly,xc,yc,gamma*(-1)**(i+j),a,periodic,spectral)
+
+
+def random_vortices(V,Lx,Ly,n=None,gamma=2,a=30,seed=None,spectral=False):
+    """
+    *n* gaussian vortices at random positions, half of each sign. By
+    default there is one vortex per unit of area. The box is
+    periodic.
+    """
+    if n is None:
+        n = int(Lx*Ly)
+    rng = numpy.random.RandomState(seed)
+    xc = rng.uniform(-Lx/2,Lx/2,n)
+    yc = rng.uniform(-Ly/2,Ly/2,n)
+    sign = rng.permutation(numpy.resize([1,-1],n))
+    return _vortices(V,Lx,Ly,xc,yc,gamma*sign,a,True,spectral)
+
+
+def shear_layers(V,Lx,Ly,eps=0.1,a=300):
+    """
+    Two shear layers simetrically perturbed with amplitude *eps*.
+    Like a planar infinite jet.
+    """
+    x,y = grid(V,Lx,Ly)
+    perturbation = 1+eps*numpy.cos(numpy.pi*x)
+    return (numpy.outer(numpy.exp(-a*(y+Ly/4.)**2),perturbation)-
+            numpy.outer(numpy.exp(-a*(y-Ly/4.)**2),perturbation))
+
+
+def random_spectrum(V,Lx,Ly,spectrum,seed=None,spectral=False):
+    """
+    Vorticity with random phases and the energy spectrum E(k) given by
+    the function *spectrum*. The energy of each shell of the dealiased
+    field, as defined in :class:`diagnostics.Diagnostics`, is
+    spectrum(k)*dk.
+
+    Example.
+    omega = random_spectrum(V,Lx,Ly,lambda k: k**4*numpy.exp(-(k/10)**2))
+    """
+    rng = numpy.random.RandomState(seed)
+    transform = NumpyFFT((V.ny,V.nx),V.rfft)
+    # White noise, so the spectrum has the symmetry of a real field
+    omega_hat = V.dealias*transform.forward(rng.standard_normal((V.ny,V.nx)))
+
+    herm,k2,dk,shell = modes(V)
+    energy = 0.5*herm*numpy.abs(omega_hat.ravel())**2/k2/(V.nx*V.ny)**2
+    energy[0] = 0
+    nshells = shell.max()+1
+    current = numpy.bincount(shell,energy,nshells)
+    target = numpy.zeros(nshells)
+    target[1:] = spectrum(dk*numpy.arange(1,nshells))*dk
+
+    scale = numpy.zeros(nshells)
+    nonzero = current > 0
+    scale[nonzero] = numpy.sqrt(target[nonzero]/current[nonzero])
+    scale[0] = 0
+    omega_hat *= scale[shell].reshape(omega_hat.shape)
+
+    if spectral:
+        return omega_hat
+    return transform.backward(omega_hat)
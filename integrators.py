@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Exponential time integrators for the 2D turbulence solver.
+
+The viscous term Lap/Re*omega is linear and diagonal in Fourier
+space, so it can be integrated exactly. Only the nonlinear term is
+approximated, with four evaluations per step like the low storage
+Runge Kutta of Vorticity2D, and the timestep is only limited by the
+CFL condition.
+
+  *IFRK4*
+    Classical fourth order Runge Kutta for exp(-L*t)*omega, the
+    integrating factor method.
+
+  *ETDRK4*
+    Exponential time differencing of Cox and Matthews, with the
+    coefficients evaluated with the contour integrals of Kassam and
+    Trefethen.
+
+The coefficients depend on dt. They are computed when the first step
+is taken, for the timestep given by the CFL condition divided by
+1+*refresh*, so the small decreases of the timestep of a flow that
+accelerates use the same tables. They are only recomputed when the
+CFL timestep is smaller than the one of the tables, or larger by
+more than a factor (1+*refresh*)**2. In between the steps are
+slightly shorter than the CFL allows.
+
+Use :func:`get_integrator` or the *integrator* argument of the solvers.
+
+Example.
+V = Vorticity2D(2.0,2.0,10000,0.2,integrator='etdrk4')
+"""
+
+from __future__ import division
+import numpy
+
+
+class IFRK4(object):
+    """
+    Integrating factor fourth order Runge Kutta for the solver *V*.
+    """
+    name = 'ifrk4'
+
+    def __init__(self,V,refresh=0.1):
+        self.refresh = refresh
+        # The tables are computed in double precision
+        self.L = V.Lap.astype('float64')/V.Re
+        self.dtype = V.real_dtype
+        self.dt = None
+        # Number of times the tables have been computed
+        self.rebuilds = 0
+        # The viscous term does not limit the timestep
+        V.dtv = numpy.inf
+
+    def tables(self,dt):
+        """Coefficients for the timestep *dt*"""
+        E = numpy.exp(self.L*(dt/2))
+        self.E = E.astype(self.dtype)
+        self.E2 = (E*E).astype(self.dtype)
+
+    def timestep(self,dt):
+        """
+        Timestep of the tables if it is close enough to the timestep
+        *dt* given by the CFL condition, otherwise new tables for
+        dt/(1+refresh).
+        """
+        if (self.dt is None or numpy.any(dt < self.dt) or
+            numpy.any(dt > (1+self.refresh)**2*self.dt)):
+            self.dt = dt/(1+self.refresh)
+            self.tables(self.dt)
+            self.rebuilds += 1
+        return self.dt
+
+    def restart(self,dt):
+        """Tables for the timestep *dt* of a restored checkpoint"""
+        self.dt = dt
+        self.tables(dt)
+
+    def buffers(self,V,names):
+        """Spectral arrays used by the step, allocated once"""
+        if not hasattr(self,names[0]):
+            for name in names:
+                setattr(self,name,numpy.zeros_like(V.omega_hat))
+
+    def first(self,V):
+        """
+        Nonlinear term of the vorticity at the beginning of the step,
+        on V.S1. Chooses the timestep and samples the diagnostics.
+        """
+        V.S1[...] = V.omega_hat
+        S1,u,v = V.nonlinear()
+        V.dt = self.timestep(V.sample(u,v))
+        V.advect(0,u,v)
+        return S1
+
+    def last(self,V):
+        """Bookkeeping at the end of the step"""
+        V.t += V.dt
+        V.nstep += 1
+        V.invalidate()
+
+    def step(self,V):
+        """
+        Advances the solver *V* a timestep. The nonlinear terms are
+        always on V.S1, and the next stage is written on it.
+        """
+        self.buffers(V,('acc','eo','tmp'))
+        acc,eo,tmp = self.acc,self.eo,self.tmp
+
+        # a, acc = E2*a+2*E*b+2*E*c+d
+        a = self.first(V)
+        dt = V.dt
+        E = self.E
+        numpy.multiply(self.E2,a,out=acc)
+        numpy.multiply(a,dt/2,out=a)
+        numpy.add(V.omega_hat,a,out=a)
+        numpy.multiply(E,a,out=V.S1)
+
+        # b at E*(u+dt/2*a)
+        b,u,v = V.nonlinear()
+        V.advect(1,u,v)
+        numpy.multiply(E,b,out=tmp)
+        numpy.add(acc,tmp,out=acc)
+        numpy.add(acc,tmp,out=acc)
+        numpy.multiply(E,V.omega_hat,out=eo)
+        numpy.multiply(b,dt/2,out=b)
+        numpy.add(eo,b,out=V.S1)
+
+        # c at E*u+dt/2*b
+        c,u,v = V.nonlinear()
+        V.advect(2,u,v)
+        numpy.multiply(E,c,out=tmp)
+        numpy.add(acc,tmp,out=acc)
+        numpy.add(acc,tmp,out=acc)
+        numpy.multiply(tmp,dt,out=tmp)
+        numpy.multiply(E,eo,out=V.S1)
+        numpy.add(V.S1,tmp,out=V.S1)
+
+        # d at E2*u+dt*E*c
+        d,u,v = V.nonlinear()
+        V.advect(3,u,v)
+        numpy.add(acc,d,out=acc)
+        numpy.multiply(acc,dt/6,out=acc)
+        numpy.multiply(self.E2,V.omega_hat,out=V.omega_hat)
+        numpy.add(V.omega_hat,acc,out=V.omega_hat)
+        self.last(V)
+
+
+class ETDRK4(IFRK4):
+    """
+    Fourth order exponential time differencing Runge Kutta for the
+    solver *V*. *points* is the number of points of the contour
+    integrals.
+    """
+    name = 'etdrk4'
+
+    def __init__(self,V,refresh=0.1,points=32):
+        IFRK4.__init__(self,V,refresh)
+        self.points = points
+
+    def tables(self,dt):
+        """Coefficients for the timestep *dt*"""
+        Ldt = self.L*dt
+        self.E = numpy.exp(Ldt).astype(self.dtype)
+        self.E2 = numpy.exp(Ldt/2).astype(self.dtype)
+
+        # L is real, the mean over the upper half of the circle is
+        # enough.
+        Q = numpy.zeros(Ldt.shape)
+        f1 = numpy.zeros(Ldt.shape)
+        f2 = numpy.zeros(Ldt.shape)
+        f3 = numpy.zeros(Ldt.shape)
+        for j in range(self.points):
+            z = Ldt+numpy.exp(1j*numpy.pi*(j+0.5)/self.points)
+            ez = numpy.exp(z)
+            Q += ((numpy.exp(z/2)-1)/z).real
+            f1 += ((-4-z+ez*(4-3*z+z**2))/z**3).real
+            f2 += ((2+z+ez*(z-2))/z**3).real
+            f3 += ((-4-3*z-z**2+ez*(4-z))/z**3).real
+
+        self.Q = (dt*Q/self.points).astype(self.dtype)
+        self.f1 = (dt*f1/self.points).astype(self.dtype)
+        # f2 always multiplies two terms
+        self.f2 = (2*dt*f2/self.points).astype(self.dtype)
+        self.f3 = (dt*f3/self.points).astype(self.dtype)
+
+    def step(self,V):
+        """
+        Advances the solver *V* a timestep. The nonlinear terms are
+        always on V.S1, and the next stage is written on it.
+        """
+        self.buffers(V,('acc','nu','a','tmp'))
+        acc,nu,a,tmp = self.acc,self.nu,self.a,self.tmp
+
+        # a = E2*u+Q*N(u)
+        nu[...] = self.first(V)
+        numpy.multiply(self.E2,V.omega_hat,out=a)
+        numpy.multiply(self.Q,nu,out=tmp)
+        numpy.add(a,tmp,out=a)
+        V.S1[...] = a
+
+        # b = E2*u+Q*N(a)
+        na,u,v = V.nonlinear()
+        V.advect(1,u,v)
+        numpy.multiply(self.f2,na,out=acc)
+        numpy.multiply(self.Q,na,out=na)
+        numpy.multiply(self.E2,V.omega_hat,out=tmp)
+        numpy.add(na,tmp,out=V.S1)
+
+        # c = E2*a+Q*(2*N(b)-N(u))
+        nb,u,v = V.nonlinear()
+        V.advect(2,u,v)
+        numpy.multiply(self.f2,nb,out=tmp)
+        numpy.add(acc,tmp,out=acc)
+        numpy.multiply(nb,2,out=nb)
+        numpy.subtract(nb,nu,out=nb)
+        numpy.multiply(self.Q,nb,out=nb)
+        numpy.multiply(self.E2,a,out=tmp)
+        numpy.add(nb,tmp,out=V.S1)
+
+        # u = E*u+f1*N(u)+2*f2*(N(a)+N(b))+f3*N(c)
+        nc,u,v = V.nonlinear()
+        V.advect(3,u,v)
+        numpy.multiply(self.f3,nc,out=tmp)
+        numpy.add(acc,tmp,out=acc)
+        numpy.multiply(self.f1,nu,out=tmp)
+        numpy.add(acc,tmp,out=acc)
+        numpy.multiply(self.E,V.omega_hat,out=V.omega_hat)
+        numpy.add(V.omega_hat,acc,out=V.omega_hat)
+        self.last(V)
+
+
+integrators = {'ifrk4': IFRK4,
+               'etdrk4': ETDRK4}
+
+
+def get_integrator(name,V,**kwargs):
+    """
+    Integrator *name* for the solver *V*, None for the low storage
+    Runge Kutta of the solver itself, 'rk4'. Additional keyword
+    arguments are passed to the integrator.
+    """
+    if name == 'rk4':
+        return None
+    return integrators[name](V,**kwargs)
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+"""
+Peak memory of the process, for the benchmarks and the memory checks
+of the examples. It only depends on the standard library, so a module
+can measure itself without importing the solver.
+
+Example.
+before = maxrss()
+data = load()
+print 'MB:',maxrss()-before
+"""
+
+from __future__ import division
+import sys
+import resource
+
+
+def maxrss():
+    """Peak resident memory of the process in MB"""
+    # Linux reports kilobytes, OS X bytes
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak/2**20
+    return peak/2**10
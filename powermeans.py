@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+"""
+Power means of arrays larger than the memory, in a single pass.
+
+The root mean nth power of an array, like rms, cmc and nmn of the
+module ``means`` of the examples, needs a temporary as large as the
+array for a**n and a second pass for the mean. Here the array is
+reduced by blocks of about *blocksize* elements along the first axis,
+and all the powers are computed from the same block, so the array is
+read once and the memory only depends on the size of the blocks.
+
+The sums of a block are the pairwise sums of numpy, and the sums of
+the blocks are accumulated with the compensated summation of
+Neumaier, so the error does not grow with the number of blocks. The
+blocks are reduced by a pool of *workers* threads, numpy releases
+the GIL in the reads and the arithmetic. The blocks are always added
+in the same order, the result does not depend on the number of
+workers.
+
+The array may be
+
+  - A numpy array or a numpy.memmap. The pages of a memmap that have
+    been read stay in the page cache until the system needs them.
+  - A :class:`RawArray`, a binary or .npy file read by blocks without
+    mapping it.
+  - A sequence of arrays with the same shape, like a SnapshotReader or
+    a list. The index of the sequence is the first axis.
+
+Example.
+omega = RawArray.from_npy('/data/tur2d/omega.npy')
+rms2,rms3 = power_means(omega,(2,3),axis=0)
+"""
+
+from __future__ import division
+import io
+import time
+from multiprocessing.pool import ThreadPool
+import numpy
+from memory import maxrss
+
+
+class RawArray(object):
+    """
+    Array of *dtype* and *shape* in C order in the binary file
+    *filename*, from the byte *offset*. Slices along the first axis
+    are read from the file when they are accessed.
+
+    Example.
+    omega = RawArray('omega.bin','float32',(1000,2048,2048))
+    last = omega[-1:]
+    """
+    def __init__(self,filename,dtype,shape,offset=0):
+        self.filename = filename
+        self.dtype = numpy.dtype(dtype)
+        self.shape = tuple(shape)
+        self.offset = offset
+        self.size = int(numpy.prod(self.shape))
+        self.rowbytes = int(numpy.prod(self.shape[1:]))*self.dtype.itemsize
+
+    @staticmethod
+    def from_npy(filename):
+        """Array saved with numpy.save in *filename*"""
+        npy = open(filename,'rb')
+        version = numpy.lib.format.read_magic(npy)
+        if version == (1,0):
+            shape,fortran,dtype = numpy.lib.format.read_array_header_1_0(npy)
+        else:
+            shape,fortran,dtype = numpy.lib.format.read_array_header_2_0(npy)
+        offset = npy.tell()
+        npy.close()
+        if fortran:
+            raise ValueError('{} is in Fortran order'.format(filename))
+        return RawArray(filename,dtype,shape,offset)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def reshape(self,shape):
+        """The same file with another *shape*, one length may be -1"""
+        shape = list(numpy.atleast_1d(shape))
+        if -1 in shape:
+            rest = int(numpy.prod([n for n in shape if n != -1]))
+            shape[shape.index(-1)] = self.size//rest
+        if int(numpy.prod(shape)) != self.size:
+            raise ValueError('cannot reshape {} into {}'.format(
+                    self.shape,tuple(shape)))
+        return RawArray(self.filename,self.dtype,shape,self.offset)
+
+    def __getitem__(self,rows):
+        if not isinstance(rows,slice):
+            if rows < 0:
+                rows += self.shape[0]
+            if rows < 0 or rows >= self.shape[0]:
+                raise IndexError('index out of range')
+            return self[rows:rows+1][0]
+
+        start,stop,step = rows.indices(self.shape[0])
+        if step != 1:
+            raise IndexError('only contiguous slices can be read')
+        out = numpy.empty((max(stop-start,0),)+self.shape[1:],self.dtype)
+        buf = memoryview(out.reshape(-1).view('uint8'))
+        raw = io.open(self.filename,'rb',buffering=0)
+        try:
+            raw.seek(self.offset+start*self.rowbytes)
+            done = 0
+            while done < len(buf):
+                n = raw.readinto(buf[done:])
+                if not n:
+                    raise IOError('{} is too short'.format(self.filename))
+                done += n
+        finally:
+            raw.close()
+        return out
+
+
+def _neumaier(s,c,x):
+    """
+    Adds *x* to the sum *s* with compensation *c*. Returns the new
+    sum and compensation.
+    """
+    t = s+x
+    c = c+numpy.where(numpy.abs(s) >= numpy.abs(x),(s-t)+x,(x-t)+s)
+    return t,c
+
+
+def _sums(block,powers,axis):
+    """Sums of each of the *powers* of *block* along *axis*"""
+    x = numpy.asarray(block,dtype='float64')
+    p = x.copy()
+    # Small integer powers are products of the previous one
+    m = 1
+    sums = {}
+    for n in sorted(set(powers)):
+        if n == int(n) and m <= n <= m+4:
+            for i in range(m,int(n)):
+                numpy.multiply(p,x,out=p)
+            m = int(n)
+            sums[n] = p.sum(axis=axis)
+        else:
+            sums[n] = numpy.power(x,n).sum(axis=axis)
+    return numpy.array([sums[n] for n in powers])
+
+
+def power_means(a,powers=(2,),axis=None,blocksize=2**18,workers=4):
+    """
+    Root mean nth power of *a* for each n of *powers*, along *axis*
+    or of all the elements if it is None. Returns an array with the
+    result of each power along the first axis.
+
+    *blocksize* is the approximate number of elements of a block, a
+    block has at least a whole row of the first axis. *workers* is the
+    number of threads.
+    """
+    powers = tuple(powers)
+    if isinstance(a,(numpy.ndarray,RawArray)):
+        if axis is None and (isinstance(a,RawArray) or a.flags.c_contiguous):
+            # Blocks of elements instead of rows
+            a = a.reshape(-1)
+        shape = tuple(a.shape)
+        take = lambda start,stop: a[start:stop]
+    else:
+        shape = (len(a),)+numpy.shape(a[0])
+        take = lambda start,stop: numpy.array([a[i]
+                                               for i in range(start,stop)])
+
+    if axis is not None:
+        if not -len(shape) <= axis < len(shape):
+            raise ValueError('axis {} is out of bounds'.format(axis))
+        axis %= len(shape)
+
+    rows = max(1,blocksize//int(numpy.prod(shape[1:])))
+    blocks = [(start,min(start+rows,shape[0]))
+              for start in range(0,shape[0],rows)]
+
+    if axis is None or axis == 0:
+        count = int(numpy.prod(shape)) if axis is None else shape[0]
+        out = None
+        work = lambda block: _sums(take(*block),powers,axis)
+    else:
+        count = shape[axis]
+        out = numpy.empty((len(powers),)+shape[:axis]+shape[axis+1:])
+        def work(block):
+            out[:,block[0]:block[1]] = _sums(take(*block),powers,axis)/count
+
+    s = c = 0
+    pool = ThreadPool(workers) if workers > 1 else None
+    try:
+        # A batch of blocks at a time, the memory is bounded
+        batch = max(workers,1)
+        for i in range(0,len(blocks),batch):
+            if pool is None:
+                parts = map(work,blocks[i:i+batch])
+            else:
+                parts = pool.map(work,blocks[i:i+batch],1)
+            if out is None:
+                for part in parts:
+                    s,c = _neumaier(s,c,part)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if out is None:
+        out = (s+c)/count
+    for i,n in enumerate(powers):
+        out[i] = numpy.power(out[i],1/n)
+    return out
+
+
+def _result(value):
+    """A float if the reduction is a scalar"""
+    if numpy.ndim(value) == 0:
+        return float(value)
+    return value
+
+
+def rms(a,axis=None,**kwargs):
+    """
+    Root mean square of *a* along *axis*. Keyword arguments are
+    passed to :func:`power_means`.
+    """
+    return _result(power_means(a,(2,),axis,**kwargs)[0])
+
+
+def cmc(a,axis=None,**kwargs):
+    """
+    Cubic root mean cube of *a* along *axis*. Keyword arguments are
+    passed to :func:`power_means`.
+    """
+    return _result(power_means(a,(3,),axis,**kwargs)[0])
+
+
+def nmn(a,n,axis=None,**kwargs):
+    """
+    Nth root mean nth power of *a* along *axis*. Keyword arguments
+    are passed to :func:`power_means`.
+    """
+    return _result(power_means(a,(n,),axis,**kwargs)[0])
+
+
+def _reduce_file(filename,how,workers):
+    """
+    Power means of the .npy *filename* in a new process, read *how*,
+    'raw', 'memmap' or 'means' for the functions of the module
+    ``means``. Returns the results, the seconds and the memory used.
+    """
+    before = maxrss()
+    tstamp = time.time()
+    if how == 'means':
+        from _static import means
+        a = numpy.load(filename)
+        result = [means.rms(a),means.cmc(a),means.nmn(a,4)]
+    else:
+        if how == 'raw':
+            a = RawArray.from_npy(filename)
+        else:
+            a = numpy.load(filename,mmap_mode='r')
+        result = list(power_means(a,(2,3,4),workers=workers))
+    return result,time.time()-tstamp,maxrss()-before
+
+
+def test_powermeans(size_mb=1024,workers=4):
+    """
+    Compares the power means with the functions of the module
+    ``means``, and prints the time and the memory of a new process
+    that reduces a .npy file of *size_mb* MB and one of a quarter of
+    that size, with *workers* threads.
+    """
+    import os
+    import math
+    import shutil
+    import tempfile
+    from multiprocessing import Pool
+    from _static import means
+
+    numpy.random.seed(1)
+    a = numpy.random.rand(37,53,11)+0.5
+    for kwargs in ({},{'blocksize': 100, 'workers': 1},
+                   {'blocksize': 100, 'workers': 3}):
+        assert numpy.allclose(rms(a,**kwargs),means.rms(a),1e-14,0)
+        assert numpy.allclose(cmc(a,**kwargs),means.cmc(a),1e-14,0)
+        assert numpy.allclose(nmn(a,5,**kwargs),means.nmn(a,5),1e-14,0)
+        for axis in (0,1,2,-1):
+            for n in (2,3,5):
+                assert numpy.allclose(
+                    nmn(a,n,axis,**kwargs),
+                    numpy.apply_along_axis(means.nmn,axis,a,n),1e-14,0)
+        # A sequence
+        assert numpy.allclose(power_means(list(a),(2,3),0,**kwargs),
+                              power_means(a,(2,3),0),1e-14,0)
+
+    # Compensated sums, single precision data
+    b = (1+1e-3*numpy.random.rand(10**7)).astype('float32')
+    exact = math.sqrt(math.fsum(b.astype('float64')**2)/len(b))
+    print 'Relative error of means.rms:',abs(means.rms(b)/exact-1)
+    print 'Relative error of rms:',abs(rms(b,blocksize=2**12)/exact-1)
+    assert abs(rms(b,blocksize=2**12)/exact-1) < 1e-15
+
+    path = tempfile.mkdtemp()
+    pool = Pool(1,maxtasksperchild=1)
+    try:
+        # The files are written by blocks too
+        for mb in (size_mb//4,size_mb):
+            filename = os.path.join(path,'{}.npy'.format(mb))
+            rows = mb*2**18//1024
+            npy = numpy.lib.format.open_memmap(filename,'w+','float32',
+                                               (rows,1024))
+            for start in range(0,rows,1024):
+                npy[start:start+1024] = numpy.random.rand(
+                    min(1024,rows-start),1024)
+            npy.flush()
+            del npy
+
+            results = {}
+            for how in ('raw','memmap','means'):
+                if how == 'means' and mb > size_mb//4:
+                    continue
+                result,seconds,rss = pool.apply(_reduce_file,
+                                                (filename,how,workers))
+                results[how] = result
+                print '{:>6} MB {:<7} {:>8.2f} s {:>8.1f} MB of memory'.format(
+                    mb,how,seconds,rss)
+            assert numpy.allclose(results['raw'],results['memmap'],1e-15,0)
+            if 'means' in results:
+                assert numpy.allclose(results['raw'],results['means'],1e-5,0)
+    finally:
+        pool.terminate()
+        shutil.rmtree(path)
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+"""
+Timing of the phases of the 2D turbulence solver.
+
+The solvers have a *profiler* attribute, None by default. Then the
+only cost is a comparison with None at each phase. If it is a
+:class:`Profiler` every phase of the step is timed:
+
+  step         The whole step
+  spectral     Poisson equation and derivatives in Fourier space
+  ifft, fft    Each transform of the backend
+  product      Nonlinear product in physical space
+  dealias      Truncation of the convective term
+  viscous      Laplacian of the right hand side
+  fortran      Right hand side of Vorticity2DSerial, transforms included
+  velocities   Normalization of the velocities of the Fortran part
+  rk update    Substeps and updates of the low storage Runge Kutta
+  cfl          Timestep, with the reduction of a distributed solver
+  diagnostics  Sample of diagnostics.Diagnostics
+  tracers      Stage of tracers.Tracers, the interpolation included
+  snapshot     Copy of the vorticity by SnapshotWriter.write
+  checkpoint   Vorticity2D.save
+
+Phases are nested, the time of the step includes the rest. The
+statistics of each phase are accumulated as long as the profiler
+lives, and the last *events* phases are kept to be exported as a
+trace for chrome://tracing or Perfetto.
+
+Example.
+V = Vorticity2D(2.0,2.0,10000,0.2)
+V.profiler = Profiler()
+for i in range(nsteps):
+    V.step()
+V.profiler.report()
+V.profiler.save_trace('run.trace.json')
+"""
+
+from __future__ import division
+import json
+import timeit
+import contextlib
+import collections
+import numpy
+
+
+class Profiler(object):
+    """
+    Statistics of the time spent in each phase. *events* is the
+    number of phases kept for the trace, 0 for no trace. *pid* is the
+    process of the trace, the rank of a distributed solver. *alpha*
+    is the weight of the last sample in the moving average.
+    """
+    def __init__(self,events=100000,pid=0,alpha=0.05):
+        self.events = events
+        self.pid = pid
+        self.alpha = alpha
+        self.clock = timeit.default_timer
+        self.reset()
+
+    def reset(self):
+        """Forgets all the samples"""
+        # count, total, min, max, sum of squares, moving average
+        self.stats = collections.OrderedDict()
+        self.trace = collections.deque(maxlen=self.events)
+        self.start = self.clock()
+
+    def mark(self,name,start):
+        """
+        Adds a sample of the phase *name* that started at *start*,
+        a time given by :attr:`clock`. Returns the current time.
+        """
+        now = self.clock()
+        elapsed = now-start
+        s = self.stats.get(name)
+        if s is None:
+            self.stats[name] = [1,elapsed,elapsed,elapsed,elapsed**2,elapsed]
+        else:
+            s[0] += 1
+            s[1] += elapsed
+            if elapsed < s[2]:
+                s[2] = elapsed
+            if elapsed > s[3]:
+                s[3] = elapsed
+            s[4] += elapsed**2
+            s[5] += self.alpha*(elapsed-s[5])
+        if self.events:
+            self.trace.append((name,start,elapsed))
+        return now
+
+    @contextlib.contextmanager
+    def phase(self,name):
+        """
+        Times a block of code as the phase *name*
+
+        Example.
+        with V.profiler.phase('plot'):
+            pylab.contourf(V.omega)
+        """
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.mark(name,start)
+
+    def summary(self):
+        """
+        Dictionary with the statistics of each phase, in seconds
+        """
+        result = collections.OrderedDict()
+        for name,(count,total,tmin,tmax,squares,recent) in \
+                self.stats.items():
+            mean = total/count
+            result[name] = {'count': count,
+                            'total': total,
+                            'mean': mean,
+                            'std': numpy.sqrt(max(squares/count-mean**2,0)),
+                            'min': tmin,
+                            'max': tmax,
+                            'recent': recent}
+        return result
+
+    def report(self):
+        """
+        Prints the statistics sorted by total time, and the fraction
+        of the time of the step spent in each phase.
+        """
+        summary = self.summary()
+        step = summary.get('step',{}).get('total')
+        print '{:<12} {:>8} {:>10} {:>10} {:>10} {:>10} {:>6}'.format(
+            'phase','count','total s','mean ms','max ms','recent ms','%')
+        for name in sorted(summary,key=lambda n: -summary[n]['total']):
+            s = summary[name]
+            print '{:<12} {:>8} {:>10.4f} {:>10.4f} {:>10.4f} {:>10.4f} {:>6}'\
+                .format(name,s['count'],s['total'],1e3*s['mean'],
+                        1e3*s['max'],1e3*s['recent'],
+                        '{:.1f}'.format(100*s['total']/step) if step else '')
+
+    def save(self,filename):
+        """
+        Writes the statistics to the JSON file *filename*
+        """
+        output = open(filename,'w')
+        json.dump({'pid': self.pid, 'phases': self.summary()},output,
+                  indent=2)
+        output.close()
+
+    def chrome_trace(self):
+        """
+        Kept phases in the Chrome trace event format, times in
+        microseconds since the profiler was created or reset.
+        """
+        return {'displayTimeUnit': 'ms',
+                'traceEvents': [{'name': name, 'cat': 'tur2d', 'ph': 'X',
+                                 'ts': 1e6*(start-self.start),
+                                 'dur': 1e6*elapsed,
+                                 'pid': self.pid, 'tid': 0}
+                                for name,start,elapsed in self.trace]}
+
+    def save_trace(self,filename):
+        """
+        Writes the trace to *filename*, open it in chrome://tracing
+        or https://ui.perfetto.dev
+        """
+        output = open(filename,'w')
+        json.dump(self.chrome_trace(),output)
+        output.close()
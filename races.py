@@ -0,0 +1,177 @@
+# -*- coding: utf-8 -*-
+"""
+Monte Carlo of races to *n*, like the counters of the example
+_static/flujo3.py. Every draw is one of the *outcomes* with the same
+probability, and the race stops when one outcome has been drawn *n*
+times. The winner is that outcome and the stopping time the number of
+draws.
+
+A race never takes more than k*(n-1)+1 draws, k outcomes, so a batch
+of races is simulated with all the draws at once, and the first time
+that each outcome reaches *n* is found with cumulative sums.
+
+The races are split in tasks of *batch* races, and the task i draws
+from numpy.random.RandomState([seed,i]). The results only depend on
+the seed, the number of races and the size of the batch, not on the
+number of processes of the pool.
+
+The result is the joint distribution, counts[w,t] is the number of
+races won by the outcome w after t draws.
+
+Example.
+counts = simulate(10**7,n=10,processes=4)
+times = counts.sum(axis=0)
+winners = counts.sum(axis=1)
+"""
+
+from __future__ import division
+import time
+import random
+from math import exp, log, lgamma
+from multiprocessing import Pool
+import numpy
+
+
+def longest(n,k):
+    """Maximum number of draws of a race to *n* with *k* outcomes"""
+    return k*(n-1)+1
+
+
+def _races(task):
+    """
+    Joint counts of a task, a tuple with the seed, the index of the
+    task, the number of races, *n* and the number of outcomes.
+    """
+    seed,index,size,n,k = task
+    rs = numpy.random.RandomState([seed,index])
+    T = longest(n,k)
+    # Smallest signed integer that holds the outcomes and the counts,
+    # up to n and k included
+    dtype = numpy.min_scalar_type(-(max(n,k)+1))
+    draws = rs.randint(0,k,size=(size,T),dtype=dtype)
+
+    # First draw at which each outcome reaches n, T if never
+    first = numpy.empty((k,size),dtype='int64')
+    counts = numpy.empty((size,T),dtype=dtype)
+    for w in range(k):
+        numpy.cumsum(draws == w,axis=1,dtype=dtype,out=counts)
+        reached = counts == n
+        first[w] = numpy.where(reached.any(axis=1),reached.argmax(axis=1),T)
+
+    winner = first.argmin(axis=0)
+    # Number of draws, not the index of the last one
+    stop = first.min(axis=0)+1
+    return numpy.bincount(winner*(T+1)+stop,
+                          minlength=k*(T+1)).reshape(k,T+1)
+
+
+def simulate(ntrials,n=10,outcomes=(-1,0,1),batch=2**16,seed=0,
+             processes=None):
+    """
+    Joint counts of the winner and the stopping time of *ntrials*
+    races to *n* with *outcomes*. The races are simulated by tasks of
+    *batch* races with a pool of *processes*, in this process if it
+    is None.
+    """
+    k = len(outcomes)
+    tasks = [(seed,i,min(batch,ntrials-start),n,k)
+             for i,start in enumerate(range(0,ntrials,batch))]
+    counts = numpy.zeros((k,longest(n,k)+1),dtype='int64')
+    if processes is None:
+        for task in tasks:
+            counts += _races(task)
+    else:
+        pool = Pool(processes)
+        try:
+            for part in pool.imap_unordered(_races,tasks):
+                counts += part
+        finally:
+            pool.terminate()
+    return counts
+
+
+def loop(ntrials,n=10,outcomes=(-1,0,1),seed=0):
+    """
+    The same counts as :func:`simulate` with the loop of flujo3, one
+    random.choice per draw.
+    """
+    rand = random.Random(seed)
+    k = len(outcomes)
+    counts = numpy.zeros((k,longest(n,k)+1),dtype='int64')
+    for trial in xrange(ntrials):
+        drawn = [0]*k
+        draws = 0
+        while max(drawn) < n:
+            drawn[outcomes.index(rand.choice(outcomes))] += 1
+            draws += 1
+        counts[drawn.index(n),draws] += 1
+    return counts
+
+
+def exact(n=10,k=3):
+    """
+    Joint probability of the winner and the stopping time. The winner
+    w stops at t draws if the last draw is w, w was drawn n-1 times
+    in the first t-1 draws, and each of the other outcomes less than
+    n times. The factorials are added as logarithms, they overflow a
+    float for large *n*.
+    """
+    T = longest(n,k)
+    # Exponential generating function of the draws of a loser
+    loser = numpy.exp([-lgamma(c+1) for c in range(n)])
+    others = numpy.array([1.])
+    for i in range(k-1):
+        others = numpy.convolve(others,loser)
+
+    p = numpy.zeros(T+1)
+    for t in range(n,T+1):
+        if others[t-n] > 0:
+            p[t] = exp(log(others[t-n])+lgamma(t)-lgamma(n)-t*log(k))
+    return numpy.tile(p,(k,1))
+
+
+def test_races(ntrials=2*10**6,nloop=2*10**4,processes=2):
+    """
+    Compares the distributions of :func:`simulate` with the exact
+    ones, checks that the counts do not depend on the number of
+    processes, and prints the races per second of :func:`simulate`
+    and of :func:`loop`.
+    """
+    p = exact(10,3)
+    assert abs(p.sum()-1) < 1e-12
+
+    tstamp = time.time()
+    counts = simulate(ntrials)
+    vectorized = ntrials/(time.time()-tstamp)
+    assert counts.sum() == ntrials
+    assert numpy.all(simulate(ntrials,processes=processes) == counts)
+    assert numpy.any(simulate(ntrials,seed=1) != counts)
+
+    # Within five standard deviations of the exact frequencies
+    for freq,prob in ((counts.sum(axis=0)/ntrials,p.sum(axis=0)),
+                      (counts.sum(axis=1)/ntrials,p.sum(axis=1)),
+                      (counts/ntrials,p)):
+        sigma = numpy.sqrt(prob*(1-prob)/ntrials)
+        assert numpy.all(abs(freq-prob) <= 5*sigma+1e-12)
+
+    # Counts and outcomes at and above the limit of the smallest integers
+    for n,k,big in ((128,2,10**5),(130,2,10**5),(2,128,10**4)):
+        counts = simulate(big,n=n,outcomes=range(k))
+        p2 = exact(n,k)
+        assert counts.sum() == big and abs(p2.sum()-1) < 1e-12
+        for freq,prob in ((counts.sum(axis=0)/big,p2.sum(axis=0)),
+                          (counts.sum(axis=1)/big,p2.sum(axis=1))):
+            sigma = numpy.sqrt(prob*(1-prob)/big)
+            assert numpy.all(abs(freq-prob) <= 5*sigma+1e-12)
+
+    tstamp = time.time()
+    counts = loop(nloop)
+    looped = nloop/(time.time()-tstamp)
+    sigma = numpy.sqrt(p*(1-p)/nloop)
+    assert numpy.all(abs(counts/nloop-p) <= 5*sigma+1e-12)
+
+    times = numpy.arange(p.shape[1])
+    print 'Mean stopping time:',(times*p.sum(axis=0)).sum()
+    print 'loop:',looped,'races per second'
+    print 'simulate:',vectorized,'races per second'
+    print 'Speedup:',vectorized/looped
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+Right hand side of the 2D turbulence solver compiled with Numba, a
+portable alternative to the Fortran module rhs_tur2d that only needs
+the numba package. Use it with the *kernels* argument of the solvers.
+
+Example.
+V = Vorticity2D(2.0,2.0,10000,0.2,kernels='numba')
+
+The transforms are still done by the FFT backend of the solver. The
+rest of the right hand side is done by four kernels, each a single
+pass over the arrays:
+
+  spectral  Poisson equation for the stream function, velocities and
+            derivatives of the vorticity in Fourier space
+  product   Nonlinear product in physical space
+  dealias   Truncation of the convective term
+  viscous   Laplacian of the vorticity and sum of both terms
+
+The kernels repeat the arithmetic of numpy for complex numbers in the
+same order, so the right hand side is the same as the one of
+Vorticity2D.FW to the last bit. The rows are distributed among the
+threads of Numba with prange, set NUMBA_NUM_THREADS to change their
+number. The compiled code is cached next to this file, only the
+first run of a new type of arrays pays the compilation.
+"""
+
+import numba
+
+
+def _rows(a):
+    """View of *a* with all the leading dimensions as rows"""
+    rows = a.view()
+    # Raises AttributeError instead of copying
+    rows.shape = (-1,a.shape[-1])
+    return rows
+
+
+@numba.njit(parallel=True,cache=True)
+def _spectral(omega_hat,poisson,ikx,iky,u_hat,v_hat,ox_hat,oy_hat,zero,one):
+    ny = poisson.shape[0]
+    for j in numba.prange(omega_hat.shape[0]):
+        jj = j%ny
+        for i in range(omega_hat.shape[1]):
+            wr = omega_hat[j,i].real
+            wi = omega_hat[j,i].imag
+            # psi = -omega/poisson, divided like numpy does
+            p = poisson[jj,i]
+            rat = zero/p
+            scl = one/(p+zero*rat)
+            pr = -((wr+wi*rat)*scl)
+            pi = -((wi-wr*rat)*scl)
+            kxr = ikx[jj,i].real
+            kxi = ikx[jj,i].imag
+            kyr = iky[jj,i].real
+            kyi = iky[jj,i].imag
+            u_hat[j,i] = complex(kyr*pr-kyi*pi,kyr*pi+kyi*pr)
+            v_hat[j,i] = complex(-(kxr*pr-kxi*pi),-(kxr*pi+kxi*pr))
+            ox_hat[j,i] = complex(kxr*wr-kxi*wi,kxr*wi+kxi*wr)
+            oy_hat[j,i] = complex(kyr*wr-kyi*wi,kyr*wi+kyi*wr)
+
+
+@numba.njit(parallel=True,cache=True)
+def _product(u,v,ox,oy,conv):
+    for j in numba.prange(u.shape[0]):
+        for i in range(u.shape[1]):
+            conv[j,i] = u[j,i]*ox[j,i]+v[j,i]*oy[j,i]
+
+
+@numba.njit(parallel=True,cache=True)
+def _dealias(conv_hat,dealias,zero,one):
+    ny = dealias.shape[0]
+    for j in numba.prange(conv_hat.shape[0]):
+        jj = j%ny
+        for i in range(conv_hat.shape[1]):
+            d = one if dealias[jj,i] else zero
+            cr = conv_hat[j,i].real
+            ci = conv_hat[j,i].imag
+            conv_hat[j,i] = complex(d*cr-zero*ci,d*ci+zero*cr)
+
+
+@numba.njit(parallel=True,cache=True)
+def _viscous(S1,Lap,conv_hat,Re,zero,one):
+    ny = Lap.shape[0]
+    rat = zero/Re
+    scl = one/(Re+zero*rat)
+    for j in numba.prange(S1.shape[0]):
+        jj = j%ny
+        for i in range(S1.shape[1]):
+            L = Lap[jj,i]
+            sr = S1[j,i].real
+            si = S1[j,i].imag
+            # Lap*S1/Re
+            xr = L*sr-zero*si
+            xi = L*si+zero*sr
+            yr = (xr+xi*rat)*scl
+            yi = (xi-xr*rat)*scl
+            S1[j,i] = complex(yr-conv_hat[j,i].real,yi-conv_hat[j,i].imag)
+
+
+class Kernels(object):
+    """
+    Compiled kernels of the right hand side of the solver *V*. The
+    operators are shared with the solver. The stream function is not
+    written on the workspace.
+    """
+    name = 'numba'
+
+    def __init__(self,V):
+        self.poisson = V.poisson
+        self.ikx = V.ikx
+        self.iky = V.iky
+        self.Lap = V.Lap
+        self.dealias_mask = V.dealias
+        # Constants in the precision of the fields
+        real = V.real_dtype.type
+        self.zero = real(0)
+        self.one = real(1)
+        self.Re = real(V.Re)
+
+    def spectral(self,omega_hat,w):
+        """Fourier coefficients of u, v and the vorticity derivatives"""
+        _spectral(_rows(omega_hat),self.poisson,self.ikx,self.iky,
+                  _rows(w.u_hat),_rows(w.v_hat),_rows(w.ox_hat),
+                  _rows(w.oy_hat),self.zero,self.one)
+
+    def product(self,w):
+        """Convective term in physical space, on w.conv"""
+        _product(_rows(w.u),_rows(w.v),_rows(w.ox),_rows(w.oy),
+                 _rows(w.conv))
+
+    def dealias(self,w):
+        """Truncation of w.conv_hat"""
+        _dealias(_rows(w.conv_hat),self.dealias_mask,self.zero,self.one)
+
+    def viscous(self,S1,w):
+        """Right hand side Lap*S1/Re-conv_hat on *S1*"""
+        _viscous(_rows(S1),self.Lap,_rows(w.conv_hat),self.Re,self.zero,
+                 self.one)
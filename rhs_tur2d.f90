@@ -9,9 +9,37 @@ module rhs_tur2d
   integer:: nx__ = 64
   integer:: ny__ = 64
   integer:: Re__ = 10000
+  !Threads used by FFTW. 0 is the OpenMP default
+  integer:: nthreads__ = 0
+  !1 for single precision tables, work arrays and plans, used by
+  !fw_fortran_single. Set it before init.
+  integer:: single__ = 0
   !f2py intent(hide) planu,planv,planox,planoy,planconv
   type(c_ptr):: planu,planv,planox,planoy,planconv
+  !Plans of fftwf, kept apart so they are never executed or destroyed
+  !as double precision plans.
+  !f2py intent(hide) planu_s,planv_s,planox_s,planoy_s,planconv_s
+  type(c_ptr):: planu_s,planv_s,planox_s,planoy_s,planconv_s
   logical:: planned = .false.
+  logical:: planned_single = .false.
+
+  !Operator tables and work arrays, allocated by init. The arrays
+  !passed from Python are (ny__,nx__): rows are y and columns are x.
+  !Wavenumbers and dealias factors (1 or 0) of the columns and rows.
+  real(kind = 8), dimension(:), allocatable:: kx_t,ky_t
+  real(kind = 8), dimension(:), allocatable:: dealias_x,dealias_y
+  !Inverse of the Poisson operator
+  real(kind = 8), dimension(:,:), allocatable:: ipoisson_t
+  complex(kind = 8), dimension(:,:), allocatable:: u_hat_w,v_hat_w
+  complex(kind = 8), dimension(:,:), allocatable:: ox_hat_w,oy_hat_w
+  complex(kind = 8), dimension(:,:), allocatable:: ox_w,oy_w,conv_w
+  !Single precision versions
+  real(kind = 4), dimension(:), allocatable:: kx_s,ky_s
+  real(kind = 4), dimension(:), allocatable:: dealias_xs,dealias_ys
+  real(kind = 4), dimension(:,:), allocatable:: ipoisson_s
+  complex(kind = 4), dimension(:,:), allocatable:: u_hat_s,v_hat_s
+  complex(kind = 4), dimension(:,:), allocatable:: ox_hat_s,oy_hat_s
+  complex(kind = 4), dimension(:,:), allocatable:: ox_s,oy_s,conv_s
 
   contains
 
@@ -25,10 +53,226 @@ module rhs_tur2d
       include 'fftw3.f03'
       integer:: init
       
-      init = fftw_init_threads()
+      if (single__ /= 0) then
+         init = fftwf_init_threads()
+      else
+         init = fftw_init_threads()
+      end if
+      call tables()
 
     end function init
 
+    subroutine tables()
+      implicit none
+      !Compute the operator tables and allocate the work arrays
+      !for the current nx__, ny__, Lx__ and Ly__
+      integer:: i,j
+
+      if (allocated(kx_t)) then
+         call free_tables()
+      end if
+
+      allocate(kx_t(nx__),dealias_x(nx__),ky_t(ny__),dealias_y(ny__))
+      allocate(ipoisson_t(ny__,nx__))
+
+      do j = 1,nx__
+         kx_t(j) = kx(j,1)
+         dealias_x(j) = 0.0d0
+         if (abs(kx_t(j)*Lx__/(2*pi__)) < nx__/3.0d0) then
+            dealias_x(j) = 1.0d0
+         end if
+      end do
+
+      do i = 1,ny__
+         ky_t(i) = ky(1,i)
+         dealias_y(i) = 0.0d0
+         if (abs(ky_t(i)*Ly__/(2*pi__)) < ny__/3.0d0) then
+            dealias_y(i) = 1.0d0
+         end if
+      end do
+
+      !$OMP PARALLEL DO PRIVATE(i,j)
+      do j = 1,nx__
+         do i = 1,ny__
+            if (i==1 .and. j==1) then
+               ipoisson_t(i,j) = 1.0d0
+            else
+               ipoisson_t(i,j) = -1.0d0/(kx_t(j)**2+ky_t(i)**2)
+            end if
+         end do
+      end do
+      !$OMP END PARALLEL DO
+
+      if (single__ /= 0) then
+         !The tables are rounded once, the work arrays are only
+         !needed in the precision of the fields
+         allocate(kx_s(nx__),dealias_xs(nx__),ky_s(ny__),dealias_ys(ny__))
+         allocate(ipoisson_s(ny__,nx__))
+         kx_s = real(kx_t,4)
+         ky_s = real(ky_t,4)
+         dealias_xs = real(dealias_x,4)
+         dealias_ys = real(dealias_y,4)
+         ipoisson_s = real(ipoisson_t,4)
+         allocate(u_hat_s(ny__,nx__),v_hat_s(ny__,nx__))
+         allocate(ox_hat_s(ny__,nx__),oy_hat_s(ny__,nx__))
+         allocate(ox_s(ny__,nx__),oy_s(ny__,nx__),conv_s(ny__,nx__))
+      else
+         allocate(u_hat_w(ny__,nx__),v_hat_w(ny__,nx__))
+         allocate(ox_hat_w(ny__,nx__),oy_hat_w(ny__,nx__))
+         allocate(ox_w(ny__,nx__),oy_w(ny__,nx__),conv_w(ny__,nx__))
+      end if
+    end subroutine tables
+
+    subroutine free_tables()
+      implicit none
+      deallocate(kx_t,dealias_x,ky_t,dealias_y,ipoisson_t)
+      if (allocated(u_hat_w)) then
+         deallocate(u_hat_w,v_hat_w,ox_hat_w,oy_hat_w)
+         deallocate(ox_w,oy_w,conv_w)
+      end if
+      if (allocated(kx_s)) then
+         deallocate(kx_s,dealias_xs,ky_s,dealias_ys,ipoisson_s)
+         deallocate(u_hat_s,v_hat_s,ox_hat_s,oy_hat_s)
+         deallocate(ox_s,oy_s,conv_s)
+      end if
+    end subroutine free_tables
+
+
+    function threads()
+      implicit none
+      !Threads used by FFTW and by the OpenMP loops
+      integer:: threads,omp_get_max_threads
+
+      if (nthreads__ > 0) then
+         threads = nthreads__
+      else
+         threads = omp_get_max_threads()
+      end if
+    end function threads
+
+    function plan(rigor,wisdom,nx,ny)
+      use, intrinsic :: iso_c_binding
+      implicit none
+      include 'fftw3.f03'
+      !Create the plans used by fw_fortran_serial with the planner
+      !rigor FFTW_ESTIMATE, FFTW_MEASURE, FFTW_PATIENT or
+      !FFTW_EXHAUSTIVE. If wisdom is not blank the wisdom is imported
+      !from that file before planning and exported to it afterwards.
+      !Returns 1 if the wisdom was imported. Single precision plans
+      !if single__ is 1.
+      integer, intent(in):: nx,ny
+      character(len=*), intent(in):: rigor,wisdom
+      integer:: plan
+
+      complex(kind = 8), dimension(:,:), allocatable:: a,b
+      integer(C_INT):: flags,ierr
+
+      select case (rigor)
+      case ('FFTW_ESTIMATE')
+         flags = FFTW_ESTIMATE
+      case ('FFTW_MEASURE')
+         flags = FFTW_MEASURE
+      case ('FFTW_PATIENT')
+         flags = FFTW_PATIENT
+      case default
+         flags = FFTW_EXHAUSTIVE
+      end select
+      flags = flags + FFTW_DESTROY_INPUT
+
+      if (planned .or. planned_single) then
+         call destroy_plans()
+      end if
+
+      !The OpenMP loops use the same threads as FFTW
+      call omp_set_num_threads(threads())
+
+      if (single__ /= 0) then
+         plan = plan_single(flags,wisdom,nx,ny)
+      else
+         plan = 0
+         if (len_trim(wisdom) > 0) then
+            plan = fftw_import_wisdom_from_filename(&
+                 & trim(wisdom)//C_NULL_CHAR)
+         end if
+
+         call fftw_plan_with_nthreads(threads())
+
+         !The plans are executed later on other arrays of the same size
+         allocate(a(nx,ny),b(nx,ny))
+         planu = fftw_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+         planv = fftw_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+         planox = fftw_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+         planoy = fftw_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+         planconv = fftw_plan_dft_2d(ny,nx,a,b,FFTW_FORWARD,flags)
+         deallocate(a,b)
+
+         if (len_trim(wisdom) > 0) then
+            ierr = fftw_export_wisdom_to_filename(trim(wisdom)//C_NULL_CHAR)
+         end if
+         planned = .true.
+      end if
+
+      write(*,*) "INFO: plans for fftw. ",trim(rigor),&
+           & " and destroy input. Wisdom imported: ",plan
+    end function plan
+
+    function plan_single(flags,wisdom,nx,ny)
+      use, intrinsic :: iso_c_binding
+      implicit none
+      include 'fftw3.f03'
+      !Single precision plans for fw_fortran_single, same as plan.
+      !The wisdom of single precision plans is kept apart.
+      integer, intent(in):: nx,ny,flags
+      character(len=*), intent(in):: wisdom
+      integer:: plan_single
+
+      complex(kind = 4), dimension(:,:), allocatable:: a,b
+      integer(C_INT):: ierr
+
+      plan_single = 0
+      if (len_trim(wisdom) > 0) then
+         plan_single = fftwf_import_wisdom_from_filename(&
+              & trim(wisdom)//C_NULL_CHAR)
+      end if
+
+      call fftwf_plan_with_nthreads(threads())
+
+      allocate(a(nx,ny),b(nx,ny))
+      planu_s = fftwf_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+      planv_s = fftwf_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+      planox_s = fftwf_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+      planoy_s = fftwf_plan_dft_2d(ny,nx,a,b,FFTW_BACKWARD,flags)
+      planconv_s = fftwf_plan_dft_2d(ny,nx,a,b,FFTW_FORWARD,flags)
+      deallocate(a,b)
+      planned_single = .true.
+
+      if (len_trim(wisdom) > 0) then
+         ierr = fftwf_export_wisdom_to_filename(trim(wisdom)//C_NULL_CHAR)
+      end if
+    end function plan_single
+
+    subroutine destroy_plans()
+      use, intrinsic :: iso_c_binding
+      implicit none
+      include 'fftw3.f03'
+
+      if (planned_single .eqv. .true.) then
+         call fftwf_destroy_plan(planu_s)
+         call fftwf_destroy_plan(planv_s)
+         call fftwf_destroy_plan(planox_s)
+         call fftwf_destroy_plan(planoy_s)
+         call fftwf_destroy_plan(planconv_s)
+      end if
+      if (planned .eqv. .true.) then
+         call fftw_destroy_plan(planu)
+         call fftw_destroy_plan(planv)
+         call fftw_destroy_plan(planox)
+         call fftw_destroy_plan(planoy)
+         call fftw_destroy_plan(planconv)
+      end if
+      planned = .false.
+      planned_single = .false.
+    end subroutine destroy_plans
 
     function kx(i,j)
       implicit none
@@ -196,71 +440,197 @@ module rhs_tur2d
       !$OMP END PARALLEL DO
     end function dealias
     
+    subroutine spectral_fields(omega_hat,nx,ny)
+      implicit none
+      !Fourier coefficients of u, v and the gradient of the vorticity
+      !in a single pass over omega_hat. They are stored in u_hat_w,
+      !v_hat_w, ox_hat_w and oy_hat_w.
+      !ACHTUNG. nx is the number of rows and ny the number of columns.
+      integer, intent(in):: nx,ny
+      complex(kind = 8), dimension(nx,ny), intent(in):: omega_hat
+
+      integer:: i,j
+      real(kind = 8):: kxj,kyi
+      complex(kind = 8):: o,p
+
+      !$OMP PARALLEL DO PRIVATE(i,j,kxj,kyi,o,p)
+      do j = 1,ny
+         kxj = kx_t(j)
+         do i = 1,nx
+            kyi = ky_t(i)
+            o = omega_hat(i,j)
+            p = o*ipoisson_t(i,j)
+            !Products by the imaginary unit written explicitly
+            u_hat_w(i,j) = cmplx(kyi*aimag(p),-kyi*real(p),kind = 8)
+            v_hat_w(i,j) = cmplx(-kxj*aimag(p),kxj*real(p),kind = 8)
+            ox_hat_w(i,j) = cmplx(-kxj*aimag(o),kxj*real(o),kind = 8)
+            oy_hat_w(i,j) = cmplx(-kyi*aimag(o),kyi*real(o),kind = 8)
+         end do
+      end do
+      !$OMP END PARALLEL DO
+    end subroutine spectral_fields
+
+    subroutine update_rhs(omega_hat,rhs,nx,ny)
+      implicit none
+      !rhs holds the transform of the convective term. Renormalizes
+      !and dealiases it and adds the viscous term in a single pass.
+      integer, intent(in):: nx,ny
+      complex(kind = 8), dimension(nx,ny), intent(in):: omega_hat
+      complex(kind = 8), dimension(nx,ny), intent(inout):: rhs
+
+      integer:: i,j
+      real(kind = 8):: scale,iRe,kx2
+
+      !The four inverse transforms are not normalized
+      scale = 1.0d0/(real(nx,8)*real(ny,8))**2
+      iRe = 1.0d0/Re__
+
+      !$OMP PARALLEL DO PRIVATE(i,j,kx2)
+      do j = 1,ny
+         kx2 = kx_t(j)**2
+         do i = 1,nx
+            rhs(i,j) = -(kx2+ky_t(i)**2)*iRe*omega_hat(i,j) - &
+                 & (dealias_x(j)*dealias_y(i)*scale)*rhs(i,j)
+         end do
+      end do
+      !$OMP END PARALLEL DO
+    end subroutine update_rhs
+
     subroutine fw_fortran_serial(omega_hat,rhs,u,v,nx,ny)
-      !TODO. Separate plan creation from plan execution.
+      !The plans are created by plan, here they are only executed.
       use, intrinsic :: iso_c_binding
       implicit none
       include 'fftw3.f03'
 
       integer, intent(in):: nx,ny
-      integer:: n,omp_get_num_threads
+      integer:: n
       complex(kind = 8), dimension(nx,ny), intent(in):: omega_hat
-      complex(kind = 8), dimension(nx,ny), intent(out):: rhs,u,v
+      !Output arrays are given by the caller to avoid allocating
+      !them at every call. They must be contiguous in Fortran order.
+      complex(kind = 8), dimension(nx,ny), intent(inout):: rhs,u,v
+
+      integer:: i,j
+
+      !The tables and work arrays of init are in single precision
+      if (single__ /= 0) then
+         stop "fw_fortran_serial requires single__ = 0"
+      end if
+      if (planned .eqv. .false.) then
+         n = plan('FFTW_EXHAUSTIVE','',nx,ny)
+      end if
+
+      call spectral_fields(omega_hat,nx,ny)
 
-      !Aux variables. More than needed, you can clean up.
-      complex(kind = 8), dimension(nx,ny):: u_hat,v_hat
-      complex(kind = 8), dimension(nx,ny):: omega_x_hat,omega_y_hat
-      complex(kind = 8), dimension(nx,ny):: omega_x,omega_y
-      complex(kind = 8), dimension(nx,ny):: conv
+      call fftw_execute_dft(planu,u_hat_w,u)
+      call fftw_execute_dft(planv,v_hat_w,v)
+      call fftw_execute_dft(planox,ox_hat_w,ox_w)
+      call fftw_execute_dft(planoy,oy_hat_w,oy_w)
+
+      !Only the real part of the fields is meaningful
+      !$OMP PARALLEL DO PRIVATE(i,j)
+      do j = 1,ny
+         do i = 1,nx
+            conv_w(i,j) = real(u(i,j))*real(ox_w(i,j)) + &
+                 & real(v(i,j))*real(oy_w(i,j))
+         end do
+      end do
+      !$OMP END PARALLEL DO
+      call fftw_execute_dft(planconv,conv_w,rhs)
+
+      call update_rhs(omega_hat,rhs,nx,ny)
+
+    end subroutine fw_fortran_serial
+
+    subroutine spectral_fields_single(omega_hat,nx,ny)
+      implicit none
+      !spectral_fields in single precision
+      integer, intent(in):: nx,ny
+      complex(kind = 4), dimension(nx,ny), intent(in):: omega_hat
 
       integer:: i,j
+      real(kind = 4):: kxj,kyi
+      complex(kind = 4):: o,p
 
-      call fftw_plan_with_nthreads(omp_get_num_threads())
+      !$OMP PARALLEL DO PRIVATE(i,j,kxj,kyi,o,p)
+      do j = 1,ny
+         kxj = kx_s(j)
+         do i = 1,nx
+            kyi = ky_s(i)
+            o = omega_hat(i,j)
+            p = o*ipoisson_s(i,j)
+            u_hat_s(i,j) = cmplx(kyi*aimag(p),-kyi*real(p),kind = 4)
+            v_hat_s(i,j) = cmplx(-kxj*aimag(p),kxj*real(p),kind = 4)
+            ox_hat_s(i,j) = cmplx(-kxj*aimag(o),kxj*real(o),kind = 4)
+            oy_hat_s(i,j) = cmplx(-kyi*aimag(o),kyi*real(o),kind = 4)
+         end do
+      end do
+      !$OMP END PARALLEL DO
+    end subroutine spectral_fields_single
 
+    subroutine update_rhs_single(omega_hat,rhs,nx,ny)
+      implicit none
+      !update_rhs in single precision
+      integer, intent(in):: nx,ny
+      complex(kind = 4), dimension(nx,ny), intent(in):: omega_hat
+      complex(kind = 4), dimension(nx,ny), intent(inout):: rhs
 
-      if (planned .eqv. .false.) then
-         planu = fftw_plan_dft_2d(ny,nx,u_hat,u,FFTW_BACKWARD,&
-              & FFTW_EXHAUSTIVE + FFTW_DESTROY_INPUT)
-         planv = fftw_plan_dft_2d(ny,nx,v_hat,v,FFTW_BACKWARD,&
-              & FFTW_EXHAUSTIVE + FFTW_DESTROY_INPUT)
-         planox = fftw_plan_dft_2d(ny,nx,omega_x_hat,omega_x,&
-              & FFTW_BACKWARD,FFTW_EXHAUSTIVE + FFTW_DESTROY_INPUT)
-         planoy = fftw_plan_dft_2d(ny,nx,omega_y_hat,omega_y,&
-              & FFTW_BACKWARD,FFTW_EXHAUSTIVE + FFTW_DESTROY_INPUT)
-         planconv = fftw_plan_dft_2d(ny,nx,conv,rhs,&
-              & FFTW_FORWARD,FFTW_EXHAUSTIVE + FFTW_DESTROY_INPUT)
-         planned = .true.
-         write(*,*) "INFO: plans for fftw. Exhaustive and destroy input"
+      integer:: i,j
+      real(kind = 4):: scale,iRe,kx2
+
+      scale = real(1.0d0/(real(nx,8)*real(ny,8))**2,4)
+      iRe = 1.0/Re__
+
+      !$OMP PARALLEL DO PRIVATE(i,j,kx2)
+      do j = 1,ny
+         kx2 = kx_s(j)**2
+         do i = 1,nx
+            rhs(i,j) = -(kx2+ky_s(i)**2)*iRe*omega_hat(i,j) - &
+                 & (dealias_xs(j)*dealias_ys(i)*scale)*rhs(i,j)
+         end do
+      end do
+      !$OMP END PARALLEL DO
+    end subroutine update_rhs_single
+
+    subroutine fw_fortran_single(omega_hat,rhs,u,v,nx,ny)
+      !fw_fortran_serial for single precision arrays. Requires
+      !single__ = 1 when init and plan were called.
+      use, intrinsic :: iso_c_binding
+      implicit none
+      include 'fftw3.f03'
+
+      integer, intent(in):: nx,ny
+      complex(kind = 4), dimension(nx,ny), intent(in):: omega_hat
+      complex(kind = 4), dimension(nx,ny), intent(inout):: rhs,u,v
+
+      integer:: i,j,n
+
+      if (planned_single .eqv. .false.) then
+         if (single__ == 0) then
+            stop "fw_fortran_single requires single__ = 1"
+         end if
+         n = plan('FFTW_EXHAUSTIVE','',nx,ny)
       end if
 
-      u_hat = u_hat_f(omega_hat,nx,ny)
-      v_hat = v_hat_f(omega_hat,nx,ny)
-      omega_x_hat = ddx(omega_hat,nx,ny)
-      omega_y_hat = ddy(omega_hat,nx,ny)
+      call spectral_fields_single(omega_hat,nx,ny)
 
-      call fftw_execute_dft(planu,u_hat,u)
-      call fftw_execute_dft(planv,v_hat,v)
-      call fftw_execute_dft(planox,omega_x_hat,omega_x)
-      call fftw_execute_dft(planoy,omega_y_hat,omega_y)
+      call fftwf_execute_dft(planu_s,u_hat_s,u)
+      call fftwf_execute_dft(planv_s,v_hat_s,v)
+      call fftwf_execute_dft(planox_s,ox_hat_s,ox_s)
+      call fftwf_execute_dft(planoy_s,oy_hat_s,oy_s)
 
-      conv = (u*omega_x + v*omega_y)/(nx*ny)
-      call fftw_execute_dft(planconv,conv,rhs)
-      
-      !Renormalize after forward fft
-      rhs = rhs/(nx*ny)
-      !Dealias with the 3/2 rule
-      rhs = dealias(rhs,nx,ny)
-      
-      !Compute the rhs part of the NS equation.
       !$OMP PARALLEL DO PRIVATE(i,j)
       do j = 1,ny
          do i = 1,nx
-            rhs(i,j) = lap(i,j)*omega_hat(i,j)/Re__ - rhs(i,j)
+            conv_s(i,j) = real(u(i,j))*real(ox_s(i,j)) + &
+                 & real(v(i,j))*real(oy_s(i,j))
          end do
       end do
-      !$END OMP PARALLEL DO
+      !$OMP END PARALLEL DO
+      call fftwf_execute_dft(planconv_s,conv_s,rhs)
 
-    end subroutine fw_fortran_serial
+      call update_rhs_single(omega_hat,rhs,nx,ny)
+
+    end subroutine fw_fortran_single
 
     function cleanup()
       use, intrinsic :: iso_c_binding
@@ -268,14 +638,18 @@ module rhs_tur2d
       include 'fftw3.f03'
       integer:: cleanup
       
-      call fftw_cleanup_threads()
+      if (planned .or. planned_single) then
+         call destroy_plans()
+      end if
 
-      if (planned .eqv. .true.) then
-         call fftw_destroy_plan(planu)
-         call fftw_destroy_plan(planv)
-         call fftw_destroy_plan(planox)
-         call fftw_destroy_plan(planoy)
-         call fftw_destroy_plan(planconv)
+      if (single__ /= 0) then
+         call fftwf_cleanup_threads()
+      else
+         call fftw_cleanup_threads()
+      end if
+
+      if (allocated(kx_t)) then
+         call free_tables()
       end if
 
       write(*,*) "INFO: cleaning up threads and plans."
@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+Rolling window analytics of many yahoostock series at once.
+
+The series of many symbols are aligned in a panel with :func:`panel`,
+an array with a row per symbol and a column per session, the oldest
+first, and NaN for the sessions without a quote. The kernels work
+along the last axis of any array, every row at the same time, and
+take O(N) operations whatever the window:
+
+  moving_average, moving_std  Differences of cumulative sums
+  rolling_max, rolling_min    Maxima of blocks of *window* sessions
+  log_returns, volatility     Annualized standard deviation of returns
+  drawdown, rolling_drawdown  Fall from the maximum, total or rolling
+
+A window with a missing session has no average or deviation, the
+maxima ignore the missing sessions. Use :func:`by_rows` to apply a
+kernel to a large panel by groups of rows, so the temporaries are
+small.
+
+When a new session arrives there is no need to compute the whole
+history again. :class:`Rolling` keeps the last *window* quotes of
+every symbol and folds in a session in O(window) operations.
+
+Example.
+dates,prices = panel(read_many(symbols,cache='/data/quotes').values())
+sma = by_rows(moving_average,prices,(50,))
+R = Rolling(prices,window=50)
+R.update(new_prices)
+R.mean
+"""
+
+from __future__ import division
+import time
+import shutil
+import tempfile
+import datetime
+import numpy
+
+import finance
+
+
+def panel(source,column='adj_close',symbols=None,start=None,end=None):
+    """
+    Dates and quotes of *column* of many series. *source* is a list
+    of yahoostock or a Store, then *symbols*, all if None, are read
+    from the date *start* to *end*. Returns the day numbers of all
+    the sessions and an array with a row per series and a column per
+    session, NaN if there is no quote.
+    """
+    if isinstance(source,finance.Store):
+        if symbols is None:
+            symbols = source.symbols
+        tables = [source.window(symbol,start,end) for symbol in symbols]
+    else:
+        tables = [stock.table for stock in source]
+
+    index = finance.columns.index(column)
+    dates = numpy.unique(numpy.concatenate(
+            [numpy.zeros(0)]+[table[0] for table in tables
+                              if table is not None]))
+    prices = numpy.empty((len(tables),len(dates)))
+    prices[:] = numpy.nan
+    for i,table in enumerate(tables):
+        if table is not None:
+            prices[i,numpy.searchsorted(dates,table[0])] = table[index]
+    return dates,prices
+
+
+def by_rows(kernel,x,args=(),rows=256):
+    """
+    Applies *kernel* to groups of *rows* rows of *x*, with the
+    additional arguments *args*. The result has the shape of *x*.
+    """
+    x = numpy.asarray(x)
+    out = numpy.empty(x.shape)
+    for start in range(0,x.shape[0],rows):
+        out[start:start+rows] = kernel(x[start:start+rows],*args)
+    return out
+
+
+def _moving_sums(x,window,powers):
+    """
+    Sums of the *powers* of x-m in the windows that end at each
+    session, m the mean of each row, and m. The sums are NaN if a
+    window is incomplete.
+    """
+    x = numpy.asarray(x,dtype='float64')
+    valid = numpy.isfinite(x)
+    count = valid.sum(axis=-1)[...,numpy.newaxis]
+    # Centered values, the differences of the cumulative sums do not
+    # lose digits.
+    xc = numpy.where(valid,x,0)
+    m = xc.sum(axis=-1)[...,numpy.newaxis]/numpy.maximum(count,1)
+    xc -= m
+    xc[~valid] = 0
+
+    n = x.shape[-1]
+    def windows(y):
+        c = numpy.zeros(y.shape[:-1]+(n+1,))
+        numpy.cumsum(y,axis=-1,out=c[...,1:])
+        out = numpy.empty(x.shape)
+        out[...,:window-1] = numpy.nan
+        out[...,window-1:] = c[...,window:]-c[...,:n-window+1]
+        return out
+
+    sums = [windows(xc**p) for p in powers]
+    if not valid.all():
+        incomplete = windows(valid.astype('float64')) != window
+        for s in sums:
+            s[incomplete] = numpy.nan
+    return sums,m
+
+
+def moving_average(x,window):
+    """Mean of the last *window* sessions"""
+    (s1,),m = _moving_sums(x,window,(1,))
+    return m+s1/window
+
+
+def moving_std(x,window,ddof=1):
+    """Standard deviation of the last *window* sessions"""
+    (s1,s2),m = _moving_sums(x,window,(1,2))
+    return numpy.sqrt(numpy.maximum(s2-s1**2/window,0)/(window-ddof))
+
+
+def rolling_max(x,window):
+    """
+    Maximum of the last *window* sessions, with the algorithm of van
+    Herk and Gil-Werman: the maximum of a window is the maximum of
+    the end of a block of *window* sessions and the beginning of the
+    next one.
+    """
+    x = numpy.asarray(x,dtype='float64')
+    n = x.shape[-1]
+    nblocks = -(-n//window)
+    blocks = numpy.empty(x.shape[:-1]+(nblocks*window,))
+    blocks[...,:n] = x
+    blocks[...,n:] = numpy.nan
+    blocks = blocks.reshape(x.shape[:-1]+(nblocks,window))
+    first = numpy.fmax.accumulate(blocks,axis=-1)
+    last = numpy.fmax.accumulate(blocks[...,::-1],axis=-1)[...,::-1]
+    first = first.reshape(x.shape[:-1]+(-1,))
+    last = last.reshape(x.shape[:-1]+(-1,))
+
+    out = numpy.empty(x.shape)
+    out[...,:window-1] = numpy.nan
+    out[...,window-1:] = numpy.fmax(last[...,:n-window+1],
+                                     first[...,window-1:n])
+    return out
+
+
+def rolling_min(x,window):
+    """Minimum of the last *window* sessions"""
+    return -rolling_max(-numpy.asarray(x,dtype='float64'),window)
+
+
+def log_returns(x):
+    """Logarithm of the ratio of each quote and the previous one"""
+    x = numpy.asarray(x,dtype='float64')
+    out = numpy.empty(x.shape)
+    out[...,0] = numpy.nan
+    out[...,1:] = numpy.log(x[...,1:]/x[...,:-1])
+    return out
+
+
+def volatility(x,window,periods=252):
+    """
+    Annualized standard deviation of the last *window* log returns,
+    with *periods* sessions per year.
+    """
+    return moving_std(log_returns(x),window)*numpy.sqrt(periods)
+
+
+def drawdown(x):
+    """Fall of each quote from the maximum of all the previous ones"""
+    x = numpy.asarray(x,dtype='float64')
+    return x/numpy.fmax.accumulate(x,axis=-1)-1
+
+
+def rolling_drawdown(x,window):
+    """Fall of each quote from the maximum of the last *window*"""
+    return numpy.asarray(x,dtype='float64')/rolling_max(x,window)-1
+
+
+class Rolling(object):
+    """
+    State of the rolling windows of many series, for the panel of
+    quotes *prices*, with a row per series and a column per session.
+    Each :meth:`update` with the quotes of a new session takes
+    O(window) operations per series, and the attributes are the
+    values of the kernels at the last session. *periods* is the
+    number of sessions per year of the volatility.
+
+    Example.
+    R = Rolling(prices,window=20)
+    R.update(new_prices)
+    R.volatility
+    """
+    def __init__(self,prices,window=20,periods=252):
+        prices = numpy.atleast_2d(numpy.asarray(prices,dtype='float64'))
+        self.window = window
+        self.periods = periods
+        self.count = prices.shape[1]
+
+        # Ring buffers of the last quotes and returns
+        k = min(window,self.count)
+        slots = numpy.arange(self.count-k,self.count)%window
+        self.prices = numpy.empty((prices.shape[0],window))
+        self.prices[:] = numpy.nan
+        self.prices[:,slots] = prices[:,self.count-k:]
+        self.returns = numpy.empty((prices.shape[0],window))
+        self.returns[:] = numpy.nan
+        self.returns[:,slots] = log_returns(
+            prices[:,max(self.count-k-1,0):])[:,-k:]
+        self.last = prices[:,-1].copy()
+        self.peak = numpy.fmax.reduce(prices,axis=1)
+
+    def update(self,prices):
+        """Folds in the quotes of a new session, NaN if missing"""
+        prices = numpy.asarray(prices,dtype='float64')
+        i = self.count%self.window
+        self.returns[:,i] = numpy.log(prices/self.last)
+        self.prices[:,i] = prices
+        self.last = prices.copy()
+        self.peak = numpy.fmax(self.peak,prices)
+        self.count += 1
+
+    @property
+    def mean(self):
+        """Moving average"""
+        return self.prices.mean(axis=1)
+
+    @property
+    def std(self):
+        """Moving standard deviation"""
+        return self.prices.std(axis=1,ddof=1)
+
+    @property
+    def high(self):
+        """Maximum of the window"""
+        if self.count < self.window:
+            return numpy.nan*self.last
+        return numpy.fmax.reduce(self.prices,axis=1)
+
+    @property
+    def volatility(self):
+        """Annualized standard deviation of the log returns"""
+        return self.returns.std(axis=1,ddof=1)*numpy.sqrt(self.periods)
+
+    @property
+    def drawdown(self):
+        """Fall from the maximum of the whole history"""
+        return self.last/self.peak-1
+
+    @property
+    def rolling_drawdown(self):
+        """Fall from the maximum of the window"""
+        return self.last/self.high-1
+
+
+def _loop_average(x,window):
+    """Moving average with a loop, like the dashboards did"""
+    out = numpy.empty(len(x))
+    out[:] = numpy.nan
+    for t in range(window-1,len(x)):
+        total = 0.0
+        for price in x[t-window+1:t+1]:
+            total += price
+        out[t] = total/window
+    return out
+
+
+def test_rolling(window=20):
+    """
+    Checks the kernels against direct computations of each window,
+    and Rolling against the kernels.
+    """
+    numpy.random.seed(3)
+    x = 100*numpy.exp(numpy.cumsum(0.01*numpy.random.randn(7,300),axis=1))
+    x[2,:50] = numpy.nan
+    x[4,100] = numpy.nan
+    n = x.shape[1]
+
+    def direct(func,x):
+        out = numpy.empty(x.shape)
+        out[:] = numpy.nan
+        for t in range(window-1,n):
+            out[:,t] = func(x[:,t-window+1:t+1])
+        return out
+
+    def same(a,b):
+        with numpy.errstate(invalid='ignore'):
+            return numpy.all((numpy.isnan(a) & numpy.isnan(b)) |
+                             (abs(a-b) <= 1e-9*abs(b)))
+
+    assert same(moving_average(x,window),direct(
+            lambda w: w.mean(axis=1),x))
+    assert same(moving_std(x,window),direct(
+            lambda w: w.std(axis=1,ddof=1),x))
+    assert same(rolling_max(x,window),direct(
+            lambda w: numpy.fmax.reduce(w,axis=1),x))
+    assert same(rolling_min(x,window),direct(
+            lambda w: numpy.fmin.reduce(w,axis=1),x))
+    assert same(volatility(x,window),direct(
+            lambda w: w.std(axis=1,ddof=1),log_returns(x))*numpy.sqrt(252))
+    assert same(by_rows(moving_average,x,(window,),rows=3),
+                moving_average(x,window))
+    assert same(moving_average(x[0],window),moving_average(x,window)[0])
+    assert same(_loop_average(x[0],window),moving_average(x[0],window))
+
+    # Incremental updates from part of the history
+    for first in (5,window,150):
+        R = Rolling(x[:,:first],window)
+        for t in range(first,n):
+            R.update(x[:,t])
+        assert same(R.mean,moving_average(x,window)[:,-1])
+        assert same(R.std,moving_std(x,window)[:,-1])
+        assert same(R.volatility,volatility(x,window)[:,-1])
+        assert same(R.drawdown,drawdown(x)[:,-1])
+        assert same(R.rolling_drawdown,rolling_drawdown(x,window)[:,-1])
+
+
+def bench_rolling(nsymbols=10000,years=20,window=20,rows=256,nloop=20):
+    """
+    Times the kernels on a panel of *nsymbols* symbols with *years*
+    years of synthetic daily quotes, read from a Store. Compares them
+    with a loop over *nloop* symbols, and with the update of Rolling
+    with a new session.
+    """
+    end = datetime.date(2015,12,31)
+    start = datetime.date(end.year-years,1,1)
+    symbols = ['S{:05d}'.format(i) for i in range(nsymbols)]
+    path = tempfile.mkdtemp()
+    try:
+        store = finance.Store.write(path,((symbol,finance.synthetic(
+                        symbol,'d',start,end)) for symbol in symbols))
+        tstamp = time.time()
+        dates,prices = panel(store)
+        print 'Panel of',prices.shape,'in',time.time()-tstamp,'seconds'
+    finally:
+        shutil.rmtree(path)
+
+    total = 0
+    times = {}
+    kernels = [('moving_average',moving_average,(window,)),
+               ('moving_std',moving_std,(window,)),
+               ('volatility',volatility,(window,)),
+               ('drawdown',drawdown,()),
+               ('rolling_drawdown',rolling_drawdown,(window,))]
+    results = {}
+    for name,kernel,args in kernels:
+        tstamp = time.time()
+        results[name] = by_rows(kernel,prices,args,rows)
+        times[name] = time.time()-tstamp
+        total += times[name]
+        print '{:<18} {:>8.3f} s'.format(name,times[name])
+
+    tstamp = time.time()
+    for i in range(nloop):
+        _loop_average(prices[i],window)
+    looped = (time.time()-tstamp)*nsymbols/nloop
+    print 'Loop moving average, estimated:',looped,'s, speedup',\
+        looped/times['moving_average']
+
+    R = Rolling(prices[:,:-1],window)
+    tstamp = time.time()
+    R.update(prices[:,-1])
+    values = (R.mean,R.std,R.volatility,R.drawdown,R.rolling_drawdown)
+    incremental = time.time()-tstamp
+    print 'Rolling update of a session:',incremental,'s, speedup',\
+        total/incremental,'over all the kernels'
+    for name,value in zip(['moving_average','moving_std','volatility',
+                           'drawdown','rolling_drawdown'],values):
+        assert numpy.allclose(value,results[name][:,-1],1e-9,0)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Snapshots of the 2D turbulence solver.
+
+All the snapshots of a run are stored in a single directory with the
+layout of a zarr (version 2) group, so they can be read with
+:class:`SnapshotReader` or with the zarr library. The group contains
+two arrays, *omega* with one chunk per snapshot and *t* with the time
+of each snapshot. Chunks are compressed with zlib.
+
+The solver only copies the vorticity. The inverse transform, the
+conversion to single precision, the compression and the writes are
+done by a background thread.
+"""
+
+from __future__ import division
+import os
+import json
+import zlib
+import threading
+import Queue
+import numpy
+from fftbackend import NumpyFFT
+
+
+def _write_json(filename,obj):
+    jsonfile = open(filename,'w')
+    json.dump(obj,jsonfile,indent=2)
+    jsonfile.close()
+
+
+def _read_json(filename):
+    jsonfile = open(filename)
+    obj = json.load(jsonfile)
+    jsonfile.close()
+    return obj
+
+
+def _chunk_key(n,shape):
+    """Name of the chunk of the snapshot *n*"""
+    return str(n)+'.0'*len(shape)
+
+
+def _zarray(shape,chunks,dtype,level):
+    """Metadata of a zarr array"""
+    if level:
+        compressor = {'id': 'zlib', 'level': level}
+    else:
+        compressor = None
+    return {'zarr_format': 2,
+            'shape': list(shape),
+            'chunks': list(chunks),
+            'dtype': numpy.dtype(dtype).str,
+            'compressor': compressor,
+            'fill_value': None,
+            'order': 'C',
+            'filters': None}
+
+
+class SnapshotWriter(object):
+    """
+    Writes snapshots of the solver *V* to the directory *path*.
+
+    Keyword arguments
+    physical -- If True the vorticity is stored in physical space,
+                otherwise omega_hat is stored. Defaults to True.
+    single -- Store in single precision. Defaults to False.
+    level -- zlib compression level, 0 for no compression. Defaults to 1.
+    maxsize -- Number of snapshots waiting to be written. write only
+               blocks if the disk is slower than the solver.
+
+    The snapshots of an ensemble hold all its members, and the time
+    of each member is stored.
+
+    If *path* already has snapshots, the ones taken up to the current
+    time of the solver are kept and new snapshots are appended. This
+    is how a run restarted from a checkpoint continues its output.
+
+    With a distributed solver every process creates the writer and
+    calls write, the spectrum is collected and written by rank 0.
+
+    Example.
+    W = SnapshotWriter(V,'/data/tur2d/run.zarr',single=True)
+    for i in range(nsteps):
+        V.step()
+        if i%40 == 0:
+            W.write()
+    W.close()
+    """
+    def __init__(self,V,path,physical=True,single=False,level=1,maxsize=4):
+        self.V = V
+        self.path = path
+        self.physical = physical
+        self.level = level
+
+        self.batch = V.batch
+        if physical:
+            self.shape = V.batch+(V.ny,V.nx)
+            self.dtype = numpy.dtype('float32' if single else 'float64')
+            # The backend of the solver may not be thread safe
+            self.transform = NumpyFFT(self.shape,V.rfft)
+        else:
+            self.shape = V.batch+NumpyFFT((V.ny,V.nx),V.rfft).spectral_shape
+            self.dtype = numpy.dtype('complex64' if single else 'complex128')
+
+        self.t = []
+        self.error = None
+        self.thread = None
+        if V.rank != 0:
+            return
+
+        if not os.path.isdir(os.path.join(path,'omega')):
+            os.makedirs(os.path.join(path,'omega'))
+        if not os.path.isdir(os.path.join(path,'t')):
+            os.makedirs(os.path.join(path,'t'))
+        _write_json(os.path.join(path,'.zgroup'),{'zarr_format': 2})
+        _write_json(os.path.join(path,'.zattrs'),
+                    {'nx': V.nx, 'ny': V.ny, 'Lx': V.Lx, 'Ly': V.Ly,
+                     'Re': V.Re, 'CFL': V.CFL, 'rfft': V.rfft,
+                     'physical': physical, 'batch': list(V.batch)})
+
+        if os.path.exists(os.path.join(path,'omega','.zarray')):
+            self.t = [t for t in SnapshotReader(path).t
+                      if numpy.all(t <= numpy.ravel(V.t))]
+
+        self.queue = Queue.Queue(maxsize)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        return len(self.t)
+
+    def write(self):
+        """
+        Queues a snapshot of the current state of the solver
+        """
+        if self.error is not None:
+            raise self.error
+        p = self.V.profiler
+        if p is not None:
+            start = p.clock()
+        if self.batch:
+            t = numpy.ravel(self.V.t).copy()
+        else:
+            t = float(self.V.t)
+        omega_hat = self.V.gather_spectrum(self.V.omega_hat)
+        if self.thread is not None:
+            if omega_hat is self.V.omega_hat:
+                omega_hat = omega_hat.copy()
+            self.queue.put((t,omega_hat))
+        if p is not None:
+            p.mark('snapshot',start)
+
+    def flush(self):
+        """
+        Waits until the queued snapshots are on disk
+        """
+        if self.thread is None:
+            return
+        self.queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Waits until all the snapshots are on disk
+        """
+        if self.thread is None:
+            return
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            if self.error is None:
+                try:
+                    self._store(*item)
+                except Exception as err:
+                    self.error = err
+            self.queue.task_done()
+
+    def _store(self,t,omega_hat):
+        if self.physical:
+            data = self.transform.backward(omega_hat)
+        else:
+            data = omega_hat
+        data = numpy.ascontiguousarray(data,dtype=self.dtype).tostring()
+        if self.level:
+            data = zlib.compress(data,self.level)
+
+        n = len(self.t)
+        chunk = open(os.path.join(self.path,'omega',
+                                  _chunk_key(n,self.shape)),'wb')
+        chunk.write(data)
+        chunk.close()
+
+        # The array of times is small, rewritten at every snapshot
+        self.t.append(t)
+        chunk = open(os.path.join(self.path,'t',
+                                  _chunk_key(0,self.batch)),'wb')
+        chunk.write(numpy.array(self.t,dtype='float64').tostring())
+        chunk.close()
+
+        tshape = (n+1,)+self.batch
+        _write_json(os.path.join(self.path,'t','.zarray'),
+                    _zarray(tshape,tshape,'float64',0))
+        _write_json(os.path.join(self.path,'omega','.zarray'),
+                    _zarray((n+1,)+self.shape,(1,)+self.shape,
+                            self.dtype,self.level))
+
+
+class SnapshotReader(object):
+    """
+    Reads the snapshots written by SnapshotWriter in *path*.
+    Snapshots are accessed by index, and the attributes of the run
+    are in *attrs*.
+
+    Example.
+    R = SnapshotReader('/data/tur2d/run.zarr')
+    pylab.contourf(R[-1])
+    """
+    def __init__(self,path):
+        self.path = path
+        self.attrs = _read_json(os.path.join(path,'.zattrs'))
+        self.meta = _read_json(os.path.join(path,'omega','.zarray'))
+        self.shape = tuple(self.meta['shape'][1:])
+        self.dtype = numpy.dtype(str(self.meta['dtype']))
+        self.batch = tuple(self.attrs.get('batch',()))
+
+    @property
+    def t(self):
+        """Time of each snapshot"""
+        t = numpy.fromfile(os.path.join(self.path,'t',
+                                        _chunk_key(0,self.batch)),
+                           dtype='float64')
+        return t.reshape((-1,)+self.batch)[:len(self)]
+
+    def __len__(self):
+        return self.meta['shape'][0]
+
+    def __getitem__(self,i):
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('snapshot index out of range')
+
+        chunk = open(os.path.join(self.path,'omega',
+                                  _chunk_key(i,self.shape)),'rb')
+        data = chunk.read()
+        chunk.close()
+        if self.meta['compressor'] is not None:
+            data = zlib.decompress(data)
+        return numpy.frombuffer(data,dtype=self.dtype).reshape(self.shape)
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter sweeps of the 2D turbulence solver.
+
+Every combination of the given Reynolds numbers, CFL numbers, box
+sizes and initial conditions is a run, and the runs are distributed
+over a pool of processes. Each worker uses a fixed number of threads,
+so *processes* times *threads* should not exceed the number of
+cores. The variables of the threading libraries are set in the
+workers before they import the solver, numpy and the Fortran module,
+so the process that calls :func:`sweep` should not have imported them
+either.
+
+The result of every run is appended to a CSV table as soon as it
+finishes. If the table already exists the runs that are in it are not
+computed again, so an interrupted sweep continues where it stopped.
+A run is identified by its parameters, the number of steps and the
+keyword arguments of the solver.
+
+Example.
+sweep('sweep.csv',Re=[1000,5000,10000],CFL=[0.1,0.2],Lx=[1.0,2.0],
+      initial=['soup','kh'],nsteps=500,processes=4)
+"""
+
+from __future__ import division
+import os
+import csv
+import itertools
+import multiprocessing
+from datetime import datetime
+
+# Initial conditions available by name, functions of turbulence
+initial_conditions = {'soup': 'vortex_soup',
+                      'kh': 'shear_layers'}
+
+keys = ['Re','CFL','Lx','Ly','initial','nsteps','solver']
+columns = keys+['nx','ny','t','energy','enstrophy','seconds','status']
+
+_threads = 1
+
+
+def _pin_threads(threads):
+    """Initializer of the workers"""
+    global _threads
+    _threads = threads
+    for var in ('OMP_NUM_THREADS','MKL_NUM_THREADS','OPENBLAS_NUM_THREADS'):
+        os.environ[var] = str(threads)
+
+
+def _text(value):
+    """
+    Value of a parameter as written in the table, the keyword
+    arguments of the solver sorted by name.
+    """
+    if isinstance(value,dict):
+        return ';'.join('{}={}'.format(key,value[key])
+                        for key in sorted(value))
+    return str(value)
+
+
+def run_id(params):
+    """
+    String that identifies a run in the results table
+    """
+    return ','.join(_text(params[key]) for key in keys)
+
+
+def run(params):
+    """
+    Runs a single point of the sweep. *params* is a dictionary with
+    the keys Re, CFL, Lx, Ly, initial and nsteps, and optionally
+    solver, a dictionary of keyword arguments for the solver. Returns
+    a row of the results table.
+    """
+    # After _pin_threads, the libraries read the variables when they
+    # are loaded
+    import numpy
+    import turbulence
+
+    params = dict(params,solver=params.get('solver',{}))
+    # Same text as in the table, see run_id
+    row = dict((key,_text(params[key])) for key in keys)
+    row['status'] = 'ok'
+    tstamp = datetime.now()
+    try:
+        V = turbulence.Vorticity2DSerial(params['Lx'],params['Ly'],
+                                         params['Re'],params['CFL'],
+                                         threads=_threads,
+                                         **params['solver'])
+        initial = getattr(turbulence,initial_conditions[params['initial']])
+        V.set_initial(initial(V,params['Lx'],params['Ly']))
+        for i in range(params['nsteps']):
+            V.step()
+        V.cleanup()
+
+        u,v = V.velocities()
+        omega = V.omega
+        # Python numbers, unpickling numpy ones imports numpy in the
+        # parent
+        row.update(nx=int(V.nx),ny=int(V.ny),t=float(V.t),
+                   energy=float(0.5*numpy.mean(u**2+v**2)),
+                   enstrophy=float(0.5*numpy.mean(omega**2)))
+    except Exception as err:
+        row['status'] = 'error: {}'.format(err)
+
+    row['seconds'] = (datetime.now()-tstamp).total_seconds()
+    return row
+
+
+def completed(results):
+    """
+    Identifiers of the runs already in the table *results*
+    """
+    if not os.path.exists(results):
+        return set()
+
+    table = open(results,'rb')
+    done = set(run_id(row) for row in csv.DictReader(table)
+               if row['status'] == 'ok')
+    table.close()
+    return done
+
+
+def sweep(results,Re,CFL,Lx,Ly=None,initial=('soup',),nsteps=100,
+          processes=None,threads=1,solver=None):
+    """
+    Runs all the combinations of *Re*, *CFL*, *Lx*, *Ly* and
+    *initial* for *nsteps* steps and appends the results to the CSV
+    file *results*. If *Ly* is None the box is square.
+
+    *processes* is the size of the pool, by default the number of
+    cores divided by *threads*, the threads of each worker. *solver*
+    is a dictionary of keyword arguments for Vorticity2DSerial.
+
+    Returns the rows computed in this call.
+    """
+    if processes is None:
+        processes = max(1,multiprocessing.cpu_count()//threads)
+
+    if Ly is None:
+        boxes = [(l,l) for l in Lx]
+    else:
+        boxes = list(itertools.product(Lx,Ly))
+
+    if os.path.exists(results):
+        table = open(results,'rb')
+        header = next(csv.reader(table),None)
+        table.close()
+        if header is not None and header != columns:
+            raise ValueError('{} has other columns, {}'.format(
+                    results,header))
+
+    done = completed(results)
+    points = []
+    for re,cfl,(lx,ly),ic in itertools.product(Re,CFL,boxes,initial):
+        params = {'Re': re, 'CFL': cfl, 'Lx': lx, 'Ly': ly,
+                  'initial': ic, 'nsteps': nsteps, 'solver': solver or {}}
+        if run_id(params) not in done:
+            points.append(params)
+
+    print 'Sweep:',len(points),'runs to do,',len(done),'already done'
+
+    new = not os.path.exists(results)
+    table = open(results,'ab')
+    writer = csv.DictWriter(table,columns)
+    if new:
+        writer.writeheader()
+
+    rows = []
+    pool = multiprocessing.Pool(processes,_pin_threads,(threads,))
+    try:
+        for row in pool.imap_unordered(run,points):
+            writer.writerow(row)
+            table.flush()
+            rows.append(row)
+            print run_id(row),row['status'],row['seconds']
+    finally:
+        pool.terminate()
+        table.close()
+
+    return rows
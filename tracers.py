@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+Passive tracers of the 2D turbulence solver.
+
+The tracers are advected with the classical fourth order Runge Kutta,
+with the velocities that the solver computes at each of its four
+substeps, at t, t+dt/2, t+dt/2 and t+dt, so no additional transforms
+are needed. The velocities are interpolated at the positions of the
+tracers with the periodic cubic convolution of Keys, on a stencil of
+4x4 points, or bilinearly on 2x2 points. All the tracers are
+interpolated at once, with a gather of each row of the stencil.
+
+The positions are kept as two arrays, *x* and *y*, and they are not
+wrapped into the box, so the displacements are continuous. The grid
+is the periodic one, x = -Lx/2+i*Lx/nx.
+
+The trajectories can be written to a directory with the layout of a
+zarr (version 2) group, with the arrays *t*, *x* and *y*. The
+positions are kept in memory by chunks of *chunk* samples, a chunk
+is written when it is full. :func:`load` reads them back.
+
+Example.
+V = Vorticity2D(2.0,2.0,10000,0.2)
+x,y = numpy.random.uniform(-1,1,(2,10**5))
+V.tracers = Tracers(V,x,y,'/data/tur2d/tracers.zarr',every=10)
+for i in range(nsteps):
+    V.step()
+V.tracers.close()
+"""
+
+from __future__ import division
+import os
+import shutil
+import tempfile
+import numpy
+from snapshots import _write_json, _read_json, _chunk_key, _zarray
+
+
+def keys(t):
+    """
+    Weights of the cubic convolution of Keys for the points -1, 0, 1
+    and 2 at the fractions *t* of the interval [0,1).
+    """
+    t2 = t*t
+    t3 = t2*t
+    return numpy.array([(-t3+2*t2-t)/2,
+                        (3*t3-5*t2+2)/2,
+                        (-3*t3+4*t2+t)/2,
+                        (t3-t2)/2]).T
+
+
+def linear(t):
+    """Weights of the bilinear interpolation for the points 0 and 1"""
+    return numpy.array([1-t,t]).T
+
+
+stencils = {'cubic': (numpy.arange(-1,3),keys),
+            'linear': (numpy.arange(0,2),linear)}
+
+
+class Tracers(object):
+    """
+    Tracers of the solver *V* at the positions *x*, *y*. *method* is
+    the interpolation, 'cubic' or 'linear'. If *path* is given the
+    positions are written there every *every* steps, in single
+    precision if *single*, in chunks of *chunk* samples.
+
+    Assign it to V.tracers, the solver calls :meth:`stage` at each
+    substep. Only solvers with a single field in one process are
+    supported.
+    """
+    # Fraction of the step of each stage and weight of its velocity
+    c = numpy.array([0,1/2,1/2,1])
+    b = numpy.array([1/6,1/3,1/3,1/6])
+
+    def __init__(self,V,x,y,path=None,method='cubic',every=1,chunk=16,
+                 single=True):
+        if V.batch or V.backend.physical_shape != (V.ny,V.nx):
+            raise ValueError('Tracers of a single field in one process')
+        self.x = numpy.array(x,dtype='float64').ravel()
+        self.y = numpy.array(y,dtype='float64').ravel()
+        if self.x.shape != self.y.shape:
+            raise ValueError('x and y must have the same size')
+        self.n = len(self.x)
+        self.nx,self.ny = V.nx,V.ny
+        self.x0 = -V.Lx/2
+        self.y0 = -V.Ly/2
+        self.dx = V.Lx/V.nx
+        self.dy = V.Ly/V.ny
+        self.offsets,self.weights = stencils[method]
+        self.method = method
+
+        # Positions of the stage and sum of the velocities
+        self.xs = self.x.copy()
+        self.ys = self.y.copy()
+        self.ax = numpy.zeros(self.n)
+        self.ay = numpy.zeros(self.n)
+
+        self.path = path
+        self.every = every
+        self.t = []
+        if path is not None:
+            self.dtype = numpy.dtype('float32' if single else 'float64')
+            self.buffer = numpy.empty((2,chunk,self.n),dtype=self.dtype)
+            self.filled = 0
+            for name in ('x','y','t'):
+                if not os.path.isdir(os.path.join(path,name)):
+                    os.makedirs(os.path.join(path,name))
+            _write_json(os.path.join(path,'.zgroup'),{'zarr_format': 2})
+            _write_json(os.path.join(path,'.zattrs'),
+                        {'Lx': V.Lx, 'Ly': V.Ly, 'nx': V.nx, 'ny': V.ny,
+                         'method': method, 'every': every,
+                         'ntracers': self.n})
+            self.sample(V.t)
+
+    def interpolate(self,u,x,y):
+        """
+        Values of the fields of the list *u* at the positions *x*, *y*
+        """
+        fx = (x-self.x0)/self.dx
+        fy = (y-self.y0)/self.dy
+        i = numpy.floor(fx)
+        j = numpy.floor(fy)
+        wx = self.weights(fx-i)
+        wy = self.weights(fy-j)
+        cols = numpy.mod(i.astype('int64')[:,numpy.newaxis]+self.offsets,
+                         self.nx)
+        rows = numpy.mod(j.astype('int64')[:,numpy.newaxis]+self.offsets,
+                         self.ny)*self.nx
+
+        flat = [numpy.ascontiguousarray(field).ravel() for field in u]
+        out = [numpy.zeros(len(x)) for field in u]
+        for m in range(len(self.offsets)):
+            index = rows[:,m:m+1]+cols
+            for field,values in zip(flat,out):
+                values += wy[:,m]*numpy.einsum(
+                    'ij,ij->i',numpy.take(field,index),wx)
+        return out
+
+    def stage(self,V,i,u,v):
+        """
+        Stage *i* of the Runge Kutta of the tracers, with the
+        velocities *u*, *v* of the substep *i* of the solver *V*.
+        """
+        dt = V.dt
+        ku,kv = self.interpolate((u,v),self.xs,self.ys)
+        if i == 0:
+            numpy.multiply(ku,self.b[0],out=self.ax)
+            numpy.multiply(kv,self.b[0],out=self.ay)
+        else:
+            self.ax += self.b[i]*ku
+            self.ay += self.b[i]*kv
+
+        if i < 3:
+            # Position of the next stage
+            numpy.multiply(ku,self.c[i+1]*dt,out=self.xs)
+            numpy.multiply(kv,self.c[i+1]*dt,out=self.ys)
+            self.xs += self.x
+            self.ys += self.y
+        else:
+            self.x += dt*self.ax
+            self.y += dt*self.ay
+            self.xs[...] = self.x
+            self.ys[...] = self.y
+            if self.path is not None and (V.nstep+1)%self.every == 0:
+                self.sample(V.t+dt)
+
+    def sample(self,t):
+        """Adds the positions at the time *t* to the trajectories"""
+        self.t.append(float(t))
+        self.buffer[0,self.filled] = self.x
+        self.buffer[1,self.filled] = self.y
+        self.filled += 1
+        if self.filled == self.buffer.shape[1]:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the chunk of positions being filled. It is written
+        again until it is full.
+        """
+        if self.path is None:
+            return
+        chunk = self.buffer.shape[1]
+        nchunk = (len(self.t)-self.filled)//chunk
+        data = self.buffer.copy()
+        data[:,self.filled:] = numpy.nan
+        for name,part in zip(('x','y'),data):
+            chunkfile = open(os.path.join(self.path,name,
+                                          _chunk_key(nchunk,(self.n,))),'wb')
+            chunkfile.write(part.tostring())
+            chunkfile.close()
+            _write_json(os.path.join(self.path,name,'.zarray'),
+                        _zarray((len(self.t),self.n),(chunk,self.n),
+                                self.dtype,0))
+
+        chunkfile = open(os.path.join(self.path,'t',_chunk_key(0,())),'wb')
+        chunkfile.write(numpy.array(self.t,dtype='float64').tostring())
+        chunkfile.close()
+        _write_json(os.path.join(self.path,'t','.zarray'),
+                    _zarray((len(self.t),),(len(self.t),),'float64',0))
+        if self.filled == chunk:
+            self.filled = 0
+
+    def close(self):
+        """Writes the positions that are still in memory"""
+        if self.path is not None and self.filled:
+            self.flush()
+
+
+def load(path):
+    """
+    Times and positions of the trajectories written by Tracers in
+    *path*. The positions are arrays with a row per sample.
+    """
+    meta = _read_json(os.path.join(path,'x','.zarray'))
+    nsamples,n = meta['shape']
+    chunk = meta['chunks'][0]
+    dtype = numpy.dtype(str(meta['dtype']))
+    t = numpy.fromfile(os.path.join(path,'t',_chunk_key(0,())),
+                       dtype='float64')[:nsamples]
+    positions = []
+    for name in ('x','y'):
+        parts = [numpy.fromfile(os.path.join(path,name,
+                                             _chunk_key(k,(n,))),dtype=dtype)
+                 for k in range(-(-nsamples//chunk))]
+        positions.append(numpy.concatenate(parts).reshape(-1,n)[:nsamples])
+    return t,positions[0],positions[1]
+
+
+def test_tracers(L=2.0,Re=10000,nsteps=50,CFL=0.2):
+    """
+    Tracers in the shear flow of vorticity cos(k*x), a steady solution
+    of the Euler equations that decays with the viscosity, with
+    v = sin(k*x)*exp(-k**2*t/Re)/k. A tracer moves in y only, by the
+    integral of v. Checks the positions, the interpolation and the
+    trajectories written to disk, for the low storage Runge Kutta
+    and an exponential integrator.
+    """
+    import turbulence
+    import initial
+
+    k = 2*numpy.pi/L
+    numpy.random.seed(5)
+    x,y = numpy.random.uniform(-L,L,(2,1000))
+    for integrator in ('rk4','etdrk4'):
+        V = turbulence.Vorticity2D(L,L,Re,CFL,integrator=integrator)
+        xg,yg = initial.grid(V,L,L,periodic=True)
+        V.set_initial(numpy.cos(k*xg)[numpy.newaxis,:]+0*yg[:,numpy.newaxis])
+
+        # Interpolation of a smooth field
+        u,v = V.velocities()
+        for method,tol in (('cubic',1e-5),('linear',5e-4)):
+            T = Tracers(V,x,y,method=method)
+            vi = T.interpolate((v,),x,y)[0]
+            error = numpy.abs(vi-numpy.sin(k*x)/k).max()
+            print method,'interpolation error:',error
+            assert error < tol
+
+        path = tempfile.mkdtemp()
+        try:
+            V.tracers = Tracers(V,x,y,path,every=3,chunk=4,single=False)
+            for i in range(nsteps):
+                V.step()
+                if V.nstep%3 == 0:
+                    last = V.t,V.tracers.y.copy()
+            V.tracers.close()
+            shift = numpy.sin(k*x)/k*Re/k**2*(1-numpy.exp(-k**2*V.t/Re))
+            error = numpy.abs(V.tracers.y-y-shift).max()
+            print integrator,'position error after',V.t,':',error
+            assert numpy.abs(V.tracers.x-x).max() < 1e-12
+            assert error < 1e-5
+
+            t,xt,yt = load(path)
+            assert len(t) == nsteps//3+1 and t[0] == 0
+            assert numpy.all(yt[0] == y) and numpy.all(xt == x)
+            assert t[-1] == last[0] and numpy.all(yt[-1] == last[1])
+            assert numpy.all(numpy.diff(t) > 0)
+        finally:
+            shutil.rmtree(path)
+
+
+def bench_tracers(L=4.0,counts=(10**3,10**4,10**5,10**6),nsteps=5,
+                  method='cubic',Re=10000,CFL=0.2,**kwargs):
+    """
+    Cost per step of the tracers on the vortex soup, as a function of
+    the number of tracers, interpolated with *method*. Keyword
+    arguments are passed to the solver.
+    """
+    import turbulence
+    from profiling import Profiler
+
+    V = turbulence.Vorticity2D(L,L,Re,CFL,**kwargs)
+    V.set_initial(turbulence.vortex_soup(V,L,L))
+    V.step()
+    base = turbulence.time_steps(V,nsteps)
+    print 'Grid',V.nx,'x',V.ny,'without tracers:',base,'s per step'
+    results = {0: base}
+    for n in counts:
+        x,y = numpy.random.uniform(-L/2,L/2,(2,n))
+        V.tracers = Tracers(V,x,y,method=method)
+        V.profiler = Profiler()
+        results[n] = turbulence.time_steps(V,nsteps)
+        tracers = V.profiler.summary()['tracers']['total']/nsteps
+        print '{:>8} tracers: {:.4f} s per step, {:.4f} s in tracers, '\
+            '{:.3f} us per tracer'.format(n,results[n],tracers,1e6*tracers/n)
+        V.profiler = None
+    V.tracers = None
+    return results
@@ -2,15 +2,71 @@
 
 
 from __future__ import division
+import os
+import json
+import shutil
+import tempfile
+import ctypes
+import ctypes.util
 import numpy
 from datetime import datetime
+from fftbackend import get_backend, SlabFFT
+from snapshots import SnapshotWriter
+from integrators import get_integrator
+import initial
 
 try:
     from rhs_tur2d import rhs_tur2d
-    print "Imported the Fortran implementation of the right hand side"
-except ImportError as err:
-    print "Extension module not successfully imported"
-    print err
+except ImportError:
+    # Vorticity2DSerial falls back to the Python right hand side
+    rhs_tur2d = None
+
+try:
+    import rhs_numba
+except ImportError:
+    # Only the numpy kernels of the right hand side
+    rhs_numba = None
+
+class Workspace(object):
+    """
+    Work arrays used by the right hand side and the Runge Kutta
+    update. They are allocated once, when the solver is created, and
+    every substep writes on them in place.
+    """
+    def __init__(self,spectral,physical,order='C',zeros=numpy.zeros,
+                 dtype='complex',transforms=True):
+        """
+        *spectral* and *physical* are the shapes of the arrays in
+        Fourier and physical space. *order* is the memory layout,
+        'F' if the arrays are passed to Fortran. *zeros* allocates
+        the arrays, the FFT backend may require them to be aligned.
+        *dtype* is the type of the spectral arrays, the physical ones
+        are real of the same precision. If not *transforms* the
+        results of the transforms, u, v, ox, oy and conv_hat, are not
+        allocated, they are the arrays returned by the backend.
+        """
+        real = numpy.finfo(dtype).dtype
+        self.psi_hat = zeros(spectral,dtype=dtype,order=order)
+        self.u_hat = zeros(spectral,dtype=dtype,order=order)
+        self.v_hat = zeros(spectral,dtype=dtype,order=order)
+        self.ox_hat = zeros(spectral,dtype=dtype,order=order)
+        self.oy_hat = zeros(spectral,dtype=dtype,order=order)
+        self.conv = zeros(physical,dtype=real,order=order)
+        if transforms:
+            self.conv_hat = zeros(spectral,dtype=dtype,order=order)
+            self.u = zeros(physical,dtype=real,order=order)
+            self.v = zeros(physical,dtype=real,order=order)
+            self.ox = zeros(physical,dtype=real,order=order)
+            self.oy = zeros(physical,dtype=real,order=order)
+        else:
+            self.conv_hat = self.u = self.v = self.ox = self.oy = None
+
+    @property
+    def nbytes(self):
+        """Memory used by the work arrays"""
+        return sum(a.nbytes for a in self.__dict__.values()
+                   if a is not None)
+
 
 class Vorticity2D(object):
     """                                                    
@@ -21,7 +77,14 @@ class Vorticity2D(object):
     Modified version in Matlab by Guillem Borrell, May 23rd 2011
     Ported to Python by Guillem Borrell, December 30th 2011 
     """ 
-    def __init__(self,Lx,Ly,Re,CFL):
+    # Leading dimensions of the fields, empty for a single realization
+    batch = ()
+    # Process of a distributed solver that writes the output
+    rank = 0
+
+    def __init__(self,Lx,Ly,Re,CFL,rfft=False,
+                 backend='numpy',threads=1,wisdom=None,single=False,
+                 integrator='rk4',kernels='numpy'):
         """
         The constructor takes the following arguments
               
@@ -36,9 +99,48 @@ class Vorticity2D(object):
         
           *CFL*: float
             CFL number for temporal integration
+
+          *rfft*: bool
+            If True only half of the spectrum is stored, since the
+            vorticity is real, and real to complex transforms are
+            used. Defaults to False.
+
+          *backend*: string
+            FFT library, 'numpy', 'scipy' or 'pyfftw'. Falls back to
+            numpy if the library is not available.
+
+          *threads*: int
+            Number of threads of the FFT backend
+
+          *wisdom*: string
+            File to load and store the FFTW wisdom with the pyfftw
+            backend.
+
+          *single*: bool
+            Single precision fields and operators, complex64 and
+            float32. Half the memory and bandwidth, for exploratory
+            runs. The time is always double precision. Defaults to
+            False.
+
+          *integrator*: string
+            Time integrator, 'rk4' for the low storage Runge Kutta,
+            'ifrk4' or 'etdrk4' to integrate the viscous term exactly,
+            see the module integrators. Defaults to 'rk4'.
+
+          *kernels*: string
+            Operations of the right hand side besides the transforms,
+            'numpy' or 'numba' for the compiled loops of the module
+            rhs_numba. Falls back to numpy if Numba is not available.
+            Defaults to 'numpy'.
         """
+        self.Lx = Lx
+        self.Ly = Ly
         self.Re = Re
+        self.rfft = rfft
         self.CFL = CFL
+        self.single = single
+        self.dtype = numpy.dtype('complex64' if single else 'complex128')
+        self.real_dtype = numpy.finfo(self.dtype).dtype
         # Estimate the Kolmogorov scale in the 2D turbulence: 
         # eta = cte/sqrt(Re) 
         nx = 2*numpy.round(0.64*Lx*numpy.sqrt(Re)/2)  # x-modes
@@ -53,142 +155,686 @@ class Vorticity2D(object):
         self.b   = numpy.array([0,1/6,1/3,1/3,1/6])
         self.a   = numpy.array([0,1/2,1/2,1])
         self.dtv = CFL*self.dl**2*Re
+        # Largest timestep
+        self.dtmax = 0.5
         
-        self.kx,self.ky = numpy.meshgrid(
-            numpy.mod(numpy.arange(1,nx+1)-numpy.ceil(nx/2+1),nx)-\
-                numpy.floor(nx/2),
-            numpy.mod(numpy.arange(1,ny+1)-numpy.ceil(ny/2+1),ny)-\
-                numpy.floor(ny/2))
+        kx = numpy.mod(numpy.arange(1,nx+1)-numpy.ceil(nx/2+1),nx)-\
+            numpy.floor(nx/2)
+        ky = numpy.mod(numpy.arange(1,ny+1)-numpy.ceil(ny/2+1),ny)-\
+            numpy.floor(ny/2)
+        if rfft:
+            # Hermitian symmetry. Only the kx >= 0 modes are stored
+            kx = numpy.abs(kx[:int(nx)//2+1])
+
+        # Useful to create initial conditions
+        self.nx = int(nx)
+        self.ny = int(ny)
+
+        # A distributed backend only stores some of the columns of
+        # the spectrum and some of the rows of the physical field.
+        physical = self.batch+(self.ny,self.nx)
+        self.backend = self._make_backend(backend,physical,threads,wisdom)
+        print 'FFT backend:',self.backend.name,'threads:',\
+            self.backend.threads
+        kx = kx[self.backend.columns]
+
+        self.kx,self.ky = numpy.meshgrid(kx,ky)
 
         self.kx = self.kx*2*numpy.pi/Lx
         self.ky = self.ky*2*numpy.pi/Ly
         self.Lap = -(self.kx**2+self.ky**2)
         self.poisson = self.Lap
-        self.poisson[0,0] = 1
+        self.poisson[self.Lap == 0] = 1
         self.dealias = numpy.logical_and(
             numpy.less(numpy.abs(self.kx*Lx/(2*numpy.pi)),nx/3),
             numpy.less(numpy.abs(self.ky*Ly/(2*numpy.pi)),ny/3))
+
+        # Operators in the precision of the fields
+        self.kx = self.kx.astype(self.real_dtype,copy=False)
+        self.ky = self.ky.astype(self.real_dtype,copy=False)
+        self.Lap = self.Lap.astype(self.real_dtype,copy=False)
+        self.poisson = self.Lap
             
         self.t = 0
         self.dt = 0
-        self.omega_hat = numpy.zeros(self.dealias.shape,dtype='complex')
-        self.S1 = numpy.zeros(self.omega_hat.shape,dtype='complex')
-        
-        # Useful to create initial conditions
-        self.nx = int(nx)
-        self.ny = int(ny)
+        self.nstep = 0
+        # Optional diagnostics.Diagnostics, sampled at every step
+        self.diagnostics = None
+        # Optional tracers.Tracers, advected at every substep
+        self.tracers = None
+        # Optional profiling.Profiler, times the phases of the step
+        self.profiler = None
+        # Fields in physical space of the current omega_hat
+        self._fields = {}
+        spectral = self.batch+self.dealias.shape
+        self.omega_hat = numpy.zeros(spectral,dtype=self.dtype)
+        self.S1 = numpy.zeros(spectral,dtype=self.dtype)
+
+        # Derivative operators and work arrays for the right hand side
+        self.ikx = 1j*self.kx
+        self.iky = 1j*self.ky
+        self.work = Workspace(spectral,self.backend.physical_shape,
+                              zeros=self.backend.zeros,dtype=self.dtype,
+                              transforms=self.backend.inplace)
+        self.integrator = get_integrator(integrator,self)
+        self.kernels = self._make_kernels(kernels)
+
+    def _make_backend(self,backend,shape,threads,wisdom):
+        """FFT backend for fields of *shape*, see fftbackend"""
+        return get_backend(backend,shape,self.rfft,threads,wisdom=wisdom,
+                           single=self.single)
+
+    def _make_kernels(self,kernels):
+        """Kernels of the right hand side, None for numpy"""
+        if kernels not in ('numpy','numba'):
+            raise ValueError('Unknown kernels {}'.format(kernels))
+        if kernels == 'numba' and rhs_numba is None:
+            print 'Numba not available. Using the numpy kernels'
+        if kernels == 'numpy' or rhs_numba is None:
+            return None
+        return rhs_numba.Kernels(self)
+
+    def allreduce(self,a,op='sum'):
+        """
+        Reduction of *a* with *op*, 'sum' or 'max', over all the
+        parts of a distributed solver. Returns *a* for any other.
+        """
+        return a
+
+    def gather_spectrum(self,a_hat):
+        """
+        Whole spectrum *a_hat* in rank 0 and None in the rest of the
+        processes of a distributed solver. Returns *a_hat* for any
+        other.
+        """
+        return a_hat
 
-    def set_initial(self,omega):
+    def set_initial(self,omega,spectral=False):
         """
         Set initial vorticity field once the instance has been created.
         Make sure that the array is (self.nx,self.ny) shaped or you
-        will be on serious trouble. 
+        will be on serious trouble. If *spectral* *omega* is already
+        the spectrum, with the shape of self.omega_hat.
         """
-        self.omega_hat = numpy.fft.fft2(omega)
-        self.omega_hat = self.dealias*self.omega_hat
-            
+        if spectral:
+            omega_hat = omega
+        else:
+            omega_hat = self.fft2(omega)
+        self.omega_hat = numpy.asarray(self.dealias*omega_hat,
+                                       dtype=self.dtype)
+        self.invalidate()
+
+    def fft2(self,a,out=None):
+        """
+        Forward transform of the real field *a*. Returns the half
+        spectrum if the instance was created with *rfft*. The result
+        is written on *out* if given and the backend transforms in
+        place, use the returned array.
+        """
+        if not self.backend.inplace:
+            out = None
+        if self.profiler is None:
+            return self.backend.forward(a,out)
+        start = self.profiler.clock()
+        out = self.backend.forward(a,out)
+        self.profiler.mark('fft',start)
+        return out
+
+    def ifft2(self,a_hat,out=None):
+        """
+        Inverse transform of the spectral field *a_hat*. Only the real
+        part is returned, and written on *out* if given and the
+        backend transforms in place.
+        """
+        if not self.backend.inplace:
+            out = None
+        if self.profiler is None:
+            return self.backend.backward(a_hat,out)
+        start = self.profiler.clock()
+        out = self.backend.backward(a_hat,out)
+        self.profiler.mark('ifft',start)
+        return out
 
     def FW(self):
         """
-        Solve the right hand side, both linear and nonlinear terms
+        Solve the right hand side, both linear and nonlinear terms.
+
+        The result overwrites *self.S1* and the velocities are
+        arrays of the workspace, copy them if you want to keep them.
+        """
+        w = self.convection()
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        if self.kernels is not None:
+            self.kernels.viscous(self.S1,w)
+        else:
+            numpy.multiply(self.Lap,self.S1,out=self.S1)
+            numpy.divide(self.S1,self.Re,out=self.S1)
+            numpy.subtract(self.S1,w.conv_hat,out=self.S1)
+        if p is not None:
+            p.mark('viscous',start)
+        
+        return (self.S1,w.u,w.v)
+
+    def nonlinear(self):
+        """
+        Nonlinear term of the right hand side, without the viscous
+        term. Same as FW otherwise.
         """
+        w = self.convection()
+        numpy.negative(w.conv_hat,out=self.S1)
+        return (self.S1,w.u,w.v)
+
+    def convection(self):
+        """
+        Dealiased convective term of the vorticity in *self.S1* on
+        conv_hat of the workspace, and the velocities on u and v.
+        Returns the workspace.
+        """
+        w = self.work
+        if self.kernels is not None:
+            return self._convection_kernels(w)
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        
         # Solve poisson equation for psi
-        psi_hat = -self.S1/self.poisson
+        numpy.divide(self.S1,self.poisson,out=w.psi_hat)
+        numpy.negative(w.psi_hat,out=w.psi_hat)
         
         # compute u,v
-        u_hat = 1j*self.ky*psi_hat
-        v_hat = -1j*self.kx*psi_hat
+        numpy.multiply(self.iky,w.psi_hat,out=w.u_hat)
+        numpy.multiply(self.ikx,w.psi_hat,out=w.v_hat)
+        numpy.negative(w.v_hat,out=w.v_hat)
+        numpy.multiply(self.ikx,self.S1,out=w.ox_hat)
+        numpy.multiply(self.iky,self.S1,out=w.oy_hat)
+        if p is not None:
+            p.mark('spectral',start)
         
         # convective terms
-        u       = numpy.fft.ifft2(u_hat).real
-        v       = numpy.fft.ifft2(v_hat).real
-        omega_x = numpy.fft.ifft2(1j*self.kx*self.S1).real
-        omega_y = numpy.fft.ifft2(1j*self.ky*self.S1).real
-        conv    = u*omega_x + v*omega_y
-        conv_hat = numpy.fft.fft2(conv)
-        conv_hat = self.dealias*conv_hat
-        
-        return (self.Lap*self.S1/self.Re-conv_hat,u,v)
+        w.u = self.ifft2(w.u_hat,out=w.u)
+        w.v = self.ifft2(w.v_hat,out=w.v)
+        w.ox = self.ifft2(w.ox_hat,out=w.ox)
+        w.oy = self.ifft2(w.oy_hat,out=w.oy)
+        if p is not None:
+            start = p.clock()
+        numpy.multiply(w.u,w.ox,out=w.conv)
+        numpy.multiply(w.v,w.oy,out=w.ox)
+        numpy.add(w.conv,w.ox,out=w.conv)
+        if p is not None:
+            p.mark('product',start)
+        w.conv_hat = self.fft2(w.conv,out=w.conv_hat)
+        if p is not None:
+            start = p.clock()
+        numpy.multiply(self.dealias,w.conv_hat,out=w.conv_hat)
+        if p is not None:
+            p.mark('dealias',start)
+        return w
+
+    def _convection_kernels(self,w):
+        """convection with the compiled kernels"""
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        self.kernels.spectral(self.S1,w)
+        if p is not None:
+            p.mark('spectral',start)
+        w.u = self.ifft2(w.u_hat,out=w.u)
+        w.v = self.ifft2(w.v_hat,out=w.v)
+        w.ox = self.ifft2(w.ox_hat,out=w.ox)
+        w.oy = self.ifft2(w.oy_hat,out=w.oy)
+        if p is not None:
+            start = p.clock()
+        self.kernels.product(w)
+        if p is not None:
+            p.mark('product',start)
+        w.conv_hat = self.fft2(w.conv,out=w.conv_hat)
+        if p is not None:
+            start = p.clock()
+        self.kernels.dealias(w)
+        if p is not None:
+            p.mark('dealias',start)
+        return w
         
         
     def step(self):
+        """
+        Integrates a single time step, with :meth:`rk4` or with the
+        exponential integrator of the solver.
+        """
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        if self.integrator is not None:
+            self.integrator.step(self)
+        else:
+            self.rk4()
+        if p is not None:
+            p.mark('step',start)
+
+    def rk4(self):
         """
         Integrates a single Runge Kutta time step.
         
         It uses a fourth order low-storage RK scheme and the timestep
-        is evaluated at the first substep.
+        is evaluated at the first substep. All the operations are
+        performed in place on the arrays of the workspace.
         """
-        self.S1 = self.omega_hat+(self.a[0]-self.b[0])*self.dt*self.S1
+        self.substep(0)
         self.S1,u,v = self.FW()
-        vmax = numpy.sqrt(u**2+v**2).max()
-        self.dt = numpy.min([self.dtv,self.CFL*self.dl/vmax,0.5])
-        self.omega_hat = self.omega_hat+self.b[1]*self.dt*self.S1
+        self.dt = self.sample(u,v)
+        self.advect(0,u,v)
+        self.update(1)
+        self.invalidate()
         
         # Rest of Runge Kutta substeps
         for i in range(1,4):
-            self.S1 = self.omega_hat+(self.a[i]-self.b[i])*self.dt*self.S1
-            self.S1 = self.FW()[0]
-            self.omega_hat = self.omega_hat+self.b[i+1]*self.dt*self.S1
+            self.substep(i)
+            self.S1,u,v = self.FW()
+            self.advect(i,u,v)
+            self.update(i+1)
             
         self.t += self.dt
+        self.nstep += 1
+
+    def timestep(self,u,v):
+        """
+        Timestep limited by the viscous term and the CFL condition
+        for the velocities *u* and *v*.
+        """
+        w = self.work
+        numpy.multiply(u,u,out=w.ox)
+        numpy.multiply(v,v,out=w.oy)
+        numpy.add(w.ox,w.oy,out=w.ox)
+        vmax = numpy.sqrt(w.ox.max())
+        self.vmax = vmax
+        return numpy.min([self.dtv,self.CFL*self.dl/vmax,self.dtmax])
+
+    def sample(self,u,v):
+        """
+        Timestep for the velocities *u* and *v* at the beginning of
+        the step, that also samples the diagnostics.
+        """
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        dt = self.timestep(u,v)
+        if p is not None:
+            start = p.mark('cfl',start)
+        # The velocities of the right hand side are the ones of
+        # omega_hat until it is updated.
+        self._fields = {'velocities': (u,v)}
+        if self.diagnostics is not None:
+            self.diagnostics.record(self)
+            if p is not None:
+                p.mark('diagnostics',start)
+        return dt
+
+    def advect(self,i,u,v):
+        """
+        Stage *i* of the tracers with the velocities *u* and *v* of
+        the substep *i*, if there are tracers.
+        """
+        if self.tracers is None:
+            return
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        self.tracers.stage(self,i,u,v)
+        if p is not None:
+            p.mark('tracers',start)
+
+    def substep(self,i):
+        """
+        Vorticity at the beginning of the substep *i* on *self.S1*
+        """
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        numpy.multiply(self.S1,(self.a[i]-self.b[i])*self.dt,out=self.S1)
+        numpy.add(self.omega_hat,self.S1,out=self.S1)
+        if p is not None:
+            p.mark('rk update',start)
+
+    def update(self,i):
+        """
+        Adds the right hand side stored in *self.S1* to the vorticity
+        with the weight of the substep *i*. The array u_hat of the
+        workspace is used as temporary storage.
+        """
+        w = self.work
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        numpy.multiply(self.S1,self.b[i]*self.dt,out=w.u_hat)
+        numpy.add(self.omega_hat,w.u_hat,out=self.omega_hat)
+        if p is not None:
+            p.mark('rk update',start)
+
+    def save(self,path):
+        """
+        Saves a checkpoint in the directory *path*. The state is
+        written to a temporary directory that replaces *path* when it
+        is complete, so a job killed while saving keeps the previous
+        checkpoint. A distributed solver saves the whole spectrum,
+        written by rank 0.
+        """
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        omega_hat = self.gather_spectrum(self.omega_hat)
+        S1 = self.gather_spectrum(self.S1)
+        if self.rank != 0:
+            return
+        tmp = path+'.tmp'
+        if os.path.isdir(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+
+        numpy.save(os.path.join(tmp,'omega_hat.npy'),omega_hat)
+        numpy.save(os.path.join(tmp,'S1.npy'),S1)
+        state = {'t': numpy.asarray(self.t,dtype='float').tolist(),
+                 'dt': numpy.asarray(self.dt,dtype='float').tolist(),
+                 'nstep': self.nstep, 'batch': list(self.batch),
+                 'Lx': self.Lx, 'Ly': self.Ly, 'Re': self.Re,
+                 'CFL': self.CFL, 'nx': self.nx, 'ny': self.ny,
+                 'rfft': self.rfft, 'single': self.single,
+                 'integrator': getattr(self.integrator,'name','rk4'),
+                 'kernels': getattr(self.kernels,'name','numpy'),
+                 'backend': self.backend.name,
+                 'threads': self.backend.threads}
+        if hasattr(self,'shared_dt'):
+            state['shared_dt'] = self.shared_dt
+        statefile = open(os.path.join(tmp,'state.json'),'w')
+        json.dump(state,statefile,indent=2)
+        statefile.close()
+
+        if os.path.isdir(path):
+            os.rename(path,path+'.old')
+        os.rename(tmp,path)
+        if os.path.isdir(path+'.old'):
+            shutil.rmtree(path+'.old')
+        if p is not None:
+            p.mark('checkpoint',start)
+
+    def load(self,path):
+        """
+        Restores the checkpoint saved in *path*. The arrays are memory
+        mapped copy-on-write, they are read from disk when they are
+        used. A distributed solver takes its columns of the spectrum.
+        Raises ValueError if the checkpoint is from a different grid
+        or box.
+        """
+        statefile = open(os.path.join(path,'state.json'))
+        state = json.load(statefile)
+        statefile.close()
+
+        # Checkpoints saved before the single precision mode
+        state.setdefault('single',False)
+        for key in ('nx','ny','Lx','Ly','Re','CFL','rfft','single'):
+            if state[key] != getattr(self,key):
+                raise ValueError('Checkpoint {} is {}, solver has {}'.format(
+                        key,state[key],getattr(self,key)))
+        # The timesteps of an ensemble only continue with the same rule
+        if 'shared_dt' in state and hasattr(self,'shared_dt') and \
+                state['shared_dt'] != self.shared_dt:
+            raise ValueError('Checkpoint shared_dt is {}, solver has {}'.format(
+                    state['shared_dt'],self.shared_dt))
+
+        for name in ('omega_hat','S1'):
+            current = getattr(self,name)
+            saved = numpy.load(os.path.join(path,name+'.npy'),mmap_mode='c')
+            saved = saved[...,self.backend.columns]
+            if saved.shape != current.shape:
+                raise ValueError('Checkpoint {} has shape {}, solver {}'.format(
+                        name,saved.shape,current.shape))
+            # Keep the memory layout the right hand side expects
+            if saved.flags.c_contiguous == current.flags.c_contiguous:
+                setattr(self,name,saved)
+            else:
+                current[...] = saved
+
+        if self.batch:
+            self.t = numpy.array(state['t'])
+            self.dt = numpy.array(state['dt'])
+        else:
+            self.t = state['t']
+            self.dt = state['dt']
+        self.nstep = state['nstep']
+        if self.integrator is not None:
+            # Continue with the timestep of the tables
+            self.integrator.restart(self.dt)
+        self.invalidate()
+
+    @classmethod
+    def from_checkpoint(cls,path,**kwargs):
+        """
+        Creates a solver from the checkpoint in *path* with the same
+        parameters and FFT backend. Keyword arguments are passed to
+        the constructor.
+        """
+        statefile = open(os.path.join(path,'state.json'))
+        state = json.load(statefile)
+        statefile.close()
+
+        # The distributed transforms are the ones of Vorticity2DMPI
+        if state['backend'] != 'mpi':
+            kwargs.setdefault('backend',state['backend'])
+            kwargs.setdefault('threads',state['threads'])
+        if state.get('batch'):
+            kwargs.setdefault('nens',state['batch'][0])
+        if 'shared_dt' in state:
+            kwargs.setdefault('shared_dt',state['shared_dt'])
+        if state['rfft']:
+            kwargs['rfft'] = True
+        if state.get('single'):
+            kwargs['single'] = True
+        kwargs.setdefault('integrator',state.get('integrator','rk4'))
+        kwargs.setdefault('kernels',state.get('kernels','numpy'))
+        V = cls(state['Lx'],state['Ly'],state['Re'],state['CFL'],**kwargs)
+        V.load(path)
+        return V
 
         
+    def invalidate(self):
+        """
+        Forgets the fields in physical space computed from omega_hat.
+        step, set_initial and load call it, call it if you modify
+        omega_hat in place.
+        """
+        self._fields = {}
+
+    def _cached(self,name,compute):
+        """
+        Field *name* of the current omega_hat, computed with
+        *compute* the first time it is requested. The arrays are
+        shared, do not modify them.
+        """
+        if name not in self._fields:
+            self._fields[name] = compute()
+        return self._fields[name]
+
     @property
     def omega(self):
         """
         Transforms vorticity from Fourier to physical space to make
         pretty plots.
         """
-        return numpy.fft.ifft2(self.omega_hat).real
+        return self._cached('omega',lambda: self.ifft2(self.omega_hat))
+
+    @property
+    def psi(self):
+        """Stream function in physical space"""
+        return self._cached('psi',
+                            lambda: self.ifft2(-self.omega_hat/self.poisson))
+
+    @property
+    def u(self):
+        """Velocity in the x direction"""
+        return self.velocities()[0]
+
+    @property
+    def v(self):
+        """Velocity in the y direction"""
+        return self.velocities()[1]
 
     def velocities(self):
         """
         Returns the velocity components of the result obtained from
         the vorticity field.
         """
-        # Solve poisson equation for psi
-        psi_hat = -self.omega_hat/self.poisson
-        
-        # compute u,v
-        u_hat = 1j*self.ky*psi_hat
-        v_hat = -1j*self.kx*psi_hat
-        return (numpy.fft.ifft2(u_hat).real,
-                numpy.fft.ifft2(v_hat).real)
+        def compute():
+            # Solve poisson equation for psi
+            psi_hat = -self.omega_hat/self.poisson
+
+            # compute u,v
+            u_hat = 1j*self.ky*psi_hat
+            v_hat = -1j*self.kx*psi_hat
+            return (self.ifft2(u_hat),
+                    self.ifft2(v_hat))
+
+        return self._cached('velocities',compute)
 
     def corr2d(self):
         """
         Returns the array of non shifted 2d correlations.
         """
-        corr = numpy.fft.ifft2(
-            numpy.conjugate(self.omega_hat)*self.omega_hat).real
+        def compute():
+            corr = self.ifft2(
+                numpy.conjugate(self.omega_hat)*self.omega_hat)
+            return corr/self.allreduce(
+                corr.max(axis=(-2,-1),keepdims=True),'max')
 
-        return corr / corr.max()
+        return self._cached('corr2d',compute)
 
 
 class Vorticity2DSerial(Vorticity2D):
     """
     Class Vorticity 2D extended with fortran. Serial version of FFTW
-    used. Requires the rhs_tur2d module properly compiled.
+    used. Requires the rhs_tur2d module properly compiled, if it is
+    not available the right hand side of Vorticity2D is used with
+    the given FFT *backend* and *kernels*.
     """
-    def __init__(self,Lx,Ly,Re,CFL):
-        Vorticity2D.__init__(self,Lx,Ly,Re,CFL)
+    def __init__(self,Lx,Ly,Re,CFL,backend='numpy',threads=1,wisdom=None,
+                 rigor='FFTW_EXHAUSTIVE',wisdom_cache=None,single=False,
+                 integrator='rk4',kernels='numpy'):
+        """
+        Same arguments as Vorticity2D, *threads* is also the number
+        of threads of FFTW in the Fortran part. Additional arguments:
+
+          *rigor*: string
+            Planner rigor for the Fortran part: 'FFTW_ESTIMATE',
+            'FFTW_MEASURE', 'FFTW_PATIENT' or 'FFTW_EXHAUSTIVE'
+
+          *wisdom_cache*: string
+            Directory where the FFTW wisdom is stored between runs.
+            See :meth:`wisdom_file`. No wisdom is stored if None.
+        """
+        Vorticity2D.__init__(self,Lx,Ly,Re,CFL,backend=backend,
+                             threads=threads,wisdom=wisdom,single=single,
+                             integrator=integrator,kernels=kernels)
+        self.fortran = rhs_tur2d is not None
+        if not self.fortran:
+            print 'Extension module rhs_tur2d not available.',\
+                'Using the Python right hand side with the',\
+                getattr(self.kernels,'name','numpy'),'kernels'
+            return
+        # The Fortran part computes the whole right hand side
+        self.kernels = None
+        
+        # The Fortran routine writes on the arrays it is given, so
+        # they must be contiguous in Fortran order.
+        shape = self.omega_hat.shape
+        self.S1 = numpy.zeros(shape,dtype=self.dtype,order='F')
+        self.work = Workspace(shape,shape,order='F',dtype=self.dtype)
+        self.work.rhs = numpy.zeros(shape,dtype=self.dtype,order='F')
+        self.work.u_fw = numpy.zeros(shape,dtype=self.dtype,order='F')
+        self.work.v_fw = numpy.zeros(shape,dtype=self.dtype,order='F')
+
         rhs_tur2d.nx__ = self.nx
         rhs_tur2d.ny__ = self.ny
         rhs_tur2d.lx__ = Lx
         rhs_tur2d.ly__ = Ly
         rhs_tur2d.re__ = Re
-
+        rhs_tur2d.nthreads__ = threads
+        rhs_tur2d.single__ = int(single)
+        if single:
+            self.fw_fortran = rhs_tur2d.fw_fortran_single
+        else:
+            self.fw_fortran = rhs_tur2d.fw_fortran_serial
 
         rhs_tur2d.init()
+        self.plan(rigor,wisdom_cache)
+
+    def wisdom_file(self,wisdom_cache):
+        """
+        Name of the wisdom file in the directory *wisdom_cache*. The
+        wisdom depends on the grid size, the number of threads, the
+        precision and the version of FFTW.
+        """
+        return os.path.join(
+            wisdom_cache,'rhs_tur2d_{}x{}_t{}{}_{}.wisdom'.format(
+                self.nx,self.ny,rhs_tur2d.threads(),
+                '_single' if self.single else '',fftw_version()))
+
+    def plan(self,rigor='FFTW_EXHAUSTIVE',wisdom_cache=None):
+        """
+        Creates the FFTW plans of the Fortran part with the planner
+        *rigor*. The wisdom is read from and saved to *wisdom_cache*,
+        so only the first run with a given grid size plans from
+        scratch. Returns True if the wisdom was found.
+        """
+        wisdom = ''
+        if wisdom_cache:
+            if not os.path.isdir(wisdom_cache):
+                os.makedirs(wisdom_cache)
+            wisdom = self.wisdom_file(wisdom_cache)
+
+        # Fortran sees the arrays transposed
+        ny,nx = self.S1.shape
+        return rhs_tur2d.plan(rigor,wisdom,ny,nx) == 1
 
     def FW(self):
-        rhs,u,v = rhs_tur2d.fw_fortran_serial(self.S1)
+        if not self.fortran:
+            return Vorticity2D.FW(self)
+        
+        w = self.work
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        self.fw_fortran(self.S1,w.rhs,w.u_fw,w.v_fw)
+        if p is not None:
+            start = p.mark('fortran',start)
+        # The right hand side is in w.rhs. Swap the arrays instead of
+        # copying.
+        self.S1,w.rhs = w.rhs,self.S1
         
         ## Renormalize the fft here because u and v are computed in
         ## The Fortran part.
-        return (rhs,
-                u.real/(self.nx*self.ny),
-                v.real/(self.nx*self.ny))
+        numpy.divide(w.u_fw.real,self.nx*self.ny,out=w.u)
+        numpy.divide(w.v_fw.real,self.nx*self.ny,out=w.v)
+        if p is not None:
+            p.mark('velocities',start)
+        return (self.S1,w.u,w.v)
+
+    def nonlinear(self):
+        if not self.fortran:
+            return Vorticity2D.nonlinear(self)
+
+        S1,u,v = self.FW()
+        # After the swap w.rhs is the vorticity FW was given,
+        # subtract its viscous term.
+        w = self.work
+        p = self.profiler
+        if p is not None:
+            start = p.clock()
+        numpy.multiply(self.Lap,w.rhs,out=w.rhs)
+        numpy.divide(w.rhs,self.Re,out=w.rhs)
+        numpy.subtract(S1,w.rhs,out=S1)
+        if p is not None:
+            p.mark('viscous',start)
+        return (S1,u,v)
 
     def step(self):
         """
@@ -198,70 +844,284 @@ class Vorticity2DSerial(Vorticity2D):
         It uses a fourth order low-storage RK scheme and the timestep
         is evaluated at the first substep.
         """
-        self.S1 = self.omega_hat+(self.a[0]-self.b[0])*self.dt*self.S1
-        self.S1,u,v = self.FW()
-        vmax = numpy.sqrt(u**2+v**2).max()
-        self.dt = numpy.min([self.dtv,self.CFL*self.dl/vmax,0.5])
-        self.omega_hat = self.omega_hat+self.b[1]*self.dt*self.S1
-        
-        # Rest of Runge Kutta substeps
-        for i in range(1,4):
-            self.S1 = self.omega_hat+(self.a[i]-self.b[i])*self.dt*self.S1
-            self.S1 = self.FW()[0]
-            self.omega_hat = self.omega_hat+self.b[i+1]*self.dt*self.S1
-            
-        self.t += self.dt
+        Vorticity2D.step(self)
 
     def cleanup(self):
-        rhs_tur2d.cleanup()
+        if self.fortran:
+            rhs_tur2d.cleanup()
 
 
-def test_tur2d(fign,Lx,Ly,nsteps):
-    """Test a vortex soup"""
+class Vorticity2DEnsemble(Vorticity2D):
+    """
+    Ensemble of *nens* realizations of Vorticity2D in the same box,
+    advanced together. The fields have an additional leading
+    dimension, omega_hat is (nens,ny,nx), and the transforms are done
+    in a single call for all the members.
 
-    Re = 10000
-    CFL = 0.2
-    V = Vorticity2DSerial(Lx,Ly,Re,CFL)
-    # Genera la distribución inicial
+    Every member has its own timestep unless *shared_dt* is True, then
+    all of them advance with the smallest one. *t* and *dt* are
+    (nens,1,1) arrays so they broadcast against the fields.
 
-    x,y = numpy.meshgrid(numpy.linspace(-Lx/2,Lx/2,V.nx),
-                         numpy.linspace(-Ly/2,Ly/2,V.ny))
+    Example.
+    V = Vorticity2DEnsemble(2.0,2.0,10000,0.2,nens=16)
+    V.set_initial(omega) # omega is (16,V.ny,V.nx) or (V.ny,V.nx)
+    """
+    def __init__(self,Lx,Ly,Re,CFL,nens=1,shared_dt=False,**kwargs):
+        self.nens = nens
+        self.batch = (nens,)
+        self.shared_dt = shared_dt
+        Vorticity2D.__init__(self,Lx,Ly,Re,CFL,**kwargs)
+        self.t = numpy.zeros((nens,1,1))
+        self.dt = numpy.zeros((nens,1,1))
+
+    def set_initial(self,omega,spectral=False):
+        """
+        Set the initial vorticity of all the members. A single
+        (ny,nx) field, or spectrum, is used for all of them.
+        """
+        if spectral:
+            omega = numpy.broadcast_to(omega,self.omega_hat.shape)
+        else:
+            omega = numpy.broadcast_to(omega,self.batch+(self.ny,self.nx))
+        Vorticity2D.set_initial(self,omega,spectral)
+
+    def timestep(self,u,v):
+        """
+        Timestep of each member, or the smallest of them if
+        *shared_dt*.
+        """
+        w = self.work
+        numpy.multiply(u,u,out=w.ox)
+        numpy.multiply(v,v,out=w.oy)
+        numpy.add(w.ox,w.oy,out=w.ox)
+        vmax = numpy.sqrt(w.ox.max(axis=(1,2)))
+        self.vmax = vmax
+        dt = numpy.minimum(numpy.minimum(self.CFL*self.dl/vmax,self.dtv),
+                           self.dtmax)
+        if self.shared_dt:
+            dt[:] = dt.min()
+        return dt.reshape(self.dt.shape)
+
+    def member(self,i):
+        """
+        Vorticity2D with the state of the member *i*
+        """
+        V = Vorticity2D(self.Lx,self.Ly,self.Re,self.CFL,rfft=self.rfft,
+                        single=self.single,
+                        integrator=getattr(self.integrator,'name','rk4'),
+                        kernels=getattr(self.kernels,'name','numpy'))
+        V.omega_hat[...] = self.omega_hat[i]
+        V.S1[...] = self.S1[i]
+        V.t = float(self.t[i])
+        V.dt = float(self.dt[i])
+        V.nstep = self.nstep
+        return V
+
+
+class Vorticity2DMPI(Vorticity2D):
+    """
+    Vorticity2D distributed over the processes of the MPI
+    communicator *comm*, COMM_WORLD by default. omega_hat and the
+    spectral work arrays are slabs of columns of the spectrum and the
+    physical fields are slabs of rows, see fftbackend.SlabFFT. Only
+    the transforms communicate, plus the reductions of the timestep
+    and the diagnostics.
+
+    set_initial takes either the whole field, or spectrum, or the
+    local part. The generators of the module initial make whole
+    fields, except random_spectrum that needs a solver that is not
+    distributed. The fields in physical space are the local rows, use
+    :meth:`gather` to collect them.
+
+    Checkpoints and snapshots hold the whole spectrum, collected in
+    rank 0, so they are the same as the ones of Vorticity2D. save,
+    load and SnapshotWriter.write must be called by all the processes.
+
+    Example, run with mpirun -n 4 python script.py
+    V = Vorticity2DMPI(8.0,8.0,10000,0.2,rfft=True)
+    V.set_initial(vortex_soup(V,8.0,8.0))
+    for i in range(nsteps):
+        V.step()
+    omega = V.gather(V.omega) # None except in rank 0
+    """
+    def __init__(self,Lx,Ly,Re,CFL,rfft=False,single=False,comm=None,
+                 integrator='rk4',kernels='numpy'):
+        from mpi4py import MPI
+        self.MPI = MPI
+        if comm is None:
+            comm = MPI.COMM_WORLD
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        Vorticity2D.__init__(self,Lx,Ly,Re,CFL,rfft=rfft,backend='mpi',
+                             single=single,integrator=integrator,
+                             kernels=kernels)
+
+    def _make_backend(self,backend,shape,threads,wisdom):
+        return SlabFFT(shape,self.rfft,single=self.single,comm=self.comm)
+
+    def allreduce(self,a,op='sum'):
+        a = numpy.asarray(a,dtype='float')
+        result = numpy.empty_like(a)
+        self.comm.Allreduce(a,result,{'sum': self.MPI.SUM,
+                                      'max': self.MPI.MAX}[op])
+        return result
+
+    def set_initial(self,omega,spectral=False):
+        """
+        Set the initial vorticity from the whole field, or spectrum,
+        or from the part of this process.
+        """
+        if spectral:
+            if omega.shape != self.omega_hat.shape:
+                omega = omega[:,self.backend.columns]
+        elif omega.shape != self.backend.physical_shape:
+            omega = omega[self.backend.rows,:]
+        Vorticity2D.set_initial(self,omega,spectral)
+
+    def timestep(self,u,v):
+        """
+        Timestep limited by the largest velocity of all the processes
+        """
+        Vorticity2D.timestep(self,u,v)
+        self.vmax = float(self.allreduce(self.vmax,'max'))
+        return numpy.min([self.dtv,self.CFL*self.dl/self.vmax,
+                          self.dtmax])
+
+    def gather(self,a):
+        """
+        Collects the rows of the physical field *a* of all the
+        processes. Returns the whole field in rank 0, None in the rest.
+        """
+        parts = self.comm.gather(a,root=0)
+        if self.rank == 0:
+            return numpy.concatenate(parts,axis=0)
+
+    def gather_spectrum(self,a_hat):
+        """
+        Collects the columns of the spectrum *a_hat* of all the
+        processes. Returns the whole spectrum in rank 0, None in the
+        rest.
+        """
+        parts = self.comm.gather(numpy.ascontiguousarray(a_hat),root=0)
+        if self.rank == 0:
+            return numpy.concatenate(parts,axis=-1)
+
+    def save(self,path):
+        """
+        Saves a checkpoint like Vorticity2D.save, it can be loaded by
+        any solver of the same grid. All the processes wait until it
+        is on disk.
+        """
+        Vorticity2D.save(self,path)
+        self.comm.Barrier()
+
+    @classmethod
+    def from_checkpoint(cls,path,comm=None,**kwargs):
+        """
+        Creates a solver from the checkpoint in *path*, saved by any
+        solver of the same grid. Keyword arguments are passed to the
+        constructor.
+        """
+        statefile = open(os.path.join(path,'state.json'))
+        state = json.load(statefile)
+        statefile.close()
 
-    ### Sopa de vórtices. 2-3 segundos por paso.
-    omega = numpy.zeros(x.shape)
+        kwargs.setdefault('integrator',state.get('integrator','rk4'))
+        kwargs.setdefault('kernels',state.get('kernels','numpy'))
+        V = cls(state['Lx'],state['Ly'],state['Re'],state['CFL'],
+                rfft=state['rfft'],single=state.get('single',False),
+                comm=comm,**kwargs)
+        V.load(path)
+        return V
+
+
+def fftw_version():
+    """
+    Version string of the FFTW library, 'unknown' if it can not be
+    found.
+    """
+    name = ctypes.util.find_library('fftw3')
+    if name is None:
+        return 'unknown'
+    try:
+        lib = ctypes.CDLL(name)
+        version = ctypes.c_char.in_dll(lib,'fftw_version')
+        return ctypes.string_at(ctypes.addressof(version))
+    except (OSError,ValueError):
+        return 'unknown'
+
+
+def vortex_soup(V,Lx,Ly):
+    """
+    Lattice of alternating gaussian vortices with two missing
+    vortices, sampled on the grid of the solver *V*.
+    """
     nvx= numpy.int(Lx);
     nvy= numpy.int(Ly);
     vii=2;
     rii=30;
-    
-    for i in range(nvx):
-        for j in range(nvy):
-            if j==2 and i==1:
-                continue
-            if j==3 and i==1:
-                continue
-            else:
-                omega += (-1)**(i+j)*vii*\
-                    numpy.exp(-rii*((x+(i-nvx)*Lx/nvx+Lx/2+Lx/nvx/2)**2+\
-                                        (y+(j-nvy)*Ly/nvy+Lx/2+Ly/nvy/2)**2))
 
-            
+    i,j = numpy.meshgrid(numpy.arange(nvx),numpy.arange(nvy),indexing='ij')
+    keep = numpy.logical_not(numpy.logical_and(i==1,(j==2)|(j==3)))
+    i = i[keep]
+    j = j[keep]
+    xc = -((i-nvx)*Lx/nvx+Lx/2+Lx/nvx/2)
+    yc = -((j-nvy)*Ly/nvy+Lx/2+Ly/nvy/2)
+    return initial.gaussian_vortices(V,Lx,Ly,xc,yc,(-1)**(i+j)*vii,rii)
 
-    V.set_initial(omega)
-    V.t = 0
-    j = 0
 
-    for i in range(nsteps):
+def shear_layers(V,Lx,Ly,eps=0.1):
+    """
+    Two shear layers simetrically perturbed with amplitude *eps*,
+    sampled on the grid of the solver *V*. Like a planar infinite
+    jet.
+    """
+    return initial.shear_layers(V,Lx,Ly,eps)
+
+
+def test_tur2d(fign,Lx,Ly,nsteps,checkpoint=None,every=1000,profile=None):
+    """
+    Test a vortex soup. If *checkpoint* is given the state is saved
+    there every *every* steps, and the run continues from it if it
+    already exists. If *profile* is given the phases of the steps
+    are timed, and the statistics and the trace are written to
+    *profile*.json and *profile*.trace.json.
+    """
+    from profiling import Profiler
+
+    Re = 10000
+    CFL = 0.2
+    V = Vorticity2DSerial(Lx,Ly,Re,CFL)
+    if checkpoint is not None and os.path.isdir(checkpoint):
+        V.load(checkpoint)
+        print 'Restarting from step',V.nstep,'t =',V.t
+    else:
+        # Genera la distribución inicial
+
+        ### Sopa de vórtices. 2-3 segundos por paso.
+        V.set_initial(vortex_soup(V,Lx,Ly))
+        V.t = 0
+    W = SnapshotWriter(V,'/data/tur2d/tur2dbig.zarr')
+    if profile is not None:
+        V.profiler = Profiler()
+
+    for i in range(V.nstep,nsteps):
         tstamp = datetime.now()
         V.step()
         if i%40 == 0:
             print i,'/',nsteps,(datetime.now()-tstamp).total_seconds()
-            datfile = open('/data/tur2d/tur2dbig{:05d}.npy'.format(j),'w')
-            numpy.save(datfile,V.omega)
-            datfile.close()
-            j += 1
+            W.write()
+        if checkpoint is not None and (i+1)%every == 0:
+            # Snapshots before the checkpoint must be on disk
+            W.flush()
+            V.save(checkpoint)
 
+    W.close()
     V.cleanup()
+    if profile is not None:
+        V.profiler.report()
+        V.profiler.save(profile+'.json')
+        V.profiler.save_trace(profile+'.trace.json')
     return V
 
 
@@ -271,18 +1131,7 @@ def test_kh(fign,Lx,Ly,nsteps):
     CFL = 0.2
 
     V = Vorticity2DSerial(Lx,Ly,Re,CFL)
-    # Uniform grid mesh
-    x,y = numpy.meshgrid(numpy.linspace(-Lx/2,Lx/2,V.nx),
-                         numpy.linspace(-Ly/2,Ly/2,V.ny))
-    
-    # Two shear layers simetrically perturbed. Like a planar
-    # infinite jet
-
-    omega = (1+0.1*numpy.cos(numpy.pi*x[0]))*numpy.exp(-300*(y+Ly/4.)**2)
-    omega += -(1+0.1*numpy.cos(numpy.pi*x[0]))*numpy.exp(-300*(y-Ly/4.)**2)
-        
-
-    V.set_initial(omega)
+    V.set_initial(shear_layers(V,Lx,Ly))
     V.t = 0
 
     # for i in range(nsteps):
@@ -293,6 +1142,315 @@ def test_kh(fign,Lx,Ly,nsteps):
 
     return V
 
+def test_kh_ensemble(Lx,Ly,nsteps,eps=(0.05,0.1,0.2,0.4),shared_dt=False):
+    """
+    Kelvin-Helmholtz instabilities with the perturbation amplitudes
+    *eps*, advanced as a single ensemble.
+    """
+    Re = 10000
+    CFL = 0.2
+
+    V = Vorticity2DEnsemble(Lx,Ly,Re,CFL,nens=len(eps),shared_dt=shared_dt,
+                            rfft=True)
+    V.set_initial(numpy.array([shear_layers(V,Lx,Ly,e) for e in eps]))
+
+    for i in range(nsteps):
+        V.step()
+        if i%100 == 0:
+            print i,'/',nsteps,'t:',V.t.ravel()
+
+    return V
+
+
+def test_restart(Lx,Ly,nsteps,Re=10000,CFL=0.2):
+    """
+    Runs *nsteps* of the Kelvin-Helmholtz instability, saves a
+    checkpoint, restarts from it and runs *nsteps* more. The result
+    must be the one of 2*nsteps uninterrupted steps, bit for bit, for
+    Vorticity2D and for ensembles with and without *shared_dt*.
+    """
+    eps = (0.05,0.1,0.2)
+    cases = [(Vorticity2D,{}),
+             (Vorticity2DEnsemble,{'nens': len(eps),'shared_dt': False}),
+             (Vorticity2DEnsemble,{'nens': len(eps),'shared_dt': True})]
+    path = tempfile.mkdtemp()
+    try:
+        for solver,kwargs in cases:
+            V = solver(Lx,Ly,Re,CFL,rfft=True,**kwargs)
+            if V.batch:
+                V.set_initial(numpy.array([shear_layers(V,Lx,Ly,e)
+                                           for e in eps]))
+            else:
+                V.set_initial(shear_layers(V,Lx,Ly))
+            for i in range(nsteps):
+                V.step()
+            V.save(os.path.join(path,'checkpoint'))
+            R = solver.from_checkpoint(os.path.join(path,'checkpoint'))
+            for i in range(nsteps):
+                V.step()
+                R.step()
+            print solver.__name__,kwargs,'t:',numpy.ravel(V.t)
+            assert getattr(R,'shared_dt',None) == kwargs.get('shared_dt')
+            assert numpy.all(R.omega_hat == V.omega_hat)
+            assert numpy.all(R.t == V.t) and R.nstep == V.nstep
+    finally:
+        shutil.rmtree(path)
+
+
+def time_steps(V,nsteps):
+    """
+    Seconds per step of the solver *V* averaged over *nsteps*
+    """
+    tstamp = datetime.now()
+    for i in range(nsteps):
+        V.step()
+    return (datetime.now()-tstamp).total_seconds()/nsteps
+
+
+def bench_serial(Lx,Ly,nsteps,Re=10000,CFL=0.2,**kwargs):
+    """
+    Time per step of Vorticity2D and Vorticity2DSerial on the vortex
+    soup. Keyword arguments are passed to both solvers.
+    """
+    results = {}
+    for solver in (Vorticity2D,Vorticity2DSerial):
+        V = solver(Lx,Ly,Re,CFL,**kwargs)
+        V.set_initial(vortex_soup(V,Lx,Ly))
+        V.step()
+        results[solver.__name__] = time_steps(V,nsteps)
+        print solver.__name__,'seconds per step:',results[solver.__name__]
+        if solver is Vorticity2DSerial:
+            V.cleanup()
+
+    return results
+
+
+def bench_kernels(Lx,Ly,nsteps,Re=10000,CFL=0.2,**kwargs):
+    """
+    Time per step of Vorticity2D with the numpy and the numba kernels,
+    and of Vorticity2DSerial with the Fortran right hand side if it
+    is available, on the vortex soup. Checks that both kernels give
+    the same right hand side. Keyword arguments are passed to the
+    solvers.
+    """
+    cases = [('numpy',Vorticity2D,{'kernels': 'numpy'}),
+             ('numba',Vorticity2D,{'kernels': 'numba'})]
+    if rhs_tur2d is not None:
+        cases.append(('fortran',Vorticity2DSerial,{}))
+
+    results = {}
+    rhs = {}
+    for name,solver,extra in cases:
+        V = solver(Lx,Ly,Re,CFL,**dict(kwargs,**extra))
+        V.set_initial(vortex_soup(V,Lx,Ly))
+        V.S1[...] = V.omega_hat
+        # The first call compiles the kernels or reads the cache
+        tstamp = datetime.now()
+        rhs[name] = V.FW()[0].copy()
+        first = (datetime.now()-tstamp).total_seconds()
+        V.step()
+        results[name] = time_steps(V,nsteps)
+        print name,'seconds per step:',results[name],\
+            'first right hand side:',first
+        if hasattr(V,'cleanup'):
+            V.cleanup()
+
+    if V.kernels is None and 'fortran' not in results:
+        print 'Numba not available'
+    else:
+        assert numpy.all(rhs['numba'] == rhs['numpy'])
+    for name in results:
+        print name,'speedup:',results['numpy']/results[name],\
+            'max difference:',numpy.abs(rhs[name]-rhs['numpy']).max()
+    return results
+
+def bench_rfft(Lx,Ly,nsteps,Re=10000,CFL=0.2):
+    """
+    Compares the complex and the real to complex versions of
+    Vorticity2D on the vortex soup. Prints the time per step, the
+    memory used by the spectral arrays and the maximum difference
+    between both vorticity fields.
+    """
+    results = {}
+    for rfft in (False,True):
+        V = Vorticity2D(Lx,Ly,Re,CFL,rfft=rfft)
+        V.set_initial(vortex_soup(V,Lx,Ly))
+        nbytes = sum(a.nbytes for a in (V.omega_hat,V.S1,V.kx,V.ky,
+                                        V.Lap,V.dealias))
+        elapsed = time_steps(V,nsteps)
+        print 'rfft:',rfft,'seconds per step:',elapsed,\
+            'MB:',nbytes/2**20
+        results[rfft] = (elapsed,nbytes,V.omega)
+
+    print 'Speedup:',results[False][0]/results[True][0]
+    print 'Memory ratio:',results[True][1]/results[False][1]
+    print 'Max difference:',numpy.abs(results[False][2]-
+                                      results[True][2]).max()
+    return results
+
+
+def test_single(Lx,Ly,nsteps,Re=10000,CFL=0.2,tol=1e-4,
+                solver=Vorticity2D,**kwargs):
+    """
+    Runs the vortex soup in double and in single precision with
+    *solver* and checks that the relative difference of the energy
+    and the enstrophy stays below *tol* during *nsteps* steps.
+    Keyword arguments are passed to both solvers. Returns the time
+    per step and the largest differences.
+    """
+    from diagnostics import Diagnostics
+    results = {}
+    for single in (False,True):
+        V = solver(Lx,Ly,Re,CFL,single=single,**kwargs)
+        V.set_initial(vortex_soup(V,Lx,Ly))
+        V.diagnostics = Diagnostics(V)
+        elapsed = time_steps(V,nsteps)
+        nbytes = V.omega_hat.nbytes+V.S1.nbytes+V.work.nbytes
+        print 'single:',single,'seconds per step:',elapsed,\
+            'MB:',nbytes/2**20
+        results[single] = (elapsed,V.diagnostics.records)
+        if hasattr(V,'cleanup'):
+            V.cleanup()
+
+    drift = {}
+    for name in ('energy','enstrophy'):
+        double = results[False][1][name]
+        drift[name] = numpy.abs(results[True][1][name]/double-1).max()
+        print name,'relative drift:',drift[name]
+    assert max(drift.values()) < tol,\
+        'Single precision drift {} above {}'.format(drift,tol)
+    return results[False][0],results[True][0],drift
+
+
+def bench_integrators(Lx,Ly,T,Re=10000,steps=(8,16,32,64,128),
+                      reference=1024,solver=Vorticity2D,**kwargs):
+    """
+    Time to solution of the integrators. The vortex soup is advanced
+    up to the time *T* with each number of *steps* of constant dt,
+    and compared with ETDRK4 with *reference* steps. Prints the time,
+    the largest CFL number of the run and the error of the vorticity
+    relative to its maximum, inf if the run is unstable. Keyword
+    arguments are passed to the solver. Returns a dictionary
+    (integrator,nsteps): (seconds,CFL,error).
+    """
+    def run(integrator,nsteps):
+        # The CFL condition never limits the timestep, dtmax does
+        V = solver(Lx,Ly,Re,1e6,integrator=integrator,**kwargs)
+        V.set_initial(vortex_soup(V,Lx,Ly))
+        V.dtmax = T/nsteps
+        if V.integrator is not None:
+            # Tables for dtmax itself, not below it
+            V.integrator.refresh = 0
+        cfl = 0
+        tstamp = datetime.now()
+        for i in range(nsteps):
+            V.step()
+            cfl = max(cfl,V.dtmax*V.vmax/V.dl)
+            if not numpy.isfinite(V.vmax):
+                break
+        elapsed = (datetime.now()-tstamp).total_seconds()
+        omega = V.omega.copy()
+        if hasattr(V,'cleanup'):
+            V.cleanup()
+        return elapsed,cfl,omega
+
+    exact = run('etdrk4',reference)[2]
+    scale = numpy.abs(exact).max()
+
+    results = {}
+    for integrator in ('rk4','ifrk4','etdrk4'):
+        for nsteps in steps:
+            elapsed,cfl,omega = run(integrator,nsteps)
+            error = numpy.abs(omega-exact).max()/scale
+            if not numpy.isfinite(error):
+                error = numpy.inf
+            print integrator,'steps:',nsteps,'seconds:',elapsed,\
+                'CFL:',cfl,'error:',error
+            results[integrator,nsteps] = (elapsed,cfl,error)
+    return results
+
+
+def test_rebuilds(Lx,Ly,nsteps,Re=10000,CFL=0.2,maxrebuilds=3):
+    """
+    Number of times the exponential integrators compute their tables
+    in *nsteps* of the Kelvin-Helmholtz instability. The velocity
+    grows at every step, the tables must not follow it.
+    """
+    for integrator in ('ifrk4','etdrk4'):
+        V = Vorticity2D(Lx,Ly,Re,CFL,integrator=integrator)
+        V.set_initial(shear_layers(V,Lx,Ly))
+        tstamp = datetime.now()
+        for i in range(nsteps):
+            V.step()
+        print integrator,'rebuilds:',V.integrator.rebuilds,'seconds:',\
+            (datetime.now()-tstamp).total_seconds()
+        assert V.integrator.rebuilds <= maxrebuilds
+        # The steps are never longer than the CFL condition allows
+        assert V.dt <= V.CFL*V.dl/V.vmax
+
+
+def test_mpi(Lx,Ly,nsteps,Re=10000,CFL=0.2,rfft=True,tol=1e-12):
+    """
+    Runs the vortex soup with Vorticity2DMPI and, in rank 0, with
+    Vorticity2D, prints the time per step and checks that the
+    vorticity and the diagnostics differ less than *tol* relative to
+    their maximum. Checks that the checkpoints and the snapshots of
+    both solvers are interchangeable. Run with
+    mpirun -n 4 python -c "import turbulence; turbulence.test_mpi(4.,4.,50)"
+    """
+    from diagnostics import Diagnostics
+    from snapshots import SnapshotReader
+
+    V = Vorticity2DMPI(Lx,Ly,Re,CFL,rfft=rfft)
+    V.set_initial(vortex_soup(V,Lx,Ly))
+    V.diagnostics = Diagnostics(V)
+    V.comm.Barrier()
+    elapsed = time_steps(V,nsteps)
+    omega = V.gather(V.omega)
+
+    path = V.comm.bcast(tempfile.mkdtemp() if V.rank == 0 else None,root=0)
+    try:
+        V.save(os.path.join(path,'checkpoint'))
+        W = SnapshotWriter(V,os.path.join(path,'snapshots.zarr'))
+        W.write()
+        W.close()
+        # Another step from the checkpoint, in every process
+        R = Vorticity2DMPI.from_checkpoint(os.path.join(path,'checkpoint'))
+        V.step()
+        R.step()
+        assert numpy.all(R.omega_hat == V.omega_hat)
+
+        if V.rank != 0:
+            return
+        S = Vorticity2D(Lx,Ly,Re,CFL,rfft=rfft)
+        S.set_initial(vortex_soup(S,Lx,Ly))
+        S.diagnostics = Diagnostics(S)
+        serial = time_steps(S,nsteps)
+
+        print 'Processes:',V.comm.Get_size(),'seconds per step:',elapsed,\
+            'serial:',serial
+        scale = numpy.abs(S.omega).max()
+        difference = numpy.abs(omega-S.omega).max()
+        print 'Max difference:',difference,'of',scale
+        assert difference <= tol*scale
+        for name in ('t','energy','enstrophy','vmax'):
+            serial = S.diagnostics.records[name]
+            difference = numpy.abs(V.diagnostics.records[name][:nsteps]-
+                                   serial).max()
+            print name,difference
+            assert difference <= tol*numpy.abs(serial).max()
+
+        snapshot = SnapshotReader(os.path.join(path,'snapshots.zarr'))[0]
+        assert numpy.abs(snapshot-S.omega).max() <= tol*scale
+        C = Vorticity2D.from_checkpoint(os.path.join(path,'checkpoint'))
+        assert numpy.abs(C.omega_hat-S.omega_hat).max() <= \
+            tol*numpy.abs(S.omega_hat).max()
+    finally:
+        V.comm.Barrier()
+        if V.rank == 0:
+            shutil.rmtree(path)
+
+
 if __name__ == '__main__':
 
     vort = test_tur2d(1,32.0,32.0,40000)